@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# Mrs
+# Copyright 2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Estimates pi with vectorized (NumPy) map and reduce functions.
+
+This computes the same Halton sequence as pure_pi.py, but each call to the
+mapper handles a whole array of map tasks at once.  The records are stored
+in StructWriter files, so the mapper's input arrays are read directly from
+the packed blocks.
+"""
+
+from __future__ import division, print_function
+
+import sys
+import mrs
+import numpy
+
+# The number of digits of the Halton sequence in bases 2 and 3 (enough for
+# 63-bit indices).
+DIGITS = {2: 63, 3: 40}
+
+
+def radical_inverse(indices, base):
+    """Computes the base-`base` radical inverse of an array of indices."""
+    result = numpy.zeros(indices.shape)
+    remaining = indices.copy()
+    scale = 1 / base
+    for _ in range(DIGITS[base]):
+        if not remaining.any():
+            break
+        result += scale * (remaining % base)
+        remaining //= base
+        scale /= base
+    return result
+
+
+class NumpyPi(mrs.MapReduce):
+    int64_serializer = mrs.make_primitive_serializer('<q')
+
+    @mrs.vectorized
+    @mrs.output_serializers(key='int64_serializer', value='int64_serializer')
+    def map_batch(self, keys, values):
+        """Counts the points inside the circle for each start index.
+
+        The output keys are 1 for points inside and 0 for points outside.
+        """
+        num_points = int(self.opts.num_points)
+        offsets = numpy.arange(1, num_points + 1, dtype=numpy.int64)
+        indices = values[:, numpy.newaxis] + offsets
+        x = radical_inverse(indices, 2) - .5
+        y = radical_inverse(indices, 3) - .5
+        inside = (x * x + y * y <= .25).sum(axis=1)
+
+        out_keys = numpy.repeat(numpy.array([1, 0], dtype=numpy.int64),
+                len(values))
+        out_values = numpy.concatenate((inside, num_points - inside))
+        return out_keys, out_values.astype(numpy.int64)
+
+    @mrs.vectorized
+    def reduce_batch(self, key, values):
+        yield int(values.sum())
+
+    def run(self, job):
+        points = int(self.opts.num_points)
+        tasks = self.opts.num_tasks
+        kvpairs = ((i, i * points) for i in range(tasks))
+        source = job.local_data(kvpairs, splits=self.opts.num_splits,
+                key_serializer='int64_serializer',
+                value_serializer='int64_serializer',
+                format=mrs.StructWriter)
+
+        intermediate = job.map_data(source, self.map_batch,
+                parter=self.vectorized_mod_partition, format=mrs.StructWriter)
+        source.close()
+        output = job.reduce_data(intermediate, self.reduce_batch)
+        intermediate.close()
+
+        job.wait(output)
+        output.fetchall()
+        for key, value in output.data():
+            if key == 1:
+                inside = value
+            else:
+                outside = value
+
+        pi = 4 * inside / (inside + outside)
+        print(pi)
+        sys.stdout.flush()
+
+        return 0
+
+    @classmethod
+    def update_parser(cls, parser):
+        parser.add_option('-p', '--points',
+                        dest='num_points',
+                        help='Number of points for each map task',
+                        default=1000)
+
+        parser.add_option('-t', '--tasks',
+                        dest='num_tasks', type='int',
+                        help='Number of records (map task inputs)',
+                        default=40)
+
+        parser.add_option('-s', '--splits',
+                        dest='num_splits', type='int',
+                        help='Number of splits of the input records',
+                        default=4)
+
+        return parser
+
+if __name__ == '__main__':
+    mrs.main(NumpyPi)
@@ -44,20 +44,27 @@ logger.addHandler(handler)
 # expected to be useful outside of Mrs internals.
 from . import registry
 from . import version
-from .fileformats import HexWriter, TextWriter, BinWriter, ZipWriter
+from .fileformats import (HexWriter, TextWriter, BinWriter, ZipWriter,
+        StructWriter)
 from .main import main
-from .mapreduce import MapReduce, IterativeMR, GeneratorCallbackMR
-from .serializers import (Serializer, output_serializers, raw_serializer,
-        str_serializer, int_serializer, make_struct_serializer,
-        make_primitive_serializer, make_protobuf_serializer)
+from .mapreduce import (MapReduce, IterativeMR, GeneratorCallbackMR,
+        mutates_input, vectorized)
+from .serializers import (Serializer, output_serializers, auto_serializer,
+        pickle_serializer, raw_serializer, str_serializer, int_serializer,
+        varint_serializer, marshal_serializer, make_struct_serializer,
+        make_primitive_serializer, make_tuple_serializer,
+        make_protobuf_serializer)
 
 __version__ = version.__version__
 
 # We need to set __all__ to make sure that pydoc has everything:
 __all__ = ['MapReduce', 'main', 'logger', 'BinWriter', 'HexWriter',
-    'TextWriter', 'Serializer', 'output_serializers', 'raw_serializer',
-    'str_serializer', 'int_serializer', 'make_struct_serializer',
-    'make_primitive_serializer', 'make_protobuf_serializer',
-    'GeneratorCallbackMR']
+    'TextWriter', 'StructWriter', 'Serializer', 'output_serializers',
+    'auto_serializer', 'pickle_serializer', 'raw_serializer',
+    'str_serializer', 'int_serializer', 'varint_serializer',
+    'marshal_serializer', 'make_struct_serializer',
+    'make_primitive_serializer', 'make_tuple_serializer',
+    'make_protobuf_serializer',
+    'GeneratorCallbackMR', 'mutates_input', 'vectorized']
 
 # vim: et sw=4 sts=4
@@ -0,0 +1,619 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mrs Master on asyncio (Python 3 only)
+
+The MasterRunner serves RPCs from slaves on a pool of threads, makes RPCs to
+slaves from peon threads, and wakes up its event loop through a pipe.  With
+many slaves, these threads spend much of their time contending for locks.
+The AsyncMasterRunner instead runs everything on one asyncio event loop: the
+XML-RPC server and the RPC clients for the slaves are coroutines, and the
+job connection is watched by the same loop.  Only chores that do blocking
+work (such as deleting files) run on a small, fixed pool of threads.
+"""
+
+from __future__ import division, print_function
+
+import asyncio
+import concurrent.futures
+import gzip
+import socket
+import time
+import traceback
+
+from urllib.parse import urlsplit
+from xmlrpc.client import Fault, ProtocolError, dumps, loads
+
+from . import http
+from . import master
+from . import peons
+from . import registry
+from .version import __version__
+
+import logging
+logger = logging.getLogger('mrs')
+del logging
+
+# Number of threads for chores that are not coroutines.
+CHORE_THREADS = 4
+RPC_PATHS = ('/', '/RPC2')
+USER_AGENT = 'Mrs/%s' % __version__
+
+
+class AsyncMasterRunner(master.MasterRunner):
+    """A MasterRunner that runs on a single asyncio event loop.
+
+    Attributes:
+        loop: the asyncio event loop
+        rpc_server: the AsyncRPCServer for requests from slaves
+    """
+    def __init__(self, *args):
+        self.loop = None
+        super(AsyncMasterRunner, self).__init__(*args)
+        self.rpc_server = None
+
+    def make_event_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        return AsyncEventLoop(self.loop)
+
+    def make_chore_queue(self):
+        return AsyncChoreQueue(self.loop)
+
+    def run(self):
+        self.sched_timing_stats()
+        self.slaves = AsyncSlaves(self.event_loop, self.schedule,
+                self.chore_queue, self.opts.mrs__timeout,
+                self.opts.mrs__pingdelay, self.opts.mrs__phi_threshold)
+
+        try:
+            self.loop.run_until_complete(self.start_rpc_server())
+            self.event_loop.run()
+        finally:
+            # Rewrite the runfile with a hyphen to signify that execution is
+            # complete.
+            self.write_runfile('-')
+            self.loop.run_until_complete(self.slaves.disconnect_all())
+            if self.rpc_server is not None:
+                self.loop.run_until_complete(self.rpc_server.close())
+            self.loop.run_until_complete(self.chore_queue.shutdown())
+            self.loop.close()
+        return self.exitcode
+
+    async def start_rpc_server(self):
+        program_hash = registry.object_hash(self.program_class)
+        self.rpc_interface = self.make_rpc_interface(program_hash)
+        port = getattr(self.opts, 'mrs__port', 0)
+        self.rpc_server = AsyncRPCServer(self.rpc_interface)
+        port = await self.rpc_server.start(port)
+
+        logger.info('Listening on port %s.' % port)
+        self.write_runfile(port)
+
+    def add_peon_threads(self):
+        """Does nothing (RPCs to slaves run on the event loop)."""
+        pass
+
+
+class AsyncEventLoop(object):
+    """An adapter that gives an asyncio loop the interface of an EventLoop.
+
+    See `util.EventLoop`.  Setting `running` to False stops the `run` method.
+    As with an EventLoop, an exception in a handler stops the loop and is
+    raised by `run`.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.handler_map = {}
+        self.writer_map = {}
+        self._running = True
+        self._stopped = loop.create_future()
+
+    @property
+    def running(self):
+        return self._running
+
+    @running.setter
+    def running(self, value):
+        self._running = value
+        if not value and not self._stopped.done():
+            self._stopped.set_result(None)
+
+    def call_handler(self, handler):
+        """Calls the handler, stopping the loop if it raises an exception."""
+        try:
+            handler()
+        except Exception as e:
+            if self._stopped.done():
+                raise
+            self._running = False
+            self._stopped.set_exception(e)
+
+    def call_soon(self, handler):
+        """Arranges for the handler to be called by the loop."""
+        self.loop.call_soon(self.call_handler, handler)
+
+    def register_fd(self, fd, handler):
+        self.handler_map[fd] = handler
+        self.loop.add_reader(fd, self.call_handler, handler)
+
+    def unregister_fd(self, fd):
+        del self.handler_map[fd]
+        self.loop.remove_reader(fd)
+        self.unregister_writer(fd)
+
+    def register_writer(self, fd, handler):
+        """Calls the given handler whenever the file descriptor is writable.
+
+        Unlike with an EventLoop, this must be called from the loop's thread.
+        """
+        self.writer_map[fd] = handler
+        self.loop.add_writer(fd, self.call_handler, handler)
+
+    def unregister_writer(self, fd):
+        if self.writer_map.pop(fd, None) is not None:
+            self.loop.remove_writer(fd)
+
+    def run(self, timeout_function=None):
+        """Runs the asyncio loop until `running` is set to False.
+
+        The timeout_function is ignored (timers are handled by the loop).
+        """
+        if self._running:
+            self.loop.run_until_complete(self._stopped)
+
+
+class AsyncChoreQueue(object):
+    """A ChoreQueue that runs chores on an asyncio loop.
+
+    See `peons.ChoreQueue`.  Chores that are coroutine functions run as tasks
+    on the loop.  Other chores might block, so they run on a pool of
+    CHORE_THREADS threads.  Delayed chores are kept in a TimerWheel, and the
+    loop only has a single callback for the wheel's next expiration.
+    """
+    def __init__(self, loop, threads=CHORE_THREADS):
+        self.loop = loop
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._tasks = set()
+        self._wheel = peons.TimerWheel()
+        self._wakeup = None
+        self._wakeup_time = None
+
+    def do(self, f, args=(), delay=0):
+        """Run a function with given args.
+
+        The action will be performed after a delay (in seconds) if the option
+        is specified, in which case a Timer is returned.
+        """
+        if delay:
+            timer = peons.Timer(self, time.time() + delay, (f, args))
+            self._add_timer(timer)
+            return timer
+        else:
+            self._start(f, args)
+
+    def _add_timer(self, timer):
+        expiry = self._wheel.add(timer)
+        if (self._wakeup_time is None) or (expiry < self._wakeup_time):
+            self._set_wakeup(expiry)
+
+    def _set_wakeup(self, when):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self._wakeup_time = when
+        if when is not None:
+            self._wakeup = self.loop.call_later(max(0, when - time.time()),
+                    self._expire)
+
+    def _expire(self):
+        self._wakeup = None
+        for timer in self._wheel.advance(time.time()):
+            self._start(*timer.item)
+        self._set_wakeup(self._wheel.next_expiry())
+
+    def cancel_timer(self, timer):
+        """Cancels a timer (see `peons.Timer.cancel`)."""
+        if not timer.pending():
+            return False
+        self._wheel.remove(timer)
+        return True
+
+    def reset_timer(self, timer, delay):
+        """Reschedules a timer (see `peons.Timer.reset`)."""
+        if not timer.pending():
+            return False
+        self._wheel.remove(timer)
+        timer.when = time.time() + delay
+        self._add_timer(timer)
+        return True
+
+    def do_many(self, items):
+        """Run the given items, each of which is an (f, args) pair."""
+        for f, args in items:
+            self._start(f, args)
+
+    def _start(self, f, args):
+        if asyncio.iscoroutinefunction(f):
+            task = self.loop.create_task(_run_coroutine_chore(f, args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self.loop.run_in_executor(self._executor, _run_chore, f, args)
+
+    async def shutdown(self):
+        """Cancels the remaining chores and stops the threads."""
+        self._set_wakeup(None)
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+
+def _run_chore(f, args):
+    try:
+        f(*args)
+    except Exception as e:
+        tb = traceback.format_exc()
+        logger.critical('Exception in thread pool: %s' % e)
+        logger.error('Traceback: %s' % tb)
+
+
+async def _run_coroutine_chore(f, args):
+    try:
+        await f(*args)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        tb = traceback.format_exc()
+        logger.critical('Exception in chore: %s' % e)
+        logger.error('Traceback: %s' % tb)
+
+
+class AsyncRPCServer(object):
+    """An XML-RPC server on asyncio.
+
+    Requests are dispatched like those of `http.RPCServer`, and HTTP/1.1
+    connections are kept alive.  The methods of the instance are called on
+    the event loop, so they must not block.
+    """
+    def __init__(self, instance):
+        self.instance = instance
+        self._server = None
+        self._connections = set()
+
+    async def start(self, port):
+        """Starts listening on the given port (0 for any) and returns it."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        sock.listen(http.BACKLOG)
+        self._server = await asyncio.start_server(self.handle_connection,
+                sock=sock)
+        return sock.getsockname()[1]
+
+    async def close(self):
+        """Stops listening and closes any open connections."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        tasks = list(self._connections)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            await self._serve_connection(reader, writer)
+        except asyncio.CancelledError:
+            # The server is closing.
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _serve_connection(self, reader, writer):
+        host = writer.get_extra_info('peername')[0]
+        sock = writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    header = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                command, path, version, headers = parse_header(header)
+                body = await reader.readexactly(
+                        int(headers.get('content-length', 0)))
+
+                if command != 'POST':
+                    status, body = '501 Unsupported method', b''
+                elif path not in RPC_PATHS:
+                    status, body = '404 Not Found', b''
+                else:
+                    if headers.get('content-encoding') == 'gzip':
+                        body = gzip.decompress(body)
+                    status, body = '200 OK', self.dispatch_request(body, host)
+
+                keep_alive = (version == 'HTTP/1.1' and
+                        headers.get('connection', '').lower() != 'close')
+                writer.write(('HTTP/1.1 %s\r\nContent-Type: text/xml\r\n'
+                    'Content-Length: %s\r\n\r\n' % (status, len(body))
+                    ).encode('latin-1') + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (OSError, ValueError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError):
+            pass
+
+    def dispatch_request(self, data, host):
+        """Returns the marshaled response to the given request body."""
+        try:
+            params, method = loads(data)
+            result = http.dispatch(self.instance, method, params, host)
+            response = dumps((result,), methodresponse=True)
+        except Fault as fault:
+            response = dumps(fault)
+        except Exception as e:
+            response = dumps(Fault(1, '%s:%s' % (type(e), e)))
+        return response.encode('utf-8', 'xmlcharrefreplace')
+
+
+class AsyncServerProxy(object):
+    """An XML-RPC client whose calls are coroutines.
+
+    Attributes are RPC methods, as with xmlrpc.client.ServerProxy.  Calls are
+    made one at a time over a persistent HTTP/1.1 connection, and they are
+    retried like those of `http.TimeoutServerProxy`.
+    """
+    def __init__(self, uri, timeout):
+        url = http.rpc_url(uri)
+        scheme, self._netloc, path, query, _ = urlsplit(url)
+        self._path = path + ('?' + query if query else '')
+        self._host, _, port = self._netloc.rpartition(':')
+        self._port = int(port)
+        self._url = url
+        self._timeout = timeout
+        self._lock = asyncio.Lock()
+        self._reader = None
+        self._writer = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def method(*params):
+            return await self.call(name, params)
+        return method
+
+    def busy(self):
+        """Indicates whether a call is in progress."""
+        return self._lock.locked()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def call(self, method, params):
+        """Makes an RPC and returns its result.
+
+        Raises http.ConnectionFailed if the server cannot be reached.
+        """
+        request = dumps(params, method).encode('utf-8', 'xmlcharrefreplace')
+        async with self._lock:
+            for i in range(http.RETRIES):
+                reused = self._writer is not None
+                try:
+                    return await asyncio.wait_for(self._request(request),
+                            self._timeout or None)
+                except asyncio.TimeoutError:
+                    logger.error('RPC to %s failed: timed out.' % self._netloc)
+                    self.close()
+                    await asyncio.sleep(http.RETRY_DELAY)
+                except ConnectionRefusedError:
+                    logger.error('RPC to %s failed: connection refused.'
+                            % self._netloc)
+                    self.close()
+                except (OSError, asyncio.IncompleteReadError) as e:
+                    self.close()
+                    if reused:
+                        # The server may have closed the idle connection.
+                        continue
+                    logger.error('RPC to %s failed: %s' % (self._netloc, e))
+                    break
+        raise http.ConnectionFailed(self._netloc)
+
+    async def _request(self, request):
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(
+                    self._host, self._port)
+            sock = self._writer.get_extra_info('socket')
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._writer.write(('POST %s HTTP/1.1\r\nHost: %s\r\n'
+            'User-Agent: %s\r\nContent-Type: text/xml\r\n'
+            'Content-Length: %s\r\n\r\n' % (self._path, self._netloc,
+                USER_AGENT, len(request))).encode('latin-1') + request)
+        await self._writer.drain()
+
+        header = await self._reader.readuntil(b'\r\n\r\n')
+        version, status, reason, headers = parse_header(header)
+        body = await self._reader.readexactly(
+                int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            self.close()
+        if status != '200':
+            raise ProtocolError(self._url, int(status), reason, headers)
+        if headers.get('content-encoding') == 'gzip':
+            body = gzip.decompress(body)
+        params, _ = loads(body)
+        return params[0]
+
+
+def parse_header(header):
+    """Parses the start line and headers of an HTTP message.
+
+    Returns the three fields of the start line and a dict of headers (with
+    lowercase names).
+    """
+    lines = header.decode('latin-1').split('\r\n')
+    fields = lines[0].split(' ', 2)
+    if len(fields) < 2:
+        raise ValueError('Invalid HTTP start line: %r' % lines[0])
+    fields.extend([''] * (3 - len(fields)))
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return fields[0], fields[1], fields[2], headers
+
+
+class AsyncRemoteSlave(master.RemoteSlave):
+    """A RemoteSlave whose RPCs are coroutines.
+
+    The send_assignment, remove, check, and send_exit methods are coroutine
+    functions, which the AsyncChoreQueue runs on the event loop.
+    """
+    proxy_class = AsyncServerProxy
+
+    async def _call(self, description, method, *args):
+        """Makes an RPC, returning a (success, result) pair."""
+        try:
+            result = await getattr(self._rpc, method)(*args)
+        except Fault as f:
+            logger.error('Fault in %s to slave %s: %s'
+                    % (description, self.id, f.faultString))
+            return False, None
+        except ProtocolError as e:
+            logger.error('Protocol error in %s to slave %s: %s'
+                    % (description, self.id, e.errmsg))
+            return False, None
+        except http.ConnectionFailed:
+            logger.error('Connection failed in %s to slave %s'
+                    % (description, self.id))
+            return False, None
+        return True, result
+
+    async def send_assignment(self):
+        rpc_args = self._rpc_args
+        self._rpc_func = None
+        self._rpc_args = None
+        if not self.alive():
+            logger.warning('Canceling RPC call because slave %s is no'
+                    ' longer alive.' % self.id)
+            return
+
+        logger.debug('Sending assignment to slave %s: %s, %s'
+                % (self.id, rpc_args[2], rpc_args[3]))
+        success, result = await self._call('RPC', 'start_task', *rpc_args)
+        if success and result:
+            self.update_timestamp()
+        else:
+            logger.info('Failed to assign a task to slave %s.' % self.id)
+            self.critical_failure()
+
+    async def remove(self, dataset_id, source, delete):
+        if self._state not in ('alive', 'exiting'):
+            # Note: the master may disconnect the slave while remove
+            # requests are still pending--this isn't really a bad thing.
+            return
+
+        logger.debug('Sending remove request to slave %s: %s, %s'
+                % (self.id, dataset_id, source))
+        success, _ = await self._call('remove call', 'remove', dataset_id,
+                source, delete, self.cookie)
+        if success:
+            self.update_timestamp()
+        else:
+            logger.info('Failed to remove data on slave %s.' % self.id)
+            self.critical_failure()
+
+    async def discard(self, dataset_id):
+        if self._state != 'alive':
+            return
+
+        logger.debug('Sending discard request to slave %s: %s'
+                % (self.id, dataset_id))
+        success, _ = await self._call('discard call', 'discard', dataset_id,
+                self.cookie)
+        if success:
+            self.update_timestamp()
+        else:
+            logger.info('Failed to discard cached data on slave %s.'
+                    % self.id)
+            self.critical_failure()
+
+    async def check(self):
+        """Runs `RemoteSlave.check` on the event loop."""
+        master.RemoteSlave.check(self)
+
+    def disconnect(self, write_pipe=None):
+        """Marks the slave as exiting (see `AsyncSlaves.disconnect_all`)."""
+        if self._state not in ('exiting', 'exited'):
+            self._state = 'exiting'
+            if self._check_timer is not None:
+                self._check_timer.cancel()
+
+    async def send_exit(self, write_pipe=None):
+        logger.debug('Sending a exit request to slave %s' % self.id)
+        await self._call('exit', 'exit', self.cookie)
+        self._state = 'exited'
+        self._rpc.close()
+        self._rpc = None
+
+
+class AsyncSlaves(master.Slaves):
+    """List of AsyncRemoteSlaves.
+
+    Instead of writing to a pipe, `trigger_sched` arranges for the schedule
+    function to be called once by the event loop.
+    """
+    slave_class = AsyncRemoteSlave
+
+    def __init__(self, event_loop, schedule, chore_queue, rpc_timeout,
+            pingdelay, phi_threshold):
+        super(AsyncSlaves, self).__init__(None, chore_queue, rpc_timeout,
+                pingdelay, phi_threshold)
+        self._event_loop = event_loop
+        self._schedule = schedule
+        self._sched_pending = False
+
+    def trigger_sched(self):
+        if not self._sched_pending:
+            self._sched_pending = True
+            self._event_loop.call_soon(self._run_schedule)
+
+    def _run_schedule(self):
+        self._sched_pending = False
+        self._schedule()
+
+    async def disconnect_all(self):
+        """Sends an exit request to the slaves and waits for completion."""
+        self._accepting_new_slaves = False
+        exits = []
+        for slave in self._slaves.values():
+            if not slave.exited():
+                slave.disconnect()
+                exits.append(slave.send_exit())
+        await asyncio.gather(*exits)
+
+# vim: et sw=4 sts=4
@@ -15,7 +15,9 @@
 
 from __future__ import division, print_function
 
+import collections
 import os
+import sys
 
 from . import fileformats
 from . import util
@@ -34,23 +36,108 @@ try:
 except ImportError:
     from io import BytesIO
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+# Pickled buckets with at least this many bytes of encoded data pass them
+# through a shared memory segment (if supported) rather than the pickle.
+SHARED_MEMORY_MIN_BYTES = 1 << 20
+
+# Number of pairs sampled to estimate the size of a cached bucket.
+CACHE_SAMPLE_PAIRS = 100
+
+
+def approximate_size(kvpair):
+    """Estimate the number of bytes of RAM used by a key-value pair.
+
+    Only the pair and its immediate key and value are counted, so the
+    estimate is low for containers, but it is cheap to compute.
+    """
+    key, value = kvpair
+    return sys.getsizeof(kvpair) + sys.getsizeof(key) + sys.getsizeof(value)
+
 
 class ReadBucket(object):
     """Hold data from a source.
 
+    When a bucket is pickled (to be sent to another process), its in-memory
+    data are not decoded until they are used.  If the data are also in a
+    local file in a lossless format, only the url is sent, and the data are
+    read from the file when needed.  Otherwise, the data are sent encoded,
+    and large data are placed in a shared memory segment that is referenced
+    by name (the receiving process unlinks it, and any segments that are
+    never received are unlinked by `unlink_shared_memory`).
+
     Attributes:
         source: An integer showing which source the data come from.
         split: An integer showing which split the data is directed to.
         serializers: A Serializers instance: functions for serializing and
             deserializing between Python objects and bytes.
         url: A string showing a URL that can be used to read the data.
+        spilled: True if the data were too big to keep in RAM and must be
+            read from the url.
     """
     def __init__(self, source, split, serializers=None):
-        self._data = []
+        self._pairs = []
+        self._lazy_url = False
+        self._lazy_bytes = None
+        self._lazy_shm = None
+        self._lazy_len = 0
         self.source = source
         self.split = split
         self.serializers = serializers
         self.url = None
+        self.spilled = False
+
+    @property
+    def _data(self):
+        """The list of key-value pairs (loaded on first use if lazy)."""
+        if self._is_lazy():
+            self._materialize()
+        return self._pairs
+
+    @_data.setter
+    def _data(self, data):
+        self._lazy_url = False
+        self._lazy_bytes = None
+        self._lazy_shm = None
+        self._pairs = data
+
+    def _is_lazy(self):
+        return (self._lazy_url or self._lazy_bytes is not None or
+                self._lazy_shm is not None)
+
+    def _materialize(self):
+        """Loads data that were left encoded or in a file when unpickled."""
+        if self._lazy_url:
+            reader = fileformats.open_url(self.url,
+                    serializers=self.serializers)
+        else:
+            if self._lazy_shm is not None:
+                encoded = _read_shared_memory(*self._lazy_shm)
+            else:
+                encoded = self._lazy_bytes
+            reader = fileformats.BinReader(BytesIO(encoded), self.serializers)
+        pairs = []
+        with reader:
+            for batch in reader.iter_batches():
+                pairs.extend(batch)
+        self._data = pairs
+
+    def _lossless_url(self):
+        """Reports whether the url is a local file that holds all the data."""
+        if not self.url or self.spilled:
+            return False
+        if urlparse(self.url).scheme not in ('', 'file'):
+            return False
+        reader_cls = fileformats.fileformat(self.url)
+        return issubclass(reader_cls, fileformats.lossless_readers)
+
+    def _in_memory(self):
+        """Reports whether to read the data from RAM rather than the url."""
+        return not self._lazy_url and bool(self._data)
 
     def addpair(self, kvpair):
         """Collect a single key-value pair."""
@@ -63,8 +150,11 @@ class ReadBucket(object):
         the iterator blocks.
         """
         data = self._data
-        for kvpair in pairiter:
-            data.append(kvpair)
+        if isinstance(pairiter, fileformats.Reader):
+            for batch in pairiter.iter_batches():
+                data.extend(batch)
+        else:
+            data.extend(pairiter)
 
     def sort(self):
         self._data.sort()
@@ -74,35 +164,54 @@ class ReadBucket(object):
         self._data = None
 
     def __getstate__(self):
-        """Pickle (serialize) the bucket."""
+        """Pickle (serialize) the bucket, leaving the data to be loaded lazily.
+        """
+        if self._lazy_shm is not None:
+            # The segment belongs to this process, so it cannot be passed on.
+            self._materialize()
         state = self.__dict__.copy()
-        if self._data:
-            buf = BytesIO()
-            with fileformats.BinWriter(buf, self.serializers) as writer:
-                for pair in self._data:
-                    writer.writepair(pair)
-            state['_data'] = buf.getvalue()
-            buf.close()
-        else:
-            state['_data'] = ''
+        if self._is_lazy():
+            # Still lazy from a previous unpickling.
+            return state
+
+        pairs = self._pairs
+        state['_pairs'] = []
+        if pairs:
+            state['_lazy_len'] = len(pairs)
+            if self._lossless_url():
+                state['_lazy_url'] = True
+            else:
+                buf = ChunkBuffer()
+                with fileformats.BinWriter(buf, self.serializers) as writer:
+                    for batch in fileformats.batches(pairs):
+                        writer.writebatch(batch)
+                size = buf.size
+                if shared_memory is not None and (size >=
+                        SHARED_MEMORY_MIN_BYTES):
+                    state['_lazy_shm'] = (_write_shared_memory(buf), size)
+                else:
+                    state['_lazy_bytes'] = buf.getvalue()
+        elif pairs is None:
+            state['_pairs'] = None
         return state
 
     def __setstate__(self, state):
-        """Unpickle (deserialize) the bucket."""
+        """Unpickle (deserialize) the bucket.
+
+        A shared memory segment is attached and unlinked right away, so it
+        is freed when this bucket is done with it (or garbage collected).
+        """
         self.__dict__ = state
-        if self._data == '':
-            self._data = []
-        else:
-            # TODO: Python 3 supports using context managers with BytesIO
-            #with io.BytesIO(self._data) as buf:
-            buf = BytesIO(self._data)
-            self._data = []
-            reader = fileformats.BinReader(buf, self.serializers)
-            self.collect(reader)
-            buf.close()
+        if self._lazy_shm is not None:
+            name, size = self._lazy_shm
+            segment = shared_memory.SharedMemory(name)
+            segment.unlink()
+            self._lazy_shm = (segment, size)
 
     def __len__(self):
-        return len(self._data)
+        if self._is_lazy():
+            return self._lazy_len
+        return len(self._pairs)
 
     def __getitem__(self, item):
         """Get a particular item, mainly for debugging purposes"""
@@ -113,7 +222,7 @@ class ReadBucket(object):
 
         Use the given serializers, defaulting to self.serializers.
         """
-        if self._data:
+        if self._in_memory():
             return iter(self)
         else:
             if serializers is None:
@@ -126,11 +235,129 @@ class ReadBucket(object):
             for kvpair in reader:
                 yield kvpair
 
+    def stream_batches(self, serializers=None):
+        """Stream over lists of kvpairs (see `stream`)."""
+        if self._in_memory():
+            return fileformats.batches(self._data)
+        else:
+            if serializers is None:
+                serializers = self.serializers
+            return self._stream_batches(serializers)
+
+    def _stream_batches(self, serializers):
+        with fileformats.open_url(self.url, serializers=serializers) as reader:
+            for batch in reader.iter_batches():
+                yield batch
+
+    def stream_arrays(self, serializers=None):
+        """Stream over (keys, values) arrays (see `Reader.iter_arrays`)."""
+        if self._in_memory():
+            return (fileformats.pairs_to_arrays(batch) for batch in
+                    fileformats.batches(self._data,
+                        fileformats.VECTOR_BATCH_SIZE))
+        else:
+            if serializers is None:
+                serializers = self.serializers
+            return self._stream_arrays(serializers)
+
+    def _stream_arrays(self, serializers):
+        with fileformats.open_url(self.url, serializers=serializers) as reader:
+            for keys, values in reader.iter_arrays():
+                yield keys, values
+
     def __iter__(self):
         """Iterate over all already-loaded data."""
         return iter(self._data)
 
 
+class ChunkBuffer(object):
+    """A write-only file-like object that keeps each write as a chunk.
+
+    Unlike a BytesIO, the total size is known without a copy, and the chunks
+    can be moved elsewhere (and released) one at a time.
+    """
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+# Names of the shared memory segments created by this process.  Each is
+# unlinked by the process that receives it, so the set only matters for
+# segments that are never received (see `unlink_shared_memory`).
+_created_segments = set()
+
+
+def _write_shared_memory(buf):
+    """Moves the contents of a ChunkBuffer to a new shared memory segment.
+
+    Each chunk is released once it is copied, so the data are not held twice.
+    Returns the name of the segment.  The segment is not tracked by the
+    resource tracker, since the receiving process unlinks it.
+    """
+    segment = shared_memory.SharedMemory(create=True, size=max(buf.size, 1))
+    offset = 0
+    chunks = buf.chunks
+    while chunks:
+        chunk = chunks.popleft()
+        segment.buf[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    name = segment.name
+    segment.close()
+    _untrack_shared_memory(segment)
+    _created_segments.add(name)
+    return name
+
+
+def unlink_shared_memory():
+    """Unlinks segments created by this process that were never received.
+
+    A pickled bucket's segment leaks if the message is lost (e.g., if the
+    receiving process dies), so this is called as each job or runner
+    process exits.
+    """
+    while _created_segments:
+        name = _created_segments.pop()
+        try:
+            segment = shared_memory.SharedMemory(name)
+        except OSError:
+            # Already received and unlinked.
+            continue
+        logger.debug('Unlinking unreceived shared memory segment %s.' % name)
+        segment.close()
+        segment.unlink()
+
+
+def _untrack_shared_memory(segment):
+    """Keeps the resource tracker from unlinking a segment at exit."""
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    except (ImportError, AttributeError):
+        pass
+
+
+def _read_shared_memory(segment, size):
+    """Returns the contents of an attached segment and then closes it."""
+    view = segment.buf[:size]
+    data = bytes(view)
+    view.release()
+    segment.close()
+    return data
+
+
 class WriteBucket(ReadBucket):
     """Hold data for a split.
 
@@ -146,17 +373,26 @@ class WriteBucket(ReadBucket):
         dir: A string specifying the directory for writes.
         format: The class to be used for formatting writes.
         path: The local path of the written file.
+        spill_dir: A directory for writes once the data no longer fit in RAM
+            (only used if dir is not set).
+        max_ram_bytes: If set, the approximate number of bytes of data to
+            keep in RAM before spilling.  After spilling, pairs are only
+            written to disk.
     """
-    def __init__(self, source, split, dir=None, format=None, **kwds):
+    def __init__(self, source, split, dir=None, format=None, spill_dir=None,
+            max_ram_bytes=None, **kwds):
         super(WriteBucket, self).__init__(source, split, **kwds)
         self.dir = dir
         if format is None:
             format = fileformats.default_write_format
         self.format = format
+        self.spill_dir = spill_dir
+        self.max_ram_bytes = max_ram_bytes
 
         self._filename = None
         self._output_file = None
         self._writer = None
+        self._ram_bytes = 0
 
     def __setstate__(self, state):
         raise NotImplementedError
@@ -165,6 +401,7 @@ class WriteBucket(ReadBucket):
         b = ReadBucket(self.source, self.split, self.serializers)
         b._data = self._data
         b.url = self._filename
+        b.spilled = self.spilled
         return b
 
     def open_writer(self):
@@ -198,12 +435,48 @@ class WriteBucket(ReadBucket):
 
     def addpair(self, kvpair, write_only=False, serialized_key=None):
         """Collect a single key-value pair."""
-        if not write_only:
-            self._data.append(kvpair)
         if self.dir:
             if not self._writer:
                 self.open_writer()
             self._writer.writepair(kvpair, serialized_key=serialized_key)
+        if not write_only and not self.spilled:
+            self._pairs.append(kvpair)
+            if self.max_ram_bytes is not None:
+                self._ram_bytes += approximate_size(kvpair)
+                if self._ram_bytes > self.max_ram_bytes:
+                    self.spill()
+
+    def addbatch(self, kvpairs, write_only=False, serialized_keys=None):
+        """Collect a list of key-value pairs.
+
+        If given, `serialized_keys` is a list of the already serialized keys.
+        """
+        if self.max_ram_bytes is not None and not write_only:
+            if serialized_keys is None:
+                serialized_keys = [None] * len(kvpairs)
+            for kvpair, serialized_key in zip(kvpairs, serialized_keys):
+                self.addpair(kvpair, serialized_key=serialized_key)
+            return
+
+        if self.dir:
+            if not self._writer:
+                self.open_writer()
+            self._writer.writebatch(kvpairs, serialized_keys)
+        if not write_only:
+            self._pairs.extend(kvpairs)
+
+    def addarrays(self, keys, values, write_only=False):
+        """Collect key-value pairs given as an array of keys and of values."""
+        if self.max_ram_bytes is not None and not write_only:
+            self.addbatch(fileformats.arrays_to_pairs(keys, values))
+            return
+
+        if self.dir:
+            if not self._writer:
+                self.open_writer()
+            self._writer.writearrays(keys, values)
+        if not write_only:
+            self._pairs.extend(fileformats.arrays_to_pairs(keys, values))
 
     def collect(self, pairiter, write_only=False):
         """Collect all key-value pairs from the given iterable
@@ -211,7 +484,17 @@ class WriteBucket(ReadBucket):
         The collection can be a generator or a Mrs format.  This will block if
         the iterator blocks.
         """
-        data = self._data
+        if isinstance(pairiter, fileformats.Reader):
+            for batch in pairiter.iter_batches():
+                self.addbatch(batch, write_only)
+            return
+
+        if self.max_ram_bytes is not None and not write_only:
+            for kvpair in pairiter:
+                self.addpair(kvpair)
+            return
+
+        data = self._pairs
         if self.dir:
             if not self._writer:
                 self.open_writer()
@@ -225,6 +508,25 @@ class WriteBucket(ReadBucket):
         elif not write_only:
             data.extend(pairiter)
 
+    def spill(self):
+        """Stop keeping data in RAM, writing any unsaved data to disk.
+
+        If there is neither a dir nor a spill_dir, the data stay in RAM.
+        """
+        if not self.dir:
+            if not self.spill_dir:
+                self.max_ram_bytes = None
+                return
+            util.try_makedirs(self.spill_dir)
+            self.dir = self.spill_dir
+            self.open_writer()
+            for kvpair in self._data:
+                self._writer.writepair(kvpair)
+        logger.debug('Spilled bucket (%s, %s) with %s pairs to disk'
+                % (self.source, self.split, len(self._data)))
+        self._data = []
+        self.spilled = True
+
     def prefix(self):
         """Return the filename for the output split for the given index.
         """
@@ -238,6 +540,107 @@ class WriteBucket(ReadBucket):
             os.remove(self._filename)
 
 
+class BucketCache(object):
+    """A least-recently-used cache of the contents of input buckets.
+
+    Entries are keyed by dataset id and url, and each holds the list of
+    key-value pairs read from the url.  A worker keeps one cache across
+    tasks, so loop-invariant input (a dataset created with `cache=True`) is
+    only read from the network once.  When the estimated size of all entries
+    exceeds `max_bytes`, the least recently used entries are evicted.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._oversized = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, dataset_id, url):
+        """Returns the cached pairs for the url (or None if not cached)."""
+        key = (dataset_id, url)
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, dataset_id, url, pairs):
+        """Adds pairs to the cache, evicting old entries as needed.
+
+        Returns False if the pairs are too big to be cached at all.
+        """
+        size = _estimate_size(pairs)
+        if size > self.max_bytes:
+            return False
+        self.discard(dataset_id, url)
+        self._entries[dataset_id, url] = (pairs, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+        return True
+
+    def discard(self, dataset_id, url=None):
+        """Removes the entry for the url (or all entries for the dataset)."""
+        if url is None:
+            self._oversized = set(key for key in self._oversized
+                    if key[0] != dataset_id)
+            keys = [key for key in self._entries if key[0] == dataset_id]
+        else:
+            keys = [(dataset_id, url)]
+        for key in keys:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def load(self, bucket, dataset_id):
+        """Fills the bucket with the contents of its url (cached if possible).
+
+        The url is read in batches, and if the data turn out to be too big
+        for the cache, reading stops and the bucket is left unloaded (to be
+        streamed from the url).  Returns True if the bucket was loaded.
+        """
+        key = (dataset_id, bucket.url)
+        pairs = self.get(dataset_id, bucket.url)
+        if pairs is None:
+            if key in self._oversized:
+                return False
+            pairs = []
+            size = 0
+            with fileformats.open_url(bucket.url,
+                    serializers=bucket.serializers) as reader:
+                for batch in reader.iter_batches():
+                    size += _estimate_size(batch)
+                    if size > self.max_bytes:
+                        logger.debug('Bucket %s is too big for the cache.'
+                                % bucket.url)
+                        self._oversized.add(key)
+                        return False
+                    pairs.extend(batch)
+            if not self.put(dataset_id, bucket.url, pairs):
+                self._oversized.add(key)
+                return False
+        bucket._data = pairs
+        return True
+
+
+def _estimate_size(pairs):
+    """Estimates the RAM used by a list of pairs from a sample of them."""
+    n = len(pairs)
+    if not n:
+        return sys.getsizeof(pairs)
+    sample = pairs[::max(n // CACHE_SAMPLE_PAIRS, 1)]
+    sample_size = sum(approximate_size(kvpair) for kvpair in sample)
+    return sys.getsizeof(pairs) + sample_size * n // len(sample)
+
+
 class URLConverter(object):
     def __init__(self, addr, port, basedir):
         assert port is not None
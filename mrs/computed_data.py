@@ -13,14 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
-# TODO: add a Dataset for resplitting input (right now we assume that input
-# files are pre-split).
-
 import os
 
 from . import datasets
 from .tasks import Task
+from . import util
 
 
 class ComputedData(datasets.RemoteData):
@@ -58,6 +55,7 @@ class ComputedData(datasets.RemoteData):
         self.id = '%s_%s' % (operation.id, self.id)
 
         self._computing = True
+        self._spill_dir = None
 
         assert not input.closed
         self.input_id = input.id
@@ -79,7 +77,15 @@ class ComputedData(datasets.RemoteData):
         """Signify that computation of the dataset is done."""
         self._computing = False
 
-    def run_serial(self, program, datasets):
+    def run_serial(self, program, datasets, spill_dir=None,
+            max_ram_size=None):
+        """Computes the dataset in a single task.
+
+        If a spill_dir is given, any output bucket bigger than max_ram_size
+        MB is written to a temporary file in a subdirectory of it instead of
+        being kept in RAM.  The subdirectory is created on the first spill.
+        Without a spill_dir, all of the output is kept in RAM.
+        """
         input_data = datasets[self.input_id]
         self.splits = 1
         if self.format is not None:
@@ -89,7 +95,10 @@ class ComputedData(datasets.RemoteData):
         task = Task.from_op(self.op, input_data, self.id, 0, self.splits,
                 self.dir, ext, self.serializers)
 
-        task.run(program, None, serial=True)
+        if spill_dir:
+            self._spill_dir = os.path.join(spill_dir, self.id)
+        task.run(program, self._spill_dir, serial=True,
+                max_sort_size=max_ram_size)
         self._use_output(task.output)
         task.output.close()
         self.computation_done()
@@ -109,8 +118,10 @@ class ComputedData(datasets.RemoteData):
             ext = self.format.ext
         else:
             ext = ''
-        return Task.from_op(self.op, input_data, self.id, task_index,
+        task = Task.from_op(self.op, input_data, self.id, task_index,
                 self.splits, self.dir, ext, self.serializers)
+        task.cache_output = self.cache
+        return task
 
     def fetchall(self, **kwds):
         assert not self.computing, (
@@ -119,9 +130,15 @@ class ComputedData(datasets.RemoteData):
 
     def _use_output(self, output):
         """Uses the contents of the given LocalData."""
-        self._data = output._data
+        for key, bucket in output._data.items():
+            self[key] = bucket
         self.splits = len(output._data)
-        self._fetched = True
+        self._fetched = not any(b.spilled for b in self[:, :])
+
+    def delete(self):
+        super(ComputedData, self).delete()
+        if self._spill_dir and os.path.exists(self._spill_dir):
+            util.remove_recursive(self._spill_dir)
 
     @property
     def computing(self):
@@ -13,10 +13,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-
-# TODO: add a Dataset for resplitting input (right now we assume that input
-# files are pre-split).
-
 import collections
 import heapq
 from itertools import chain
@@ -52,14 +48,20 @@ class BaseDataset(object):
             split from all sources, use splitdata()
         serializers: a Serializers instance that keeps track of serializers
             and their associated names.
+        cache: whether workers should keep the contents of buckets in their
+            bucket caches (for input that is read repeatedly)
+        fingerprint: digest of everything that determines the contents of
+            the dataset, if known (see `mrs.lineage`)
     """
     def __init__(self, splits=0, dir=None, format=None, permanent=True,
-            serializers=None):
+            serializers=None, cache=False):
         self.splits = splits
         self.dir = dir
         self.format = format
         self.permanent = permanent
         self.serializers = serializers
+        self.cache = cache
+        self.fingerprint = None
 
         self.id = util.random_string(DATASET_ID_LENGTH)
         self.closed = False
@@ -252,6 +254,13 @@ class LocalData(BaseDataset):
     Note that the `source`, which is just used for naming files, represents
     which output source is being created.
 
+    If `max_ram_bytes` is given, then any bucket that grows beyond it is
+    spilled to disk (to the `dir` or, if there is none, to the `spill_dir`).
+
+    If `vectorized` is True, then the iterator yields (keys, values) pairs of
+    arrays rather than key-value pairs, and a vectorized `parter` (see
+    `mrs.vectorized`) partitions a whole array of keys at a time.
+
     >>> lst = [(4, 'to_0'), (5, 'to_1'), (7, 'to_3'), (9, 'to_1')]
     >>> o = LocalData(lst, splits=4, parter=(lambda x, n: x%n))
     >>> list(o[0, 1])
@@ -261,7 +270,8 @@ class LocalData(BaseDataset):
     >>>
     """
     def __init__(self, itr, splits=None, source=0, parter=None,
-            write_only=False, **kwds):
+            write_only=False, spill_dir=None, max_ram_bytes=None,
+            vectorized=False, **kwds):
         if parter is not None and splits is None:
             raise RuntimeError('The splits parameter is required when parter'
                     ' is specified.')
@@ -269,9 +279,14 @@ class LocalData(BaseDataset):
         super(LocalData, self).__init__(splits=splits, **kwds)
         self.id = 'local_' + self.id
         self.fixed_source = source
+        self.spill_dir = spill_dir
+        self.max_ram_bytes = max_ram_bytes
 
         self.collected = False
-        self._collect(itr, parter, write_only)
+        if vectorized:
+            self._collect_arrays(itr, parter, write_only)
+        else:
+            self._collect(itr, parter, write_only)
         for key, bucket in self._data.items():
             self._data[key] = bucket.readonly_copy()
         self.collected = True
@@ -280,6 +295,7 @@ class LocalData(BaseDataset):
         assert not self.collected
         assert source == self.fixed_source
         return bucket.WriteBucket(source, split, self.dir, self.format,
+                spill_dir=self.spill_dir, max_ram_bytes=self.max_ram_bytes,
                 serializers=self.serializers)
 
     def _collect(self, itr, parter, write_only):
@@ -303,20 +319,73 @@ class LocalData(BaseDataset):
                 bucket = self[source, 0]
                 bucket.collect(itr, write_only)
             else:
-                dumps_key, _ = dumps_functions(self.serializers)
-                for kvpair in itr:
-                    key, value = kvpair
-                    if dumps_key is None:
-                        serialized_key = key
-                    else:
-                        serialized_key = dumps_key(key)
-                    split = parter(key, serialized_key, n)
-                    bucket = self[source, split]
-                    bucket.addpair(kvpair, write_only,
-                            serialized_key=serialized_key)
+                self._partition(itr, parter, write_only)
         for bucket in self[:, :]:
             bucket.close_writer(self.permanent)
 
+    def _collect_arrays(self, itr, parter, write_only):
+        """Collect all of the (keys, values) arrays from the given iterator."""
+        n = self.splits
+        source = self.fixed_source
+        if not (n == 1 or getattr(parter, 'vectorized', False)):
+            pairs = chain.from_iterable(fileformats.arrays_to_pairs(keys,
+                values) for keys, values in itr)
+            return self._collect(pairs, parter, write_only)
+
+        for keys, values in itr:
+            if n == 1:
+                self[source, 0].addarrays(keys, values, write_only)
+                continue
+            split_indices = parter(keys, n)
+            for split, split_keys, split_values in _split_arrays(keys,
+                    values, split_indices):
+                bucket = self[source, split]
+                bucket.addarrays(split_keys, split_values, write_only)
+        for bucket in self[:, :]:
+            bucket.close_writer(self.permanent)
+
+    def _partition(self, itr, parter, write_only):
+        """Partitions key-value pairs into buckets, a batch at a time."""
+        n = self.splits
+        source = self.fixed_source
+        dumps_key, _ = dumps_functions(self.serializers)
+        for batch in fileformats.batches(itr):
+            keys = [key for key, _ in batch]
+            if dumps_key is None:
+                serialized_keys = keys
+            else:
+                serialized_keys = list(map(dumps_key, keys))
+
+            split_pairs = collections.defaultdict(list)
+            split_keys = collections.defaultdict(list)
+            for kvpair, key, serialized_key in zip(batch, keys,
+                    serialized_keys):
+                split = parter(key, serialized_key, n)
+                split_pairs[split].append(kvpair)
+                split_keys[split].append(serialized_key)
+
+            for split, kvpairs in split_pairs.items():
+                bucket = self[source, split]
+                bucket.addbatch(kvpairs, write_only, split_keys[split])
+
+
+def _split_arrays(keys, values, split_indices):
+    """Yields (split, keys, values) for each split in split_indices."""
+    if hasattr(keys, 'dtype') and hasattr(values, 'dtype'):
+        import numpy
+        split_indices = numpy.asarray(split_indices)
+        for split in numpy.unique(split_indices):
+            mask = (split_indices == split)
+            yield int(split), keys[mask], values[mask]
+    else:
+        split_keys = collections.defaultdict(list)
+        split_values = collections.defaultdict(list)
+        for key, value, split in zip(keys, values, split_indices):
+            split_keys[split].append(key)
+            split_values[split].append(value)
+        for split, lst in split_keys.items():
+            yield split, lst, split_values[split]
+
 
 class RemoteData(BaseDataset):
     """A Dataset whose contents can be downloaded and read.
@@ -395,6 +464,18 @@ class RemoteData(BaseDataset):
         random.shuffle(buckets)
         return self._stream_buckets(buckets, serializers)
 
+    def stream_split_batches(self, split, serializers=None,
+            _called_in_runner=False):
+        """Iterate over lists of key-value pairs for a given split."""
+        self._assert_open(_called_in_runner)
+        if self._fetched:
+            buckets = self[:, split]
+        else:
+            buckets = [bucket for bucket in self[:, split] if bucket.url]
+            random.shuffle(buckets)
+        streams = (b.stream_batches(serializers) for b in buckets)
+        return chain.from_iterable(streams)
+
     def notify_urls_known(self):
         """Signify that all buckets have been assigned urls."""
         self._urls_known = True
@@ -407,6 +488,11 @@ class MergeSortData(BaseDataset):
     it will be stored in local temporary files.
 
     Note that this class is very specific in its purpose and applicability.
+
+    When the input fits in RAM, the sorted records are kept in a single list
+    and are deserialized on the fly as they are streamed, without first being
+    copied into a bucket.  The `in_memory` attribute reports which of the two
+    paths was taken.
     """
     def __init__(self, input, input_split, max_sort_size, splits=None,
             source=None, parter=None, _called_in_runner=False, **kwds):
@@ -422,6 +508,9 @@ class MergeSortData(BaseDataset):
         self.fixed_split = input_split
         self.serializers = input.serializers
         self.permanent = False
+        self.in_memory = False
+        self._sorted_list = None
+        self._loads = None
 
         self.collected = False
         self._collect(input, input_split, max_sort_size, _called_in_runner)
@@ -437,37 +526,37 @@ class MergeSortData(BaseDataset):
         current_bytes = 0
         total_bytes = 0
         data_list = []
-        for raw_key, raw_value in input.stream_split(input_split,
+        for batch in input.stream_split_batches(input_split,
                 serializers=raw_serializers,
                 _called_in_runner=_called_in_runner):
-            pair_bytes = len(raw_key) + len(raw_value)
-            if current_bytes + pair_bytes > max_ram_bytes:
+            batch_bytes = sum(len(raw_key) + len(raw_value)
+                    for raw_key, raw_value in batch)
+            if data_list and current_bytes + batch_bytes > max_ram_bytes:
                 data_list.sort(key=itemgetter(0))
                 self._flush_data(data_list, raw_serializers, input.serializers)
                 data_list = []
                 current_bytes = 0
 
             if loads_key is None:
-                data_list.append((raw_key, raw_value))
+                data_list.extend(batch)
             else:
-                key = loads_key(raw_key)
-                data_list.append((key, raw_key, raw_value))
-            current_bytes += pair_bytes
-            total_bytes += pair_bytes
+                data_list.extend((loads_key(raw_key), raw_key, raw_value)
+                        for raw_key, raw_value in batch)
+            current_bytes += batch_bytes
+            total_bytes += batch_bytes
 
+        data_list.sort(key=itemgetter(0))
         if self._data:
-            data_list.sort(key=itemgetter(0))
             self._flush_data(data_list, raw_serializers, input.serializers)
+            logger.debug('MergeSortData initialized %s bytes in %s buckets'
+                    % (total_bytes, len(self._data)))
         else:
-            data_list.sort(key=itemgetter(0))
-            b = bucket.WriteBucket(0, self.fixed_split)
-            data_itr = self._iter_deserialized(data_list, loads_key,
-                    loads_value)
-            b.collect(data_itr)
-            self._append_bucket(b)
-
-        logger.debug('MergeSortData initialized %s bytes in %s buckets'
-                % (total_bytes, len(self._data)))
+            # Everything fit in RAM: keep the sorted list and deserialize
+            # values as they are streamed instead of copying into a bucket.
+            self.in_memory = True
+            self._sorted_list = data_list
+            self._loads = (loads_key, loads_value)
+            logger.debug('MergeSortData sorted %s bytes in RAM' % total_bytes)
 
     def _iter_deserialized(self, data_list, loads_key, loads_value):
         """Iterate over the deserialized key-value pairs of the data list."""
@@ -504,8 +593,16 @@ class MergeSortData(BaseDataset):
         b = b.readonly_copy()
         self._data[b.source, b.split] = b
 
+    def clear(self):
+        super(MergeSortData, self).clear()
+        self._sorted_list = None
+
     def stream_data(self, serializers=None, _called_in_runner=False):
         """Iterate over data from all buckets in key-sorted order."""
+        if self.in_memory:
+            loads_key, loads_value = self._loads
+            return self._iter_deserialized(self._sorted_list, loads_key,
+                    loads_value)
         streams = [b.stream(serializers) for b in self[:, :]]
         return heapq.merge(*streams)
 
@@ -515,7 +612,16 @@ class FileData(RemoteData):
 
     By default, all of the files come from a single source, with one split for
     each file.  If a split is given, then the dataset will have enough sources
-    to evenly divide the files.
+    to evenly divide the files.  If `split_size` is given, then line-based
+    files larger than `split_size` bytes are first divided into byte ranges
+    of about that size (see `fileformats.split_url`).  If `combine_to` is
+    given, then small files are packed together so that each split holds
+    about `combine_to` bytes (see `fileformats.combine_urls`); the files in
+    a split each come from a different source and are read in sequence.
+    Since this determines the sources and splits, `combine_to` cannot be
+    given with `sources` or `splits`.
+    The optional `sizes` dict gives the already known sizes of some of the
+    urls, which saves looking them up again.
 
     >>> urls = ['http://aml.cs.byu.edu/', 'LICENSE']
     >>> data = FileData(urls)
@@ -532,7 +638,27 @@ class FileData(RemoteData):
     >>>
     """
     def __init__(self, urls, sources=None, splits=None,
-            first_source=0, first_split=0, **kwds):
+            first_source=0, first_split=0, split_size=None, combine_to=None,
+            sizes=None, **kwds):
+        if sizes is None:
+            sizes = {}
+        if split_size:
+            urls = [range_url for url in urls
+                    for range_url in fileformats.split_url(url, split_size,
+                        sizes.get(url))]
+        if combine_to:
+            if sources is not None or splits is not None:
+                raise RuntimeError('The sources and splits parameters must'
+                        ' not be specified with combine_to')
+            groups = fileformats.combine_urls(urls, combine_to, sizes)
+            super(FileData, self).__init__(splits=first_split + len(groups),
+                    **kwds)
+            for split, group in enumerate(groups, first_split):
+                for source, url in enumerate(group, first_source):
+                    self[source, split].url = url
+            self._urls_known = True
+            return
+
         n = len(urls)
 
         if splits is None:
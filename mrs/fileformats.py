@@ -15,28 +15,42 @@
 
 from __future__ import division, print_function
 
+import array
+from binascii import unhexlify
 import codecs
 import gzip
-from itertools import islice
+from io import BytesIO, StringIO
+from itertools import chain, islice
 import os
+import re
 import struct
 import sys
 
 PY3 = sys.version_info[0] == 3
 if PY3:
     from urllib.parse import urlparse
-    from urllib.request import urlopen, URLopener
+    from urllib.request import urlopen, Request, URLopener
     import io
 else:
+    from itertools import imap as map, izip as zip
     from urlparse import urlparse
     from urllib import URLopener
-    from urllib2 import urlopen
+    from urllib2 import urlopen, Request
 
 from . import hdfs
-from .serializers import dumps_functions, loads_functions
+from .serializers import (dumps_functions, loads_functions, StructSerializer,
+        auto_dumps, auto_dumps_batch, auto_loads, auto_decoders)
 
 
 DEFAULT_BUFFER_SIZE = 4096
+# Readers return pairs in batches of this size by default.
+DEFAULT_BATCH_SIZE = 1024
+# Readers return arrays of (at most) this many pairs by default.
+VECTOR_BATCH_SIZE = 1 << 16
+# BinReader reads this many bytes at a time.
+BIN_READ_SIZE = 1 << 16
+# Line-based readers read this many bytes at a time.
+LINE_BLOCK_SIZE = 1 << 20
 # 1 is fast and unaggressive, 9 is slow and aggressive
 COMPRESS_LEVEL = 9
 
@@ -44,6 +58,28 @@ hex_encoder = codecs.getencoder('hex_codec')
 hex_decoder = codecs.getdecoder('hex_codec')
 
 len_struct = struct.Struct('<I')
+flags_struct = struct.Struct('<B')
+
+# BinWriter chooses type tags from this many records.
+AUTO_SAMPLE_RECORDS = 128
+# In a typed BinWriter file, this bit of a length field marks a key or value
+# written with its tag, and NO_TAG in the header means there is no tag.
+ESCAPE_BIT = 1 << 31
+LENGTH_MASK = ESCAPE_BIT - 1
+NO_TAG = b'\x00'
+
+# StructWriter groups this many records into each block.
+STRUCT_BLOCK_RECORDS = 4096
+STRUCT_KEY_PRIMITIVE = 1
+STRUCT_VALUE_PRIMITIVE = 2
+struct_item_re = re.compile(r'(\d*)([xcbB?hHiIlLqQnNefdspP])')
+numpy_kinds = {'c': 'S1', '?': '?', 'b': 'i', 'h': 'i', 'i': 'i', 'l': 'i',
+        'q': 'i', 'B': 'u', 'H': 'u', 'I': 'u', 'L': 'u', 'Q': 'u',
+        'e': 'f', 'f': 'f', 'd': 'f'}
+
+# A url fragment of the form "#bytes=START-END" selects the lines that begin
+# within the given byte range of a file ("#bytes=START-" reads to the end).
+byte_range_re = re.compile(r'^(.*)#bytes=(\d+)-(\d*)$')
 
 
 class Writer(object):
@@ -57,7 +93,8 @@ class Writer(object):
         fileobj: A file or filelike object.
         serializers: A Serializers instance (such as a namedtuple) for
             serializing from Python objects to bytes.  If a serializer is None,
-            use pickle.  Otherwise, use the serializer's `dumps` function.  A
+            use the auto serializer (see `serializers.auto_dumps`).
+            Otherwise, use the serializer's `dumps` function.  A
             `dumps` function set to None indicates that the keys are already
             bytes.
     """
@@ -68,6 +105,26 @@ class Writer(object):
     def writepair(self, kvpair, **kwds):
         raise NotImplementedError
 
+    def writebatch(self, kvpairs, serialized_keys=None):
+        """Write a list of key-value pairs.
+
+        If given, `serialized_keys` is a list of the already serialized keys.
+        Inheriting classes may override this with a faster bulk write.
+        """
+        if serialized_keys is None:
+            for kvpair in kvpairs:
+                self.writepair(kvpair)
+        else:
+            for kvpair, serialized_key in zip(kvpairs, serialized_keys):
+                self.writepair(kvpair, serialized_key=serialized_key)
+
+    def writearrays(self, keys, values):
+        """Write key-value pairs given as an array of keys and of values.
+
+        Inheriting classes may override this with a faster bulk write.
+        """
+        self.writebatch(arrays_to_pairs(keys, values))
+
     def finish(self):
         """Flush the file object, which may be a buffering wrapper."""
         self.fileobj.flush()
@@ -91,8 +148,9 @@ class Reader(object):
         fileobj: A file or filelike object.
         serializers: A Serializers instance (such as a namedtuple) for
             serializing from Python objects to bytes.  If a serializer is
-            None, use pickle.  Otherwise, use its `dumps` function.  A `dumps`
-            function set to None indicates that the keys are already bytes.
+            None, use the auto serializer.  Otherwise, use its `loads`
+            function.  A `loads` function set to None indicates that the keys
+            should be left as bytes.
     """
     def __init__(self, fileobj, serializers=None):
         self.fileobj = fileobj
@@ -101,6 +159,23 @@ class Reader(object):
     def __iter__(self, kvpair):
         raise NotImplementedError
 
+    def iter_batches(self, n=DEFAULT_BATCH_SIZE):
+        """Iterate over lists of (up to) n key-value pairs.
+
+        Reading in batches avoids a generator step for each pair.  Inheriting
+        classes may override this with a faster bulk read.
+        """
+        return batches(self, n)
+
+    def iter_arrays(self, n=VECTOR_BATCH_SIZE):
+        """Iterate over (keys, values) arrays of (up to) n pairs each.
+
+        The arrays are NumPy arrays if NumPy is installed and are otherwise
+        lists.  Inheriting classes may override this with a faster bulk read.
+        """
+        for batch in self.iter_batches(n):
+            yield pairs_to_arrays(batch)
+
     def __enter__(self):
         return self
 
@@ -117,48 +192,153 @@ class LineReader(Reader):
     In this basic reader, the key-value pair is composed of a line number and
     line contents (as a string).  The input file is assumed to be encoded in
     UTF-8, and the error mode is 'replace' (invalid characters are replaced
-    with u'\ufffd').
+    with u'\ufffd').  Lines are split on '\n' only, and a '\r\n' line
+    ending is translated to '\n'.
+
+    The file is read in blocks of `block_size` bytes that are decoded all at
+    once, which is much faster than decoding line by line.  If lines are not
+    needed as strings, BytesLineReader avoids decoding entirely.
+
+    If `start` and `end` are given, the file object must be positioned at
+    byte `start - 1` (or at 0 if `start` is 0), and only lines that begin
+    within the byte range [start, end) are read (through the end of the file
+    if `end` is None).  In this case, the key is the byte offset of the line
+    rather than the line number.
     """
-    def __init__(self, fileobj, *args, **kwds):
-        if PY3:
-            fileobj = io.TextIOWrapper(fileobj, encoding='utf-8',
-                    errors='replace')
-        super(LineReader, self).__init__(fileobj, *args, **kwds)
+    def __init__(self, fileobj, serializers=None, start=None, end=None):
+        super(LineReader, self).__init__(fileobj, serializers)
+        self.start = start
+        self.end = end
+        self.block_size = LINE_BLOCK_SIZE
 
-    if PY3:
-        def __iter__(self):
-            """Iterate over key-value pairs.
+    def __iter__(self):
+        """Iterate over key-value pairs.
 
-            Inheriting classes will almost certainly override this method.
-            """
-            return enumerate(self.fileobj)
-    else:
-        def __iter__(self):
-            """Iterate over key-value pairs.
+        Inheriting classes will almost certainly override this method.
+        """
+        if self.start is None:
+            blocks = line_blocks(self.fileobj, self.block_size)
+            return enumerate(chain.from_iterable(map(decode_lines, blocks)))
+        else:
+            return self._iter_range()
 
-            Inheriting classes will almost certainly override this method.
-            """
-            for i, s in enumerate(self.fileobj):
-                yield i, s.decode('utf-8', 'replace')
+    def _iter_range(self):
+        blocks = ranged_line_blocks(self.fileobj, self.start, self.end,
+                self.block_size)
+        for offsets, lines in blocks:
+            text_lines = decode_lines(b''.join(lines))
+            for pair in zip(offsets, text_lines):
+                yield pair
 
 
 class BytesLineReader(Reader):
     """Reads key-value pairs from a file object.
 
     In this basic reader, the key-value pair is composed of a line number
-    and line contents (as a bytes object).
+    and line contents (as a bytes object).  The `start` and `end` arguments
+    are as in LineReader.
     """
+    def __init__(self, fileobj, serializers=None, start=None, end=None):
+        super(BytesLineReader, self).__init__(fileobj, serializers)
+        self.start = start
+        self.end = end
+        self.block_size = LINE_BLOCK_SIZE
+
     def __iter__(self):
         """Iterate over key-value pairs.
 
         Inheriting classes will almost certainly override this method.
         """
-        return enumerate(self.fileobj)
+        if self.start is None:
+            blocks = line_blocks(self.fileobj, self.block_size)
+            return enumerate(chain.from_iterable(map(BytesIO, blocks)))
+        else:
+            return self._iter_range()
+
+    def _iter_range(self):
+        blocks = ranged_line_blocks(self.fileobj, self.start, self.end,
+                self.block_size)
+        for offsets, lines in blocks:
+            for pair in zip(offsets, lines):
+                yield pair
+
+
+class TextReader(LineReader):
+    """Reads key-value pairs written by a TextWriter.
+
+    Each line is split at its first run of whitespace (spaces or tabs) into
+    a key and a value, which are returned as strings.  A line without any
+    whitespace gives an empty value.
+
+    TextReader is not registered for the 'mtxt' extension, so these files
+    are still read by LineReader as (line number, line) pairs unless a
+    program opts in, e.g., with `fileformats.reader_map['mtxt'] =
+    TextReader` at module level (so that it also takes effect in workers).
+    """
+    def __iter__(self):
+        """Iterate over key-value pairs."""
+        for _, line in super(TextReader, self).__iter__():
+            if line.endswith('\n'):
+                line = line[:-1]
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                yield fields[0], fields[1]
+            elif fields:
+                yield fields[0], ''
 
 
-# TODO: implement TextReader
-# class TextReader(LineReader) should read lines and do:
-# key, value = line.split(None, 1)
+def line_blocks(fileobj, block_size=LINE_BLOCK_SIZE):
+    """Yields blocks of bytes that each end with a complete line.
+
+    Every block ends with b'\n' except possibly the last one.
+    """
+    leftover = b''
+    while True:
+        data = fileobj.read(block_size)
+        if not data:
+            if leftover:
+                yield leftover
+            return
+        cut = data.rfind(b'\n') + 1
+        if cut:
+            yield leftover + data[:cut]
+            leftover = data[cut:]
+        else:
+            leftover += data
+
+
+def ranged_line_blocks(fileobj, start, end, block_size=LINE_BLOCK_SIZE):
+    """Yields (offsets, lines) for blocks of lines that begin in [start, end).
+
+    The file object must be positioned at byte `start - 1` (or at 0 if
+    `start` is 0).  A line that begins before `start` belongs to the
+    previous range, so it is skipped.  If `end` is None, then lines are read
+    through the end of the file.  The lines are bytes.
+    """
+    offset = start
+    if start > 0:
+        offset = start - 1 + len(fileobj.readline())
+    for block in line_blocks(fileobj, block_size):
+        if end is not None and offset >= end:
+            return
+        lines = BytesIO(block).readlines()
+        offsets = []
+        for line in lines:
+            if end is not None and offset >= end:
+                del lines[len(offsets):]
+                break
+            offsets.append(offset)
+            offset += len(line)
+        yield offsets, lines
+
+
+def decode_lines(block):
+    """Decodes a block of UTF-8 lines and returns an iterator over them."""
+    text = block.decode('utf-8', 'replace')
+    if '\r\n' in text:
+        text = text.replace('\r\n', '\n')
+    return StringIO(text, newline='\n')
+
 
 class TextWriter(Writer):
     """A basic line-oriented format, primarily for user interaction.
@@ -196,15 +376,23 @@ class HexReader(Reader):
 
     def __iter__(self):
         """Iterate over key-value pairs."""
-        for line in self.fileobj:
-            encoded_key, encoded_value = line.split()
-            key, _ = hex_decoder(encoded_key)
-            value, _ = hex_decoder(encoded_value)
-            if self.loads_key is not None:
-                key = self.loads_key(key)
-            if self.loads_value is not None:
-                value = self.loads_value(value)
-            yield (key, value)
+        return chain.from_iterable(self.iter_batches())
+
+    def iter_batches(self, n=DEFAULT_BATCH_SIZE):
+        """Iterate over lists of (up to) n key-value pairs."""
+        lines = chain.from_iterable(map(BytesIO,
+            line_blocks(self.fileobj)))
+        while True:
+            batch_lines = list(islice(lines, n))
+            if not batch_lines:
+                return
+            keys = []
+            values = []
+            for line in batch_lines:
+                encoded_key, _, encoded_value = line.rstrip().partition(b' ')
+                keys.append(unhexlify(encoded_key))
+                values.append(unhexlify(encoded_value))
+            yield _load_batch(keys, values, self.loads_key, self.loads_value)
 
 
 class HexWriter(Writer):
@@ -236,19 +424,40 @@ class HexWriter(Writer):
 class BinWriter(Writer):
     """A key-value store using a simple binary record format.
 
+    Each key and value is written as a 4-byte length followed by its bytes.
+    With the auto serializer (the default), the writer holds back its first
+    `typed_sample` records, and if all of their keys (or values) have the
+    same type tag (see `serializers.auto_dumps`), the tag is written once in
+    the file header and is left out of each record.  A later record with a
+    different tag is written in full with the high bit of its length set.
+
     By default, the given file will be closed when the writer is closed,
     but the close argument makes this configurable.  Setting close to False
     is useful for StringIO/BytesIO.
     """
     ext = 'mrsb'
     magic = b'MrsB'
+    typed_magic = b'MrsT'
+    typed_sample = AUTO_SAMPLE_RECORDS
 
     def __init__(self, fileobj, *args, **kwds):
         super(BinWriter, self).__init__(fileobj, *args, **kwds)
-        self.fileobj.write(self.magic)
+        self.key_tag = b''
+        self.value_tag = b''
+        if auto_dumps in (self.dumps_key, self.dumps_value):
+            self._sample = []
+        else:
+            self._sample = None
+            self.fileobj.write(self.magic)
 
     def writepair(self, kvpair, serialized_key=None):
         """Write a key-value pair."""
+        if self._sample is not None or self.key_tag or self.value_tag:
+            if serialized_key is None:
+                return self.writebatch([kvpair])
+            else:
+                return self.writebatch([kvpair], [serialized_key])
+
         key, value = kvpair
         if serialized_key is not None:
             key = serialized_key
@@ -266,61 +475,288 @@ class BinWriter(Writer):
         write(binlen)
         write(value)
 
+    def writebatch(self, kvpairs, serialized_keys=None):
+        """Write a list of key-value pairs with a single write."""
+        if serialized_keys is None:
+            key_tag, keys = _dumps_batch([key for key, _ in kvpairs],
+                    self.dumps_key)
+        else:
+            key_tag, keys = None, serialized_keys
+        value_tag, values = _dumps_batch([value for _, value in kvpairs],
+                self.dumps_value)
+
+        if self._sample is None:
+            self._write_records(key_tag, keys, value_tag, values)
+        else:
+            self._sample.extend(zip(_with_tag(key_tag, keys),
+                _with_tag(value_tag, values)))
+            if len(self._sample) >= self.typed_sample:
+                self._write_header()
+
+    def _write_header(self):
+        """Chooses the tags, and writes the header and the held back records.
+        """
+        keys = [key for key, _ in self._sample]
+        values = [value for _, value in self._sample]
+        self._sample = None
+        n = self.typed_sample
+        if self.dumps_key is auto_dumps:
+            self.key_tag = _common_tag(keys[:n])
+        if self.dumps_value is auto_dumps:
+            self.value_tag = _common_tag(values[:n])
+
+        write = self.fileobj.write
+        if self.key_tag or self.value_tag:
+            write(self.typed_magic)
+            write(self.key_tag or NO_TAG)
+            write(self.value_tag or NO_TAG)
+        else:
+            write(self.magic)
+        self._write_records(None, keys, None, values)
+
+    def _write_records(self, key_tag, keys, value_tag, values):
+        key_lengths, keys = _typed_field(key_tag, keys, self.key_tag)
+        value_lengths, values = _typed_field(value_tag, values,
+                self.value_tag)
+
+        pack = len_struct.pack
+        parts = []
+        append = parts.append
+        for key_length, key, value_length, value in zip(key_lengths, keys,
+                value_lengths, values):
+            append(pack(key_length))
+            append(key)
+            append(pack(value_length))
+            append(value)
+        self.fileobj.write(b''.join(parts))
+
+    def finish(self):
+        if self._sample is not None:
+            self._write_header()
+        super(BinWriter, self).finish()
+
+
+def _dumps_batch(objs, dumps):
+    """Serializes a list of keys or values.
+
+    Returns a tag and a list of payloads for that tag (see
+    `serializers.auto_dumps_batch`), or None and a list of serialized bytes.
+    """
+    if dumps is auto_dumps:
+        return auto_dumps_batch(objs)
+    elif dumps is None:
+        return None, objs
+    else:
+        return None, list(map(dumps, objs))
+
+
+def _with_tag(tag, data):
+    """Converts payloads for the given tag (if not None) to full encodings."""
+    if tag is None:
+        return data
+    else:
+        return [tag + d for d in data]
+
+
+def _common_tag(data):
+    """Returns the auto serializer tag shared by all of the data (or b'')."""
+    if data:
+        tag = data[0][:1]
+        if tag in auto_decoders and all(d[:1] == tag for d in data):
+            return tag
+    return b''
+
+
+def _typed_field(tag, data, file_tag):
+    """Returns the length fields and bytes for the keys or values of a batch.
+
+    The data are payloads for the given tag, or if the tag is None, full
+    encodings.  Records with the file's tag are written without it, and any
+    others have the escape bit set in their length fields.
+    """
+    if tag is not None:
+        if tag == file_tag:
+            return list(map(len, data)), data
+        data = [tag + d for d in data]
+    if not file_tag:
+        return list(map(len, data)), data
+
+    lengths = []
+    fields = []
+    for d in data:
+        if d[:1] == file_tag:
+            lengths.append(len(d) - 1)
+            fields.append(d[1:])
+        else:
+            lengths.append(len(d) | ESCAPE_BIT)
+            fields.append(d)
+    return lengths, fields
+
 
 class BinReader(Reader):
     """A key-value store using a simple binary record format."""
     magic = b'MrsB'
+    typed_magic = b'MrsT'
 
     def __init__(self, fileobj, *args, **kwds):
         super(BinReader, self).__init__(fileobj, *args, **kwds)
-        self._buffer = b''
-        self._magic_read = False
+        self._tags = None
 
     def __iter__(self):
         """Iterate over key-value pairs."""
-        #TODO: check for 'MRSB' magic cookie
-        if not self._magic_read:
-            buf = self.fileobj.read(len(self.magic))
-            if buf != self.magic:
-                raise RuntimeError('Invalid file header: "%s"'
-                    % buf.encode('hex_codec'))
-            self._magic_read = True
+        return chain.from_iterable(self.iter_batches())
+
+    def _read_header(self):
+        """Reads the magic and returns the key and value tags (if typed)."""
+        buf = self.fileobj.read(len(self.magic))
+        if buf == self.magic:
+            return b'', b''
+        elif buf == self.typed_magic:
+            tags = self.fileobj.read(2)
+            if len(tags) != 2:
+                raise RuntimeError('File ended unexpectedly')
+            result = []
+            for tag in (tags[:1], tags[1:]):
+                if tag == NO_TAG:
+                    tag = b''
+                elif tag not in auto_decoders:
+                    raise RuntimeError('Invalid type tag: "%s"'
+                            % hex_encoder(tag)[0])
+                result.append(tag)
+            return tuple(result)
+        else:
+            raise RuntimeError('Invalid file header: "%s"'
+                % hex_encoder(buf)[0])
 
+    def iter_batches(self, n=DEFAULT_BATCH_SIZE):
+        """Iterate over lists of (up to) n key-value pairs.
+
+        The file is read in large chunks, and all of the complete records in
+        a chunk are parsed in a single pass.
+        """
+        if self._tags is None:
+            self._tags = self._read_header()
+        key_tag, value_tag = self._tags
+
+        buf = b''
+        pos = 0
+        eof = False
         while True:
-            key = self._read_record()
-            if key is None:
+            keys = []
+            values = []
+            escapes = ([], [])
+            while True:
+                pos = _parse_records(buf, pos, keys, values, n, escapes)
+                if len(keys) >= n or eof:
+                    break
+                data = self.fileobj.read(max(BIN_READ_SIZE, len(buf) - pos))
+                if data:
+                    buf = buf[pos:] + data
+                    pos = 0
+                else:
+                    eof = True
+
+            if keys:
+                if key_tag or value_tag:
+                    keys = _load_typed(keys, key_tag, escapes[0],
+                            self.loads_key)
+                    values = _load_typed(values, value_tag, escapes[1],
+                            self.loads_value)
+                    yield list(zip(keys, values))
+                else:
+                    yield _load_batch(keys, values, self.loads_key,
+                            self.loads_value)
+            elif eof:
+                if pos < len(buf):
+                    _check_partial_record(buf, pos)
                 return
-            value = self._read_record()
-            if value is None:
-                raise RuntimeError('File ended with a lone key')
-            if self.loads_key is not None:
-                key = self.loads_key(key)
-            if self.loads_value is not None:
-                value = self.loads_value(value)
-            yield (key, value)
-
-    def _fill_buffer(self, size=DEFAULT_BUFFER_SIZE):
-        self._buffer += self.fileobj.read(size)
-
-    def _read_record(self):
-        if len(self._buffer) < len_struct.size:
-            self._fill_buffer()
-        if not self._buffer:
-            return None
-
-        lenfield = self._buffer[:len_struct.size]
-        length, = len_struct.unpack(lenfield)
 
-        end = len_struct.size + length
-        if end > len(self._buffer):
-            self._fill_buffer(end - len(self._buffer))
 
-        if end > len(self._buffer):
-            raise RuntimeError('File ended unexpectedly')
+def _parse_records(buf, pos, keys, values, n, escapes):
+    """Parses complete key-value records from buf, starting at pos.
 
-        data = self._buffer[len_struct.size:end]
-        self._buffer = self._buffer[end:]
+    Appends up to n keys and values (as bytes) and returns the position
+    after the last complete record.  The indices of any keys and values with
+    the escape bit set (see `BinWriter`) are appended to the two lists in
+    `escapes`.
+    """
+    unpack_from = len_struct.unpack_from
+    size = len_struct.size
+    end = len(buf)
+    count = len(keys)
+    key_escapes, value_escapes = escapes
+    while count < n and pos + size <= end:
+        key_length, = unpack_from(buf, pos)
+        key_escaped = key_length & ESCAPE_BIT
+        key_end = pos + size + (key_length & LENGTH_MASK)
+        if key_end + size > end:
+            break
+        value_length, = unpack_from(buf, key_end)
+        value_escaped = value_length & ESCAPE_BIT
+        value_end = key_end + size + (value_length & LENGTH_MASK)
+        if value_end > end:
+            break
+        keys.append(buf[pos + size:key_end])
+        values.append(buf[key_end + size:value_end])
+        if key_escaped:
+            key_escapes.append(count)
+        if value_escaped:
+            value_escapes.append(count)
+        pos = value_end
+        count += 1
+    return pos
+
+
+def _check_partial_record(buf, pos):
+    """Raises an error describing the incomplete record at the end of buf."""
+    if len(buf) - pos >= len_struct.size:
+        key_length, = len_struct.unpack_from(buf, pos)
+        key_length &= LENGTH_MASK
+        if pos + len_struct.size + key_length == len(buf):
+            raise RuntimeError('File ended with a lone key')
+    raise RuntimeError('File ended unexpectedly')
+
+
+def _load_typed(data, tag, escapes, loads):
+    """Deserializes the keys or values of a batch from a typed file.
+
+    Records at the indices in escapes were written in full (with their tags).
+    """
+    if tag and loads is auto_loads:
+        decode = auto_decoders[tag]
+        if not escapes:
+            return list(map(decode, data))
+        escapes = set(escapes)
+        return [auto_loads(d) if i in escapes else decode(d)
+                for i, d in enumerate(data)]
+
+    if tag:
+        # Restore the full encodings.
+        escapes = set(escapes)
+        data = [d if i in escapes else tag + d for i, d in enumerate(data)]
+    if loads is None:
         return data
+    else:
+        return list(map(loads, data))
+
+
+def _load_batch(keys, values, loads_key, loads_value):
+    """Deserializes lists of keys and values into a list of pairs."""
+    if loads_key is not None:
+        keys = map(loads_key, keys)
+    if loads_value is not None:
+        values = map(loads_value, values)
+    return list(zip(keys, values))
+
+
+def batches(iterable, n=DEFAULT_BATCH_SIZE):
+    """Splits an iterable into lists of (up to) n items."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, n))
+        if not batch:
+            return
+        yield batch
 
 
 class ZipWriter(BinWriter):
@@ -332,6 +768,7 @@ class ZipWriter(BinWriter):
     """
     ext = 'mrsz'
     magic = b'MrsZ'
+    typed_magic = b'MrsY'
 
     def __init__(self, fileobj, *args, **kwds):
         fileobj = gzip.GzipFile(fileobj=fileobj, mode='wb',
@@ -339,6 +776,8 @@ class ZipWriter(BinWriter):
         super(ZipWriter, self).__init__(fileobj, *args, **kwds)
 
     def finish(self):
+        if self._sample is not None:
+            self._write_header()
         # Close the gzip file (which does not close the underlying file).
         self.fileobj.close()
 
@@ -346,6 +785,7 @@ class ZipWriter(BinWriter):
 class ZipReader(BinReader):
     """A key-value store using a simple compressed binary record format."""
     magic = b'MrsZ'
+    typed_magic = b'MrsY'
 
     def __init__(self, fileobj, *args, **kwds):
         self.original_file = fileobj
@@ -358,6 +798,359 @@ class ZipReader(BinReader):
         self.original_file.close()
 
 
+class StructWriter(Writer):
+    """A key-value store of packed arrays for fixed-width keys and values.
+
+    Both the key and value serializers must be StructSerializers (as made by
+    `make_primitive_serializer` or `make_struct_serializer`).  Records are
+    grouped into blocks, and each block holds a record count followed by an
+    array of packed keys and an array of packed values, with no per-record
+    length fields.  The struct formats are stored in the file header, so a
+    StructReader does not need the serializers.
+    """
+    ext = 'mrss'
+    magic = b'MrsS'
+    block_records = STRUCT_BLOCK_RECORDS
+
+    def __init__(self, fileobj, serializers=None):
+        super(StructWriter, self).__init__(fileobj, serializers)
+        key_s, value_s = _struct_serializers(serializers)
+        self.key_s, self.value_s = key_s, value_s
+        self.key_size = struct.calcsize(key_s.format)
+        self.value_size = struct.calcsize(value_s.format)
+
+        flags = (STRUCT_KEY_PRIMITIVE * key_s.primitive |
+                STRUCT_VALUE_PRIMITIVE * value_s.primitive)
+        write = self.fileobj.write
+        write(self.magic)
+        write(flags_struct.pack(flags))
+        for format in (key_s.format, value_s.format):
+            format = format.encode('ascii')
+            write(len_struct.pack(len(format)))
+            write(format)
+
+        self._keys = bytearray()
+        self._values = bytearray()
+        self._count = 0
+
+    def writepair(self, kvpair, serialized_key=None):
+        """Write a key-value pair."""
+        key, value = kvpair
+        if serialized_key is None:
+            serialized_key = self.dumps_key(key)
+        self._keys += serialized_key
+        self._values += self.dumps_value(value)
+        self._count += 1
+        if self._count >= self.block_records:
+            self._write_block()
+
+    def writearrays(self, keys, values):
+        """Write arrays of keys and values as a single block.
+
+        NumPy arrays are packed with a single conversion.  A two-dimensional
+        array may be given for a tuple format (one column per field).
+        """
+        numpy = _import_numpy()
+        if (numpy is None or not isinstance(keys, numpy.ndarray) or
+                not isinstance(values, numpy.ndarray)):
+            return self.writebatch(arrays_to_pairs(keys, values))
+        if len(keys) != len(values):
+            raise RuntimeError('Key and value arrays differ in length')
+        if not len(keys):
+            return
+
+        key_bytes = _pack_numpy(keys, self.key_s)
+        value_bytes = _pack_numpy(values, self.value_s)
+        self._write_block()
+        write = self.fileobj.write
+        write(len_struct.pack(len(keys)))
+        write(key_bytes)
+        write(value_bytes)
+
+    def _write_block(self):
+        count = self._count
+        if not count:
+            return
+        if (len(self._keys) != count * self.key_size or
+                len(self._values) != count * self.value_size):
+            raise RuntimeError('Serialized record has the wrong size')
+        write = self.fileobj.write
+        write(len_struct.pack(count))
+        write(self._keys)
+        write(self._values)
+        self._keys = bytearray()
+        self._values = bytearray()
+        self._count = 0
+
+    def finish(self):
+        self._write_block()
+        super(StructWriter, self).finish()
+
+
+class StructReader(Reader):
+    """Reads a key-value store written by StructWriter.
+
+    Keys and values are unpacked with the formats in the file header, except
+    that a raw serializer (with a `loads` of None) gives the packed bytes of
+    each key or value.  Besides iterating over key-value pairs, a
+    StructReader can read each block of records in bulk with `iter_arrays`.
+    """
+    magic = b'MrsS'
+
+    def __init__(self, fileobj, *args, **kwds):
+        super(StructReader, self).__init__(fileobj, *args, **kwds)
+        self._header_read = False
+
+    def _read_header(self):
+        buf = self._read_exact(len(self.magic))
+        if buf != self.magic:
+            raise RuntimeError('Invalid file header: %r' % buf)
+        flags, = flags_struct.unpack(self._read_exact(flags_struct.size))
+        formats = []
+        for _ in range(2):
+            length, = len_struct.unpack(self._read_exact(len_struct.size))
+            formats.append(self._read_exact(length).decode('ascii'))
+        self.key_struct = struct.Struct(formats[0])
+        self.value_struct = struct.Struct(formats[1])
+        self.key_primitive = bool(flags & STRUCT_KEY_PRIMITIVE)
+        self.value_primitive = bool(flags & STRUCT_VALUE_PRIMITIVE)
+        self._header_read = True
+
+    def _read_exact(self, size):
+        buf = self.fileobj.read(size)
+        while len(buf) < size:
+            data = self.fileobj.read(size - len(buf))
+            if not data:
+                raise RuntimeError('File ended unexpectedly')
+            buf += data
+        return buf
+
+    def iter_blocks(self):
+        """Iterate over (count, key bytes, value bytes) for each block."""
+        if not self._header_read:
+            self._read_header()
+        while True:
+            buf = self.fileobj.read(len_struct.size)
+            if not buf:
+                return
+            if len(buf) < len_struct.size:
+                buf += self._read_exact(len_struct.size - len(buf))
+            count, = len_struct.unpack(buf)
+            keys = self._read_exact(count * self.key_struct.size)
+            values = self._read_exact(count * self.value_struct.size)
+            yield count, keys, values
+
+    def __iter__(self):
+        """Iterate over key-value pairs."""
+        return chain.from_iterable(self._iter_block_pairs())
+
+    def _iter_block_pairs(self):
+        """Iterate over a list of key-value pairs for each block."""
+        for _, key_bytes, value_bytes in self.iter_blocks():
+            if self.loads_key is None:
+                keys = split_fixed(key_bytes, self.key_struct.size)
+            else:
+                keys = unpack_array(self.key_struct, key_bytes,
+                        self.key_primitive)
+            if self.loads_value is None:
+                values = split_fixed(value_bytes, self.value_struct.size)
+            else:
+                values = unpack_array(self.value_struct, value_bytes,
+                        self.value_primitive)
+            yield list(zip(keys, values))
+
+    def iter_arrays(self, n=None):
+        """Iterate over (keys, values) arrays, one pair for each block.
+
+        If NumPy is available, each array is made with a single call to
+        `numpy.frombuffer` (as a structured array if the values are tuples).
+        Otherwise, primitives that match a native type become `array.array`
+        objects, and anything else becomes a list.
+        """
+        for _, key_bytes, value_bytes in self.iter_blocks():
+            keys = bytes_to_array(self.key_struct, key_bytes,
+                    self.key_primitive)
+            values = bytes_to_array(self.value_struct, value_bytes,
+                    self.value_primitive)
+            yield keys, values
+
+
+def _struct_serializers(serializers):
+    """Returns the key and value StructSerializers or raises an error."""
+    if serializers is not None:
+        key_s = serializers.key_s
+        value_s = serializers.value_s
+        if (isinstance(key_s, StructSerializer) and
+                isinstance(value_s, StructSerializer)):
+            return key_s, value_s
+    raise RuntimeError('StructWriter requires struct serializers for both'
+            ' keys and values')
+
+
+def _pack_numpy(array, serializer):
+    """Packs a NumPy array with the given StructSerializer's format."""
+    numpy = _import_numpy()
+    dtype = numpy_dtype(serializer.format, serializer.primitive)
+    if dtype is None:
+        raise RuntimeError('Unsupported struct format for NumPy: %s'
+                % serializer.format)
+    if dtype.names and array.dtype.names is None:
+        array = numpy.rec.fromarrays(list(numpy.asarray(array).T),
+                dtype=dtype)
+    return numpy.ascontiguousarray(array, dtype=dtype).tobytes()
+
+
+def pairs_to_arrays(pairs):
+    """Converts a list of key-value pairs to a (keys, values) pair of arrays.
+
+    The arrays are NumPy arrays if NumPy is installed and are otherwise lists.
+    """
+    keys = as_array([key for key, _ in pairs])
+    values = as_array([value for _, value in pairs])
+    return keys, values
+
+
+def as_array(items):
+    """Converts a list to a NumPy array if NumPy is installed."""
+    numpy = _import_numpy()
+    if numpy is not None:
+        return numpy.asarray(items)
+    else:
+        return items
+
+
+def arrays_to_pairs(keys, values):
+    """Converts arrays of keys and values to a list of key-value pairs.
+
+    NumPy scalars are converted to ordinary Python objects.
+    """
+    if hasattr(keys, 'tolist'):
+        keys = keys.tolist()
+    if hasattr(values, 'tolist'):
+        values = values.tolist()
+    return list(zip(keys, values))
+
+
+def split_fixed(buf, size):
+    """Splits bytes into a list of pieces of the given size."""
+    return [buf[i:i + size] for i in range(0, len(buf), size)]
+
+
+def unpack_array(structure, buf, primitive):
+    """Returns a list of the values packed in the given bytes."""
+    if hasattr(structure, 'iter_unpack'):
+        items = structure.iter_unpack(buf)
+    else:
+        items = (structure.unpack_from(buf, offset)
+                for offset in range(0, len(buf), structure.size))
+    if primitive:
+        return [item[0] for item in items]
+    else:
+        return list(items)
+
+
+def bytes_to_array(structure, buf, primitive):
+    """Converts packed bytes into an array (see `StructReader.iter_arrays`)."""
+    numpy = _import_numpy()
+    if numpy is not None:
+        dtype = numpy_dtype(structure.format, primitive)
+        if dtype is not None:
+            return numpy.frombuffer(buf, dtype)
+    if primitive:
+        typecode = array_typecode(structure.format)
+        if typecode is not None:
+            return array.array(typecode, buf)
+    return unpack_array(structure, buf, primitive)
+
+
+_numpy = None
+
+def _import_numpy():
+    """Imports NumPy on first use, returning None if it is not installed."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def _split_struct_format(format):
+    """Splits a struct format into its byte order prefix and items."""
+    if isinstance(format, bytes):
+        format = format.decode('ascii')
+    if format and format[0] in '@=<>!':
+        prefix, format = format[0], format[1:]
+    else:
+        prefix = '@'
+    items = [(int(count) if count else 1, code)
+            for count, code in struct_item_re.findall(format)]
+    return prefix, items
+
+
+def numpy_dtype(format, primitive):
+    """Returns a NumPy dtype for a struct format (or None if unsupported)."""
+    numpy = _import_numpy()
+    prefix, items = _split_struct_format(format)
+    byteorder = {'<': '<', '>': '>', '!': '>'}.get(prefix, '=')
+
+    names = []
+    formats = []
+    offsets = []
+    preceding = prefix
+    for count, code in items:
+        if code == 'x':
+            preceding += '%sx' % count
+            continue
+        elif code == 's':
+            fields = [(code, 'S%s' % count)]
+            item = '%ss' % count
+        elif code in numpy_kinds:
+            size = struct.calcsize(prefix + code)
+            if code in 'c?':
+                field_format = numpy_kinds[code]
+            else:
+                field_format = '%s%s%s' % (byteorder, numpy_kinds[code], size)
+            fields = [(code, field_format)] * count
+            item = code
+        else:
+            return None
+        for code, field_format in fields:
+            offsets.append(struct.calcsize(preceding + '0' + code))
+            names.append('f%s' % len(names))
+            formats.append(field_format)
+            preceding += item
+
+    if primitive and len(formats) == 1:
+        return numpy.dtype(formats[0])
+    return numpy.dtype(dict(names=names, formats=formats, offsets=offsets,
+        itemsize=struct.calcsize(format)))
+
+
+def array_typecode(format):
+    """Returns an `array` typecode for a primitive struct format (or None).
+
+    The struct format must match a native type in both size and byte order.
+    """
+    prefix, items = _split_struct_format(format)
+    if len(items) != 1 or items[0][0] != 1:
+        return None
+    code = items[0][1]
+    native = ('@', '=', {'little': '<', 'big': '>'}[sys.byteorder])
+    if prefix == '!':
+        prefix = '>'
+    if prefix not in native or code not in 'bBhHiIlLqQfd':
+        return None
+    try:
+        if array.array(code).itemsize != struct.calcsize(format):
+            return None
+    except ValueError:
+        return None
+    return code
+
+
 def writerformat(extension):
     """Returns the writer class associated with the given file extension."""
     return writer_map[extension]
@@ -372,16 +1165,36 @@ def fileformat(filename):
 
 
 def open_url(url, **kwds):
-    """Opens a url or file and returns an appropriate key-value reader."""
+    """Opens a url or file and returns an appropriate key-value reader.
+
+    If the url ends with a "#bytes=START-END" or "#bytes=START-" fragment (see
+    `byte_range_url`), then only lines that begin within that range are read.
+    """
+    url, start, end = split_byte_range(url)
     reader_cls = fileformat(url)
+    if start is None:
+        offset = 0
+    elif issubclass(reader_cls, line_readers):
+        kwds['start'] = start
+        kwds['end'] = end
+        offset = max(start - 1, 0)
+    else:
+        raise RuntimeError('Byte ranges are only supported for line-based'
+                ' formats: %s' % url)
 
     parsed_url = urlparse(url, 'file')
     if parsed_url.scheme == 'file':
         f = open(parsed_url.path, 'rb')
+        if offset:
+            f.seek(offset)
     else:
         if parsed_url.scheme == 'hdfs':
             server, username, path = hdfs.urlsplit(url)
-            url = hdfs.datanode_url(server, username, path)
+            if offset:
+                url = hdfs.datanode_url(server, username, path, offset=offset)
+                offset = 0
+            else:
+                url = hdfs.datanode_url(server, username, path)
 
         if reader_cls is ZipReader and sys.version_info < (3, 2):
             # In Python <3.2, the gzip module is broken because it depends on
@@ -390,12 +1203,149 @@ def open_url(url, **kwds):
             filename, _ = opener.retrieve(url)
             f = open(filename, 'rb')
             os.unlink(filename)
+        elif offset:
+            request = Request(url, headers={'Range': 'bytes=%s-' % offset})
+            f = urlopen(request)
+            if f.getcode() != 206:
+                # The server ignored the Range header and sent everything.
+                _skip_bytes(f, offset)
         else:
             f = urlopen(url)
 
     return reader_cls(f, **kwds)
 
 
+def _skip_bytes(f, count):
+    """Reads and discards the given number of bytes from a file object."""
+    while count > 0:
+        data = f.read(min(count, 64 * DEFAULT_BUFFER_SIZE))
+        if not data:
+            return
+        count -= len(data)
+
+
+def byte_range_url(url, start, end):
+    """Returns a url that selects the lines that begin in [start, end).
+
+    If end is None, the range extends to the end of the file.
+    """
+    if end is None:
+        end = ''
+    return '%s#bytes=%s-%s' % (url, start, end)
+
+
+def split_byte_range(url):
+    """Splits a url into a (url, start, end) tuple.
+
+    If the url has no byte range, then start and end are None.  If the range
+    extends to the end of the file, then end is None.
+
+    >>> split_byte_range('/data/file.txt#bytes=100-200')
+    ('/data/file.txt', 100, 200)
+    >>> split_byte_range('/data/file.txt#bytes=100-')
+    ('/data/file.txt', 100, None)
+    >>> split_byte_range('/data/file.txt')
+    ('/data/file.txt', None, None)
+    >>>
+    """
+    match = byte_range_re.match(url)
+    if match:
+        url, start, end = match.groups()
+        return url, int(start), (int(end) if end else None)
+    else:
+        return url, None, None
+
+
+def url_size(url):
+    """Returns the size in bytes of the file at the given url."""
+    parsed_url = urlparse(url, 'file')
+    if parsed_url.scheme == 'file':
+        return os.path.getsize(parsed_url.path)
+    elif parsed_url.scheme == 'hdfs':
+        server, username, path = hdfs.urlsplit(url)
+        return hdfs.hdfs_get_file_status(server, username, path)['length']
+    else:
+        if PY3:
+            f = urlopen(Request(url, method='HEAD'))
+        else:
+            f = urlopen(url)
+        try:
+            return int(f.info()['Content-Length'])
+        finally:
+            f.close()
+
+
+def split_url(url, split_size, size=None):
+    """Divides a url into byte ranges of approximately the given size.
+
+    Only line-based formats can be divided, and urls that are already byte
+    ranges are left alone.  If the size of the file is already known, it may
+    be given.  The last range is open-ended, so lines appended to the file
+    since its size was found (e.g., in a cached listing) are still read.
+    Returns a list of urls.
+    """
+    if (split_byte_range(url)[1] is not None or
+            not issubclass(fileformat(url), line_readers)):
+        return [url]
+
+    if size is None:
+        size = url_size(url)
+    if size <= split_size:
+        return [url]
+    count = -(-size // split_size)
+    bounds = [size * i // count for i in range(count)] + [None]
+    return [byte_range_url(url, start, end)
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def combine_urls(urls, combine_to, sizes=None):
+    """Packs urls into groups of up to about `combine_to` bytes each.
+
+    Urls are sorted by host and directory, and a group never spans two hosts,
+    so each group tends to be read from a single place.  A url that is larger
+    than `combine_to` is placed in a group by itself.  The optional `sizes`
+    dict gives the already known sizes of some of the urls.  Returns a list
+    of lists of urls.
+    """
+    def locality(url):
+        parsed_url = urlparse(split_byte_range(url)[0], 'file')
+        host = (parsed_url.scheme, parsed_url.netloc)
+        return host, os.path.dirname(parsed_url.path), url
+
+    groups = []
+    group = []
+    group_host = None
+    group_size = 0
+    for host, _, url in sorted(locality(url) for url in urls if url):
+        size = _range_size(url, sizes)
+        if group and (host != group_host or
+                group_size + size > combine_to):
+            groups.append(group)
+            group = []
+            group_size = 0
+        group.append(url)
+        group_host = host
+        group_size += size
+    if group:
+        groups.append(group)
+    return groups
+
+
+def _range_size(url, sizes=None):
+    """Returns the number of bytes of a url (or of its byte range)."""
+    if sizes and url in sizes:
+        return sizes[url]
+    url, start, end = split_byte_range(url)
+    if start is None:
+        return url_size(url)
+    elif end is None:
+        if sizes and url in sizes:
+            return sizes[url] - start
+        return url_size(url) - start
+    else:
+        return end - start
+
+
 def test():
     import doctest
     doctest.testmod()
@@ -405,14 +1355,19 @@ reader_map = {
         'mrsx': HexReader,
         'mrsb': BinReader,
         'mrsz': ZipReader,
+        'mrss': StructReader,
         }
 writer_map = {
         'mtxt': TextWriter,
         'mrsx': HexWriter,
         'mrsb': BinWriter,
         'mrsz': ZipWriter,
+        'mrss': StructWriter,
         }
 default_read_format = LineReader
+line_readers = (LineReader, BytesLineReader)
+# Formats that give back exactly the pairs that were written.
+lossless_readers = (BinReader, HexReader, StructReader)
 default_write_format = BinWriter
 
 # vim: et sw=4 sts=4
@@ -71,7 +71,7 @@ def urlsplit(url):
         return None
 
     if fields.port:
-        server = ':'.join((fields.hostname, fields.port))
+        server = '%s:%s' % (fields.hostname, fields.port)
     else:
         server = fields.hostname
     if fields.username:
@@ -208,28 +208,38 @@ class RPCServer(SimpleXMLRPCServer):
         self.instance = instance
 
     def _dispatch(self, method, params, host):
-        try:
-            func = getattr(self.instance, 'xmlrpc_' + method)
-        except AttributeError:
-            raise RuntimeError('method "%s" is not supported' % method)
-
-        try:
-            if hasattr(func, 'uses_host'):
-                return func(*params, host=host)
-            else:
-                return func(*params)
-        except Exception as e:
-            import traceback
-            msg = 'Exception in RPC Server: %s' % e
-            logger.critical(msg)
-            tb = traceback.format_exc()
-            msg = 'Traceback: %s' % tb
-            logger.error(msg)
-            raise
+        return dispatch(self.instance, method, params, host)
 
 
 class ThreadingRPCServer(socketserver.ThreadingMixIn, RPCServer):
-    pass
+    # Request threads may wait indefinitely on persistent connections (e.g.,
+    # from a daemon slave), so they must not keep the process alive.
+    daemon_threads = True
+
+
+def dispatch(instance, method, params, host):
+    """Calls the method of the instance that handles the given RPC method.
+
+    The method's name is the RPC method's name prefixed with 'xmlrpc_'.
+    """
+    try:
+        func = getattr(instance, 'xmlrpc_' + method)
+    except AttributeError:
+        raise RuntimeError('method "%s" is not supported' % method)
+
+    try:
+        if hasattr(func, 'uses_host'):
+            return func(*params, host=host)
+        else:
+            return func(*params)
+    except Exception as e:
+        import traceback
+        msg = 'Exception in RPC Server: %s' % e
+        logger.critical(msg)
+        tb = traceback.format_exc()
+        msg = 'Traceback: %s' % tb
+        logger.error(msg)
+        raise
 
 
 def uses_host(f):
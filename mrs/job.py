@@ -27,7 +27,11 @@ from . import bucket
 from . import computed_data
 from . import datasets
 from . import http
+from . import journal
+from . import lineage
+from . import listing
 from . import registry
+from . import serializers
 from .serializers import Serializers
 from . import tasks
 from . import util
@@ -46,11 +50,16 @@ class Job(object):
             url_converter=None):
         self._manager = manager
         self._program = program
+        self._opts = opts
         self._default_dir = default_dir
         self._url_converter = url_converter
 
         self._registry = registry.Registry(program)
         self._keep_jobdir = getattr(opts, 'mrs__keep_jobdir', False)
+        self._listing_cache = getattr(opts, 'mrs__listing_cache', None)
+        self._result_cache = getattr(opts, 'mrs__result_cache', None)
+        self._checkpoint = getattr(opts, 'mrs__checkpoint', None)
+        self._resume = getattr(opts, 'mrs__resume', False)
         self.default_partition = program.partition
         self.default_reduce_tasks = getattr(opts, 'mrs__reduce_tasks', 1)
         self.default_reduce_splits = 1
@@ -64,9 +73,102 @@ class Job(object):
         """
         return self._manager.wait(*datasets, **kwds)
 
-    def file_data(self, filenames):
-        """Defines a set of data from a list of urls."""
-        ds = datasets.FileData(filenames)
+    def cache_data(self, ds):
+        """Keeps the contents of a computed dataset in the memory of workers.
+
+        Each task of the dataset adds its output to the bucket cache of the
+        worker that computed it, and tasks that read the dataset are
+        assigned to those workers when possible.  This lets iterative
+        programs reuse a dataset without reading it from files.  Returns the
+        dataset.
+
+        Output that is too big for the cache (see --mrs-cache-size) is not
+        cached: it is only kept in its file on the worker's local disk, where
+        later tasks read it as usual, and the worker logs a warning.
+
+        Tasks that were assigned before this call do not cache their output,
+        so to cache all of it, create the dataset with `cache=True` instead.
+        """
+        ds.cache = True
+        self._manager.cache_dataset(ds)
+        return ds
+
+    def checkpoint(self, state, *datasets):
+        """Records the state of the program for resuming after a crash.
+
+        With the --mrs-checkpoint option, the state (which must be
+        serializable as JSON) is written to the checkpoint journal, along
+        with the urls of the given datasets, which must be complete.  If the
+        program is started again with --mrs-resume, then `resume` returns
+        the state and the datasets, so that an iterative program can resume
+        from its latest iteration.  The files of the datasets are kept until
+        the next checkpoint.  Without --mrs-checkpoint, this does nothing.
+        """
+        if not self._checkpoint:
+            return
+        for ds in datasets:
+            if getattr(ds, 'computing', False):
+                raise RuntimeError('Only complete datasets can be'
+                        ' checkpointed.')
+        dataset_ids = [ds.id for ds in datasets]
+        self._manager.checkpoint(state, dataset_ids)
+
+    def resume(self):
+        """Returns the state and datasets of the latest checkpoint.
+
+        The datasets are in the order that they were given to `checkpoint`.
+        Returns (None, []) unless the program was started with --mrs-resume
+        and the checkpoint journal has a checkpoint whose files are
+        unchanged.
+        """
+        if not (self._checkpoint and self._resume):
+            return None, []
+        checkpoint = journal.last_checkpoint(self._checkpoint)
+        if checkpoint is None:
+            return None, []
+
+        state, ds_list = checkpoint
+        resumed = []
+        for fingerprint, splits, ser_names, entries in ds_list:
+            kwds = {}
+            key_s_name, value_s_name = ser_names
+            if key_s_name:
+                kwds['key_serializer'] = key_s_name
+            if value_s_name:
+                kwds['value_serializer'] = value_s_name
+            self._set_serializers(None, kwds)
+            ds = datasets.FileData([], splits=splits, **kwds)
+            for source, split, url in entries:
+                ds[source, split].url = url
+            ds.fingerprint = fingerprint
+            self._manager.submit(ds)
+            ds._close_callback = self._manager.close_dataset
+            resumed.append(ds)
+        return state, resumed
+
+    def file_data(self, filenames, split_size=None, combine_to=None,
+            cache=False):
+        """Defines a set of data from a list of urls.
+
+        Directories (including `hdfs://` directories) are expanded to the
+        files they contain (recursively), and glob patterns are expanded to
+        the matching files.  If the --mrs-listing-cache option is given,
+        directory listings are cached between runs (see `mrs.listing`).
+
+        If `split_size` is given, then large line-based files are divided
+        into byte-range splits of about `split_size` bytes each.  Keys from
+        a byte-range split are byte offsets rather than line numbers.  If
+        `combine_to` is given, then small files are packed together into
+        splits of about `combine_to` bytes each, so that a single map task
+        reads many files.  If `cache` is true, then workers keep the data in
+        RAM after reading them (see `mrs.bucket.BucketCache`).
+        """
+        files = listing.expand_urls(filenames, self._listing_cache)
+        urls = [url for url, _ in files]
+        sizes = dict((url, size) for url, size in files if size is not None)
+        ds = datasets.FileData(urls, split_size=split_size,
+                combine_to=combine_to, sizes=sizes, cache=cache)
+        self._set_fingerprint(ds)
         self._manager.submit(ds)
         ds._close_callback = self._manager.close_dataset
         return ds
@@ -98,16 +200,19 @@ class Job(object):
         if self._url_converter:
             for bucket in ds[:, :]:
                 bucket.url = self._url_converter.local_to_global(bucket.url)
+        self._set_fingerprint(ds)
         self._manager.submit(ds)
         ds._close_callback = self._manager.close_dataset
         return ds
 
     def map_data(self, input, mapper, splits=None, outdir=None, combiner=None,
-            parter=None, **kwds):
+            parter=None, parallelism=1, **kwds):
         """Define a set of data computed with a map operation.
 
         Specify the input dataset and a mapper function.  The mapper must be
-        in the program instance.
+        in the program instance.  If `parallelism` is greater than 1, each
+        map task applies the mapper with a pool of that many processes (the
+        order of the map output is then not guaranteed).
 
         Called from the user-specified run function.
         """
@@ -132,9 +237,11 @@ class Job(object):
         else:
             combine_name = ''
 
-        op = tasks.MapOperation(map_name, combine_name, part_name)
+        op = tasks.MapOperation(map_name, combine_name, part_name,
+                parallelism)
         ds = computed_data.ComputedData(op, input, splits=splits, dir=outdir,
                 permanent=permanent, **kwds)
+        self._set_fingerprint(ds, input)
         self._manager.submit(ds)
         ds._close_callback = self._manager.close_dataset
         return ds
@@ -167,14 +274,17 @@ class Job(object):
         op = tasks.ReduceOperation(reduce_name, part_name)
         ds = computed_data.ComputedData(op, input, splits=splits, dir=outdir,
                 permanent=permanent, **kwds)
+        self._set_fingerprint(ds, input)
         self._manager.submit(ds)
         ds._close_callback = self._manager.close_dataset
         return ds
 
     def reducemap_data(self, input, reducer, mapper, splits=None, outdir=None,
-            combiner=None, parter=None, **kwds):
+            combiner=None, parter=None, parallelism=1, **kwds):
         """Define a set of data computed with the reducemap operation.
 
+        The `parallelism` argument applies to the map as in `map_data`.
+
         Called from the user-specified run function.
         """
         if splits is None:
@@ -199,9 +309,10 @@ class Job(object):
         part_name, _ = self._named_attr(parter)
 
         op = tasks.ReduceMapOperation(reduce_name, map_name, combine_name,
-                part_name)
+                part_name, parallelism)
         ds = computed_data.ComputedData(op, input, splits=splits, dir=outdir,
                 permanent=permanent, **kwds)
+        self._set_fingerprint(ds, input)
         self._manager.submit(ds)
         ds._close_callback = self._manager.close_dataset
         return ds
@@ -210,6 +321,19 @@ class Job(object):
         """Reports the progress (fraction complete) of the given dataset."""
         return self._manager.progress(dataset)
 
+    def _set_fingerprint(self, ds, input=None):
+        """Fingerprints a new dataset for the result cache or a checkpoint.
+
+        See `mrs.lineage`.  The input is given for computed datasets.
+        """
+        if not (self._result_cache or self._checkpoint):
+            return
+        if input is None:
+            ds.fingerprint = lineage.source_fingerprint(ds)
+        else:
+            ds.fingerprint = lineage.computed_fingerprint(ds, input,
+                    self._program, self._opts)
+
     def _set_serializers(self, f, kwds, fallback_serializers=None):
         """Add any serializers specified on the given function to kwds."""
 
@@ -225,11 +349,11 @@ class Job(object):
 
         if isinstance(key_s, str):
             key_s_name = key_s
-            key_s = getattr(self._program, key_s)
+            key_s = serializers.lookup(key_s, self._program)
         elif key_s is None:
             key_s_name = ''
         else:
-            key_s_name = self._registry[key_s]
+            key_s_name = self._serializer_name(key_s)
 
         if 'value_serializer' in kwds:
             value_s = kwds['value_serializer']
@@ -243,14 +367,26 @@ class Job(object):
 
         if isinstance(value_s, str):
             value_s_name = value_s
-            value_s = getattr(self._program, value_s)
+            value_s = serializers.lookup(value_s, self._program)
         elif value_s is None:
             value_s_name = ''
         else:
-            value_s_name = self._registry[value_s]
+            value_s_name = self._serializer_name(value_s)
+
+        kwds['serializers'] = Serializers(key_s, key_s_name, value_s,
+                value_s_name)
 
-        serializers = Serializers(key_s, key_s_name, value_s, value_s_name)
-        kwds['serializers'] = serializers
+    def _serializer_name(self, serializer):
+        """Returns the name of a program attribute or registered serializer.
+        """
+        try:
+            return self._registry[serializer]
+        except KeyError:
+            name = serializers.registered_name(serializer)
+            if name is None:
+                raise RuntimeError('Serializer is neither an attribute of the'
+                        ' program nor registered: %r' % (serializer,))
+            return name
 
     def _named_attr(self, value):
         if isinstance(value, str):
@@ -288,7 +424,10 @@ def job_process(program_class, opts, args, default_dir, pipe,
     user_thread.daemon = True
     user_thread.start()
 
-    manager.run()
+    try:
+        manager.run()
+    finally:
+        bucket.unlink_shared_memory()
 
 
 def run_user_thread(program_class, opts, args, default_dir, manager,
@@ -323,8 +462,8 @@ class DataManager(object):
     The run method (which should be in a standalone DataManager thread)
     receives urls from the MapReduce implementation.  Other methods may be
     called from the main job thread (note that the implementation assumes that
-    only one other thread will call the submit, done, close_dataset and wait
-    method).
+    only one other thread will call the submit, done, close_dataset,
+    cache_dataset, checkpoint and wait methods).
     """
 
     def __init__(self, pipe, quit_pipe):
@@ -347,8 +486,8 @@ class DataManager(object):
             while True:
                 for fd, event in poll.poll():
                         if fd == self._pipe.fileno():
-                            message = self._pipe.recv()
-                            self.handle_message(message)
+                            for message in self._pipe.read_messages():
+                                self.handle_message(message)
                         elif fd == self._quit_pipe:
                             os.read(self._quit_pipe, 4096)
                             return
@@ -400,8 +539,8 @@ class DataManager(object):
         self._datasets[dataset.id] = dataset
         if isinstance(dataset, computed_data.ComputedData):
             self._progress_dict[dataset.id] = 0.0
-        # TODO: if we're running parallel PSO and the dataset is a LocalData,
-        # then convert it to FileData to avoid serializing unnecessary data.
+        # Buckets pickle lazily: file-backed data are sent by url, and large
+        # in-memory data are handed off in shared memory segments.
         message = DatasetSubmission(dataset)
         self._pipe.send(message)
 
@@ -416,6 +555,14 @@ class DataManager(object):
         """Called when a dataset is closed.  Reports this to the impl."""
         self._pipe.send(CloseDataset(dataset.id))
 
+    def cache_dataset(self, dataset):
+        """Called when a dataset is to be cached.  Reports this to the impl."""
+        self._pipe.send(CacheDataset(dataset.id))
+
+    def checkpoint(self, state, dataset_ids):
+        """Sends the program's state to be recorded by the impl."""
+        self._pipe.send(Checkpoint(state, dataset_ids))
+
     def wait(self, *datasets, **kwds):
         """Wait for any of the given Datasets to complete.
 
@@ -485,6 +632,19 @@ class CloseDataset(JobToRunner):
         self.dataset_id = dataset_id
 
 
+class CacheDataset(JobToRunner):
+    """Keep the output of the specified dataset in the workers' caches."""
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+
+class Checkpoint(JobToRunner):
+    """Record the program's state and the datasets needed to resume."""
+    def __init__(self, state, dataset_ids):
+        self.state = state
+        self.dataset_ids = dataset_ids
+
+
 class JobDone(JobToRunner):
     """No further datasets will be submitted and the run method is done.
 
@@ -498,10 +658,9 @@ class BucketReady(RunnerToJob):
     """The given Bucket is ready."""
     def __init__(self, dataset_id, bucket):
         self.dataset_id = dataset_id
-        # TODO: right now, the Serial impl sends the whole bucket with all
-        # data, even if the user program doesn't need it.  Instead, there
-        # should be a separate mechanism for requesting the data in the
-        # serial case.
+        # In the Serial impl, the bucket holds data, which are only loaded
+        # in the job process if the user program uses them (see
+        # `bucket.ReadBucket`).
         self.bucket = bucket
 
 
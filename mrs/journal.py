@@ -0,0 +1,202 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Checkpoint journal for resuming interrupted jobs.
+
+With the --mrs-checkpoint option, the runner appends a record to a journal
+file (one JSON object per line) whenever a task or a dataset is completed,
+and whenever the program calls `Job.checkpoint` to register its iteration
+state.  Datasets are identified across runs by their fingerprints (see
+`mrs.lineage`), and their output files are identified by url, size, and
+modification time.
+
+If a job is interrupted, its temporary directories are kept, and running
+the program again with --mrs-resume reuses them.  The program can get its
+latest state (and the datasets it registered with it) from `Job.resume`,
+and any dataset that it then submits is restored from the journal instead
+of being computed, either entirely or task by task.  Only output on
+storage that the master can check (local or shared files or HDFS) is
+journaled, so a Master needs the --mrs-shared option.
+"""
+
+from __future__ import division, print_function
+
+import collections
+import json
+import os
+
+from . import lineage
+
+from logging import getLogger
+logger = getLogger('mrs')
+
+
+def read_journal(path):
+    """Iterates over the records of a journal (skipping invalid lines).
+
+    A missing journal has no records.  The last line is invalid if the
+    process that was writing it was killed.
+    """
+    try:
+        f = open(path)
+    except (IOError, OSError):
+        return
+    with f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning('Skipping an invalid line in the journal.')
+
+
+def journal_dirs(path):
+    """Returns the (jobdir, default_dir) pair of the journaled job.
+
+    Returns None if the journal has no directories that still exist.
+    """
+    dirs = None
+    for record in read_journal(path):
+        if 'dirs' in record:
+            dirs = record['dirs']
+    if dirs is None:
+        return None
+    jobdir, default_dir = dirs
+    for d in dirs:
+        if d and not os.path.isdir(d):
+            return None
+    return jobdir, default_dir
+
+
+def last_checkpoint(path):
+    """Returns the state and datasets of the latest usable checkpoint.
+
+    The datasets are (fingerprint, splits, serializer names, entries)
+    tuples, where the entries are (source, split, url) triples.  A
+    checkpoint is only usable if all of its files are unchanged.  Returns
+    None if there is no usable checkpoint.
+    """
+    checkpoints = [record['checkpoint'] for record in read_journal(path)
+            if 'checkpoint' in record]
+    for state, ds_records in reversed(checkpoints):
+        ds_list = []
+        for fingerprint, splits, ser_names, records in ds_records:
+            entries = lineage.check_records(records)
+            if entries is None:
+                break
+            ds_list.append((fingerprint, splits, ser_names, entries))
+        else:
+            return state, ds_list
+    return None
+
+
+class Journal(object):
+    """Records completed tasks, datasets, and checkpoints of a job.
+
+    If `resume` is true, records are appended to the existing journal, and
+    the completed tasks and datasets that it lists can be looked up.
+    """
+    def __init__(self, path, resume, jobdir, default_dir):
+        self.path = path
+        self._tasks = collections.defaultdict(dict)
+        self._datasets = {}
+
+        if resume:
+            for record in read_journal(path):
+                if 'task' in record:
+                    fingerprint, task_index, records = record['task']
+                    self._tasks[fingerprint][task_index] = records
+                elif 'dataset' in record:
+                    fingerprint, splits, records = record['dataset']
+                    self._datasets[fingerprint] = (splits, records)
+            self._file = open(path, 'a')
+        else:
+            self._file = open(path, 'w')
+        self._write(dict(dirs=[jobdir, default_dir]))
+
+    def _write(self, record, sync=False):
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def lookup_dataset(self, fingerprint):
+        """Returns the splits and (source, split, url) triples of a dataset.
+
+        Returns None if the dataset was not completed or its files changed.
+        """
+        try:
+            splits, records = self._datasets[fingerprint]
+        except KeyError:
+            return None
+        entries = lineage.check_records(records)
+        if entries is None:
+            return None
+        return splits, entries
+
+    def completed_tasks(self, fingerprint):
+        """Returns a list of (task_index, outurls) for a dataset's tasks.
+
+        The outurls are (split, url) pairs.  Tasks whose files changed are
+        left out.
+        """
+        tasks = []
+        for task_index, records in self._tasks.get(fingerprint, {}).items():
+            entries = lineage.check_records(records)
+            if entries is not None:
+                outurls = [(split, url) for _, split, url in entries]
+                tasks.append((task_index, outurls))
+        return tasks
+
+    def task_done(self, fingerprint, task_index, buckets):
+        """Records the output buckets of a completed task."""
+        records = lineage.bucket_records(buckets)
+        if records is not None:
+            self._write(dict(task=[fingerprint, task_index, records]))
+
+    def dataset_done(self, ds):
+        """Records the buckets of a completed dataset."""
+        records = lineage.bucket_records(ds[:, :])
+        if records is not None:
+            self._write(dict(dataset=[ds.fingerprint, ds.splits, records]),
+                    sync=True)
+
+    def checkpoint(self, state, datasets):
+        """Records the program's state and the datasets needed to resume.
+
+        Returns False (and records nothing) if any of the datasets is not
+        on storage that can be checked when resuming.
+        """
+        ds_records = []
+        for ds in datasets:
+            records = lineage.bucket_records(ds[:, :])
+            if records is None:
+                return False
+            if ds.serializers is not None:
+                ser_names = [ds.serializers.key_s_name,
+                        ds.serializers.value_s_name]
+            else:
+                ser_names = ['', '']
+            ds_records.append([ds.fingerprint, ds.splits, ser_names,
+                records])
+        self._write(dict(checkpoint=[state, ds_records]), sync=True)
+        return True
+
+    def finish(self, success):
+        """Closes the journal, which is removed if the job succeeded."""
+        self._file.close()
+        if success:
+            os.remove(self.path)
+
+# vim: et sw=4 sts=4
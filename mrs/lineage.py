@@ -0,0 +1,300 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fingerprints of datasets and a cache of results between runs.
+
+A fingerprint is a digest of everything that determines the contents of a
+dataset.  For input data, this is the contents of a LocalData or the urls,
+sizes, and modification times of the files of a FileData.  For a computed
+dataset, it is the fingerprint of its input along with the operation (the
+code of its functions and the names of its arguments), the number of splits,
+the serializers, the output format, the source of the modules that define
+the program's class (and its base classes outside of Mrs), and the
+program's own options (all but the implementation and the options that
+begin with `mrs__`).  Any dataset derived from data that cannot be
+fingerprinted (such as an http url) has no fingerprint.
+
+A result cache is a directory of JSON manifests, one per fingerprint, which
+record the urls of the output files of a permanent dataset (one written to
+an explicit output directory).  If a dataset with the same fingerprint is
+submitted in a later run, and its files are unchanged, then the runner uses
+those files instead of computing the dataset again (they are linked or
+copied into the dataset's output directory if it is a different one).  This
+assumes that the program's functions are deterministic and depend only on
+their arguments and the program's options.  Code that the functions call in
+other modules (such as a shared library of helpers) is not part of the
+fingerprint, so after changing such code, remove the result cache directory.
+"""
+
+from __future__ import division, print_function
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import types
+
+from . import datasets
+from . import fileformats
+from . import listing
+
+from logging import getLogger
+logger = getLogger('mrs')
+
+MANIFEST_VERSION = 1
+
+# Digests of the source of program classes (see `program_fingerprint`).
+_program_digests = {}
+
+
+def code_fingerprint(func):
+    """Returns a digest of the code of a function or method.
+
+    Unlike `registry.object_hash`, this includes the constants and names
+    used by the code (and by any nested functions), so that changing a
+    literal changes the digest.
+    """
+    md5 = hashlib.md5()
+    _update_code(md5, func.__code__)
+    return md5.hexdigest()
+
+
+def program_fingerprint(program):
+    """Returns a digest of the source of the modules of a program's class.
+
+    The modules that define the class and its base classes are included,
+    except for Mrs itself and any module whose source file is unknown.
+    """
+    cls = type(program)
+    digest = _program_digests.get(cls)
+    if digest is None:
+        md5 = hashlib.md5()
+        paths = set()
+        for base in cls.__mro__:
+            if base.__module__.split('.')[0] == 'mrs':
+                continue
+            try:
+                path = inspect.getsourcefile(base)
+            except TypeError:
+                # Built-in classes have no source.
+                continue
+            if not path or path in paths:
+                continue
+            paths.add(path)
+            try:
+                with open(path, 'rb') as f:
+                    md5.update(f.read())
+            except (IOError, OSError):
+                pass
+        digest = md5.hexdigest()
+        _program_digests[cls] = digest
+    return digest
+
+
+def _update_code(md5, code):
+    md5.update(code.co_code)
+    md5.update(repr(code.co_names).encode('utf-8'))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code(md5, const)
+        else:
+            md5.update(repr(const).encode('utf-8'))
+
+
+def source_fingerprint(ds):
+    """Returns the fingerprint of a LocalData or FileData (or None)."""
+    md5 = hashlib.md5()
+    md5.update(type(ds).__name__.encode('utf-8'))
+    for b in sorted(ds[:, :], key=lambda b: (b.source, b.split)):
+        md5.update(repr((b.source, b.split)).encode('utf-8'))
+        if isinstance(ds, datasets.LocalData):
+            # The data of a LocalData are in RAM unless they were spilled.
+            pairs = b.stream() if b.spilled else iter(b)
+            for kvpair in pairs:
+                md5.update(repr(kvpair).encode('utf-8'))
+        else:
+            status = _url_status(b.url)
+            if status is None:
+                return None
+            md5.update(repr((b.url, status)).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def computed_fingerprint(ds, input, program, opts):
+    """Returns the fingerprint of a ComputedData (or None).
+
+    The input is the dataset that `ds` is computed from.
+    """
+    if input.fingerprint is None:
+        return None
+    # The output of datasets that start before their input is complete
+    # depends on timing.
+    if ds.async_start or ds.backlink_id is not None:
+        return None
+    op = ds.op
+    user_opts = sorted((name, repr(value))
+            for name, value in vars(opts).items()
+            if name != 'mrs' and not name.startswith('mrs__'))
+    if ds.serializers is not None:
+        ser_names = (ds.serializers.key_s_name, ds.serializers.value_s_name)
+    else:
+        ser_names = None
+    if ds.format is not None:
+        ext = ds.format.ext
+    else:
+        ext = ''
+
+    md5 = hashlib.md5()
+    md5.update(repr((input.fingerprint, input.splits, op.to_args(),
+        ds.splits, ser_names, ext, user_opts)).encode('utf-8'))
+    md5.update(program_fingerprint(program).encode('utf-8'))
+    for name in tuple(op.function_names()) + (op.part_name,):
+        if name:
+            md5.update(code_fingerprint(getattr(program, name)).encode(
+                'utf-8'))
+    return md5.hexdigest()
+
+
+def _url_status(url):
+    """Returns (size, mtime) of the file of a url, or None if unknown."""
+    if not url:
+        return None
+    path = fileformats.split_byte_range(url)[0]
+    fs = listing.filesystem(path)
+    if fs is None:
+        return None
+    status = fs.stat(path)
+    if status is None or status[0]:
+        return None
+    _, size, mtime = status
+    return size, mtime
+
+
+class ResultCache(object):
+    """A directory of manifests of the output files of computed datasets.
+
+    Each manifest gives the number of splits of a dataset and lists
+    (source, split, url, size, mtime) for each of its buckets, and it is
+    named by the dataset's fingerprint.  The number of splits is recorded
+    because the Serial implementation computes each dataset as one split.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _manifest_path(self, fingerprint):
+        return os.path.join(self.path, '%s.json' % fingerprint)
+
+    def lookup(self, fingerprint):
+        """Returns the splits and a list of (source, split, url) triples.
+
+        None is returned if there is no manifest for the fingerprint or if
+        any of its files is missing or has changed.
+        """
+        path = self._manifest_path(fingerprint)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+
+        entries = check_records(manifest['buckets'])
+        if entries is None:
+            return None
+        return manifest['splits'], entries
+
+    def store(self, fingerprint, ds):
+        """Writes a manifest for the buckets of the given dataset.
+
+        Returns False (and writes nothing) if any bucket with data does not
+        have a url that can be checked for changes later.
+        """
+        records = bucket_records(ds[:, :])
+        if records is None:
+            return False
+
+        manifest = dict(version=MANIFEST_VERSION, splits=ds.splits,
+                buckets=records)
+        path = self._manifest_path(fingerprint)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, path)
+        return True
+
+
+def bucket_records(buckets):
+    """Returns a list of (source, split, url, size, mtime) for the buckets.
+
+    Empty buckets without urls are skipped.  Returns None if any other
+    bucket does not have a url that can be checked for changes later.
+    """
+    records = []
+    for b in buckets:
+        if not b.url:
+            if len(b):
+                return None
+            continue
+        status = _url_status(b.url)
+        if status is None:
+            return None
+        size, mtime = status
+        records.append((b.source, b.split, b.url, size, mtime))
+    return records
+
+
+def check_records(records):
+    """Returns (source, split, url) for each record from `bucket_records`.
+
+    Returns None if any of the files is missing or has changed.
+    """
+    entries = []
+    for source, split, url, size, mtime in records:
+        if _url_status(url) != (size, mtime):
+            logger.info('Ignoring a result with a changed file: %s' % url)
+            return None
+        entries.append((source, split, url))
+    return entries
+
+
+def link_entries(entries, dir):
+    """Puts the files of (source, split, url) entries in the given directory.
+
+    Each file that is not already in the directory is hard-linked (or copied
+    if it cannot be linked) into it under the same name.  Returns the entries
+    with the new urls, or None if any file is not local.
+    """
+    new_entries = []
+    for source, split, url in entries:
+        if listing.filesystem(url) is not listing.LocalFilesystem:
+            return None
+        path = listing.local_path(url)
+        new_path = os.path.join(dir, os.path.basename(path))
+        if not (os.path.exists(new_path) and
+                os.path.samefile(path, new_path)):
+            if os.path.exists(new_path):
+                os.remove(new_path)
+            try:
+                os.link(path, new_path)
+            except OSError:
+                shutil.copy2(path, new_path)
+        new_entries.append((source, split, new_path))
+    return new_entries
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,277 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Expansion of input directories and glob patterns into lists of files.
+
+Directories (local or `hdfs://`) are listed recursively, and glob patterns
+are matched, with the listings performed in parallel by a pool of threads.
+Files and directories whose names begin with '.' or '_' are skipped.
+
+A listing cache is a JSON manifest recording the contents of each directory
+along with its modification time.  When a directory has not been modified
+since it was cached, its contents are taken from the manifest instead of
+being listed (and each of its files stat'ed) again.  Note that modifying a
+file in place does not change the modification time of its directory, so
+cached sizes may be stale for files that are rewritten between runs.
+"""
+
+from __future__ import division, print_function
+
+import fnmatch
+import glob
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import stat
+import sys
+
+PY3 = sys.version_info[0] == 3
+if PY3:
+    from urllib.parse import urlparse
+else:
+    from urlparse import urlparse
+
+from . import hdfs
+
+from logging import getLogger
+logger = getLogger('mrs')
+
+LISTING_THREADS = 16
+MANIFEST_VERSION = 1
+HIDDEN_PREFIXES = ('.', '_')
+glob_re = re.compile(r'[*?[]')
+
+
+def expand_urls(urls, cache_path=None):
+    """Expands directories and glob patterns into a list of files.
+
+    Returns a list of (url, size) pairs, where size is None if it is
+    unknown.  Urls that are neither local nor HDFS paths are passed through
+    unchanged, as are paths that do not exist.  The files within each
+    directory are sorted by name.
+    """
+    cache = ListingCache(cache_path)
+    pool = ThreadPool(LISTING_THREADS)
+    try:
+        roots = pool.map(_resolve, urls)
+
+        # Breadth-first traversal, listing each level of directories in
+        # parallel.
+        listings = {}
+        frontier = [url for entries in roots for url, size, is_dir in entries
+                if is_dir]
+        while frontier:
+            results = pool.map(cache.listdir, frontier)
+            frontier = []
+            for url, (files, subdirs) in results:
+                listings[url] = (files, subdirs)
+                frontier.extend(subdirs)
+    finally:
+        pool.close()
+        pool.join()
+    cache.save()
+
+    expanded = []
+    for entries in roots:
+        for url, size, is_dir in entries:
+            if is_dir:
+                _collect(url, listings, expanded)
+            else:
+                expanded.append((url, size))
+    return expanded
+
+
+def _collect(url, listings, expanded):
+    """Appends the files within a directory (recursively) to expanded."""
+    files, subdirs = listings[url]
+    expanded.extend(files)
+    for subdir in subdirs:
+        _collect(subdir, listings, expanded)
+
+
+def _resolve(url):
+    """Returns a list of (url, size, is_dir) entries for a url or pattern."""
+    fs = filesystem(url)
+    if fs is None:
+        return [(url, None, False)]
+
+    status = fs.stat(url)
+    if status is not None:
+        is_dir, size, _ = status
+        return [(url, size, is_dir)]
+    elif glob_re.search(url):
+        entries = []
+        for match in fs.glob(url):
+            is_dir, size, _ = fs.stat(match)
+            entries.append((match, size, is_dir))
+        if not entries:
+            raise RuntimeError('No files match the pattern: %s' % url)
+        return entries
+    else:
+        return [(url, None, False)]
+
+
+def filesystem(url):
+    """Returns the filesystem for a url (or None if it is not listable)."""
+    scheme = urlparse(url, 'file').scheme
+    if scheme == 'file':
+        return LocalFilesystem
+    elif scheme == 'hdfs':
+        return HDFSFilesystem
+    else:
+        return None
+
+
+class ListingCache(object):
+    """Caches directory listings in a JSON manifest, keyed by path and mtime.
+
+    Each entry maps a directory url to its mtime, the names and sizes of
+    its files, and the names of its subdirectories.  If `path` is None, then
+    nothing is cached.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.dirs = {}
+        self.modified = False
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == MANIFEST_VERSION:
+                    self.dirs = manifest['dirs']
+            except ValueError:
+                logger.warning('Ignoring invalid listing cache: %s' % path)
+
+    def listdir(self, url):
+        """Returns (url, (files, subdirs)) for the given directory.
+
+        The files are (url, size) pairs, and the subdirs are urls.
+        """
+        fs = filesystem(url)
+        mtime = fs.stat(url)[2]
+        entry = self.dirs.get(url)
+        if entry is None or entry['mtime'] != mtime:
+            files = []
+            dirs = []
+            for name, is_dir, size in fs.listdir(url):
+                if name.startswith(HIDDEN_PREFIXES):
+                    continue
+                if is_dir:
+                    dirs.append(name)
+                else:
+                    files.append((name, size))
+            files.sort()
+            dirs.sort()
+            entry = dict(mtime=mtime, files=files, dirs=dirs)
+            if self.path:
+                self.dirs[url] = entry
+                self.modified = True
+
+        files = [(fs.join(url, name), size) for name, size in entry['files']]
+        subdirs = [fs.join(url, name) for name in entry['dirs']]
+        return url, (files, subdirs)
+
+    def save(self):
+        """Writes the manifest (if anything changed)."""
+        if not self.modified:
+            return
+        manifest = dict(version=MANIFEST_VERSION, dirs=self.dirs)
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, self.path)
+        self.modified = False
+
+
+class LocalFilesystem(object):
+    """Listing operations for local paths (and file:// urls)."""
+    @staticmethod
+    def stat(url):
+        """Returns (is_dir, size, mtime), or None if the path is missing."""
+        try:
+            st = os.stat(local_path(url))
+        except OSError:
+            return None
+        is_dir = stat.S_ISDIR(st.st_mode)
+        return is_dir, (None if is_dir else st.st_size), st.st_mtime
+
+    @staticmethod
+    def listdir(url):
+        """Yields (name, is_dir, size) for each entry of a directory."""
+        path = local_path(url)
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            yield name, stat.S_ISDIR(st.st_mode), st.st_size
+
+    @staticmethod
+    def glob(url):
+        if url.startswith('file://'):
+            return ['file://' + path
+                    for path in sorted(glob.glob(local_path(url)))]
+        else:
+            return sorted(glob.glob(url))
+
+    @staticmethod
+    def join(url, name):
+        return os.path.join(url, name)
+
+
+def local_path(url):
+    """Converts a file:// url to a path (plain paths are left alone)."""
+    if url.startswith('file://'):
+        return urlparse(url).path
+    else:
+        return url
+
+
+class HDFSFilesystem(object):
+    """Listing operations for hdfs:// urls."""
+    @staticmethod
+    def stat(url):
+        """Returns (is_dir, size, mtime), or None if the path is missing."""
+        server, username, path = hdfs.urlsplit(url)
+        try:
+            status = hdfs.hdfs_get_file_status(server, username, path)
+        except hdfs.FileNotFoundException:
+            return None
+        is_dir = (status['type'] == 'DIRECTORY')
+        size = None if is_dir else status['length']
+        return is_dir, size, status['modificationTime']
+
+    @staticmethod
+    def listdir(url):
+        """Yields (name, is_dir, size) for each entry of a directory."""
+        server, username, path = hdfs.urlsplit(url)
+        for status in hdfs.hdfs_list_status(server, username, path):
+            is_dir = (status['type'] == 'DIRECTORY')
+            yield status['pathSuffix'], is_dir, status['length']
+
+    @classmethod
+    def glob(cls, url):
+        """Matches a pattern in the last component of an hdfs url."""
+        parent, pattern = url.rstrip('/').rsplit('/', 1)
+        if glob_re.search(parent):
+            raise RuntimeError('Only the last component of an HDFS path may'
+                    ' be a pattern: %s' % url)
+        names = [name for name, _, _ in cls.listdir(parent)
+                if fnmatch.fnmatchcase(name, pattern)]
+        return [cls.join(parent, name) for name in sorted(names)]
+
+    @staticmethod
+    def join(url, name):
+        return '%s/%s' % (url.rstrip('/'), name)
+
+# vim: et sw=4 sts=4
@@ -35,6 +35,7 @@ import time
 import traceback
 import warnings
 
+from . import bucket
 from . import master
 from . import param
 from .param import ParamObj, Param
@@ -140,7 +141,11 @@ class BaseImplementation(ParamObj):
         # Seed needs to be a string to avoid triggering XMLRPC limits:
         seed=Param(default=str(DEFAULT_SEED),
             doc='Random seed, default changes each run'),
-        timing_file=Param(doc='Name of a file to write timing data to')
+        timing_file=Param(doc='Name of a file to write timing data to'),
+        listing_cache=Param(doc='File for caching listings of input'
+            ' directories between runs'),
+        result_cache=Param(doc='Directory for caching the output of'
+            ' datasets with an outdir between runs'),
         )
 
     def __init__(self):
@@ -176,22 +181,42 @@ class BaseImplementation(ParamObj):
     def make_job_process(self, opts, args, jobdir=None):
         """Creates a job process.
 
-        Returns a (process, connection) pair.
+        Returns a (process, connection, quit_pipe) triple.
         """
+        job_proc, job_conn, job_quit_pipe, _, _ = self._job_process(opts,
+                args, jobdir)
+        return job_proc, job_conn, job_quit_pipe
+
+    def start_job_process(self, opts, args, jobdir=None):
+        """Creates and starts a job process (for a long-running runner).
+
+        Returns a (process, connection, quit_pipe) triple.  This process's
+        copies of the child's ends are closed, so they are not leaked, and
+        the connection reports EOF if the job process dies.
+        """
+        job_proc, job_conn, job_quit_pipe, child_job_conn, \
+                child_job_quit_pipe = self._job_process(opts, args, jobdir)
+        job_proc.start()
+        child_job_conn.close()
+        os.close(child_job_quit_pipe)
+        return job_proc, job_conn, job_quit_pipe
+
+    def _job_process(self, opts, args, jobdir):
         from . import job
 
-        job_conn, child_job_conn = multiprocessing.Pipe()
+        job_conn, child_job_conn = util.framed_pipe()
         child_job_quit_pipe, job_quit_pipe = os.pipe()
         job_proc = multiprocessing.Process(target=job.job_process,
                 name='Job Process',
                 args=(self.program_class, opts, args, jobdir, child_job_conn,
                     child_job_quit_pipe, self.use_bucket_server))
-        return job_proc, job_conn, job_quit_pipe
+        return (job_proc, job_conn, job_quit_pipe, child_job_conn,
+                child_job_quit_pipe)
 
     def start_worker_process(self, profile):
         from . import worker
 
-        self.worker_pipe, worker_pipe2 = multiprocessing.Pipe()
+        self.worker_pipe, worker_pipe2 = util.framed_pipe()
 
         w = worker.Worker(self.program_class, worker_pipe2)
         if profile:
@@ -201,6 +226,7 @@ class BaseImplementation(ParamObj):
 
         worker_process = multiprocessing.Process(target=target, name='Worker')
         worker_process.start()
+        self.worker_pid = worker_process.pid
 
     def stop_worker_process(self):
         if self.worker_pipe is not None:
@@ -233,19 +259,7 @@ class Implementation(BaseImplementation):
         if self.runner_class is None:
             raise NotImplementedError('Subclasses must set runner_class.')
 
-        if self.shared:
-            jobdir = util.mktempdir(self.shared, 'mrs.job_')
-            self.use_bucket_server = False
-            default_dir = os.path.join(jobdir, 'user_run')
-            os.mkdir(default_dir)
-        elif self.tmpdir:
-            jobdir = ''
-            util.try_makedirs(self.tmpdir)
-            default_dir = util.mktempdir(self.tmpdir, 'mrs_master_')
-        else:
-            jobdir = None
-            default_dir = None
-
+        jobdir, default_dir = self.make_dirs()
         job_proc, job_conn, job_quit_pipe = self.make_job_process(
                 opts, args, default_dir)
         try:
@@ -271,14 +285,57 @@ class Implementation(BaseImplementation):
         finally:
             os.write(job_quit_pipe, b'\0')
             self.stop_worker_process()
+            bucket.unlink_shared_memory()
+
+        if exitcode != 0 and getattr(self, 'checkpoint', None):
+            logger.critical('Keeping temporary files for resuming from the'
+                    ' checkpoint journal (see --mrs-resume).')
+        else:
+            self.remove_dirs(jobdir, default_dir)
+        return exitcode
+
+    def make_dirs(self):
+        """Creates the job directory and the default directory.
+
+        Returns a (jobdir, default_dir) pair, either of which may be None.
+        When resuming from a checkpoint journal, the directories of the
+        interrupted job are reused.
+        """
+        from . import journal
+        from . import util
+
+        if getattr(self, 'checkpoint', None) and self.resume:
+            dirs = journal.journal_dirs(self.checkpoint)
+            if dirs is not None:
+                if self.shared:
+                    self.use_bucket_server = False
+                return dirs
+            logger.warning('No directories to resume from in the'
+                    ' checkpoint journal.')
+
+        if self.shared:
+            jobdir = util.mktempdir(self.shared, 'mrs.job_')
+            self.use_bucket_server = False
+            default_dir = os.path.join(jobdir, 'user_run')
+            os.mkdir(default_dir)
+        elif self.tmpdir:
+            jobdir = ''
+            util.try_makedirs(self.tmpdir)
+            default_dir = util.mktempdir(self.tmpdir, 'mrs_master_')
+        else:
+            jobdir = None
+            default_dir = None
+        return jobdir, default_dir
+
+    def remove_dirs(self, jobdir, default_dir):
+        """Cleans up the directories created by make_dirs."""
+        from . import util
 
-        # Clean up jobdir
         if not self.keep_tmp:
             if jobdir:
                 util.remove_recursive(jobdir)
             elif default_dir:
                 util.remove_recursive(default_dir)
-        return exitcode
 
     def sigusr1_handler(self, signum, stack_frame):
         # Apparently the setting siginterrupt can get reset on some platforms.
@@ -290,7 +347,20 @@ class Implementation(BaseImplementation):
 
 
 class Serial(Implementation):
-    """Runs a MapReduce job in serial."""
+    """Runs a MapReduce job in serial.
+
+    Task output is kept in RAM, but any output bigger than max_ram_size is
+    spilled to temporary files in the spill_dir, so datasets do not need to
+    fit in memory.
+    """
+
+    _params = dict(
+        spill_dir=Param(doc='Local storage for output that does not fit in'
+            ' RAM (default: the system temporary directory; empty to keep'
+            ' everything in RAM)'),
+        max_ram_size=Param(default=100, type='int',
+            doc='Maximum amount of task output (in MB) to keep in RAM'),
+        )
 
     runner_class = serial.SerialRunner
     keep_tmp = False
@@ -322,6 +392,12 @@ class TaskRunnerParams(ParamObj):
             doc='Maximum number of tolerable failures per task'),
         max_sort_size=Param(default=100, type='int',
             doc='Maximum amount of data (in MB) to sort in RAM'),
+        cache_size=Param(default=256, type='int',
+            doc='Maximum amount of cached input (in MB) per worker'),
+        checkpoint=Param(doc='Journal file for checkpointing completed'
+            ' tasks and datasets'),
+        resume=Param(type='bool',
+            doc='Resume an interrupted job from its checkpoint journal'),
         )
 
 
@@ -339,14 +415,35 @@ class MockParallel(Implementation, FileParams, TaskRunnerParams):
     runner_class = runner.MockParallelRunner
 
 
+class Local(Implementation, FileParams, TaskRunnerParams):
+    """MapReduce execution on a pool of worker processes on one machine.
+
+    Tasks run in parallel on all of the cores of the local machine.  The
+    workers share a local temporary directory, so intermediate data are read
+    directly from disk rather than through a bucket server.
+    """
+    _params = dict(
+        workers=Param(default=0, type='int',
+            doc='Number of worker processes (default: one per CPU)'),
+        )
+
+    runner_class = runner.LocalRunner
+
+    def start_worker_process(self, profile):
+        """Do-nothing method (the runner starts its own workers)."""
+        pass
+
+
 class NetworkParams(ParamObj):
     _params = dict(
         port=Param(default=0, type='int', shortopt='-P',
             doc='RPC Port for incoming requests'),
         timeout=Param(default=120, type='float',
-            doc='Timeout for RPC calls (incl. pings)'),
-        pingdelay=Param(default=120, type='float',
-            doc='Interval between pings'),
+            doc='Timeout for RPC calls'),
+        pingdelay=Param(default=30, type='float',
+            doc='Interval between heartbeats from slaves'),
+        phi_threshold=Param(default=8, type='float',
+            doc='Suspicion level (phi) at which a slave is considered lost'),
         )
 
 
@@ -364,9 +461,112 @@ class Master(Implementation, FileParams, NetworkParams, TaskRunnerParams):
         pass
 
 
+class AsyncMaster(Master):
+    """A Master that runs on a single asyncio event loop (Python 3 only).
+
+    Slaves connect to it exactly as to a Master (see `mrs.aiomaster`).
+    """
+    def _main(self, opts, args):
+        from . import aiomaster
+        self.runner_class = aiomaster.AsyncMasterRunner
+        return super(AsyncMaster, self)._main(opts, args)
+
+
+class Service(Implementation, FileParams, NetworkParams, TaskRunnerParams):
+    """A resident master that runs many jobs on one pool of slaves.
+
+    Slaves sign in once and stay connected while jobs are submitted with the
+    Submit implementation (see `mrs.service`).
+    """
+    _params = dict(
+        runfile=Param(default='',
+            doc="Server's RPC port will be written here"),
+        )
+
+    use_bucket_server = True
+
+    def _main(self, opts, args):
+        from . import service
+
+        jobdir, default_dir = self.make_dirs()
+        try:
+            self.runner = service.ServiceRunner(self.program_class, opts,
+                    args, None, jobdir, default_dir, None)
+            self.runner.start_job_process = self.start_job_process
+            exitcode = self.runner.run()
+        except KeyboardInterrupt:
+            logger.critical('Quitting due to keyboard interrupt.')
+            exitcode = 0
+        finally:
+            bucket.unlink_shared_memory()
+            self.remove_dirs(jobdir, default_dir)
+        return exitcode
+
+
+class Submit(BaseImplementation, NetworkParams):
+    """Submits a job to a Service and waits for it to complete.
+
+    Only the program's own options and the args are sent; implementation
+    options are those of the service.  The exit code is the job's.  Since
+    the service has its own working directory, relative paths in the args
+    are made absolute first (see `absolute_path_args`).
+    """
+    _params = dict(
+        master=Param(shortopt='-M', doc='URL of the Service RPC server'),
+        poll_interval=Param(default=1, type='float',
+            doc='Interval (seconds) between checks of the job status'),
+        )
+
+    def _main(self, opts, args):
+        from . import http
+        from . import registry
+        from .version import __version__
+
+        if not self.master:
+            logger.critical('No service URL specified.')
+            return 1
+
+        optdict = dict((k, v) for k, v in vars(opts).items()
+                if v is not None and not k.startswith('mrs'))
+        program_hash = registry.object_hash(self.program_class)
+        service_rpc = http.TimeoutServerProxy(self.master, self.timeout)
+        job_id = service_rpc.submit(__version__, program_hash, optdict,
+                absolute_path_args(args))
+        if job_id < 0:
+            logger.critical('Service rejected the job.')
+            return 1
+        logger.info('Submitted job %s.' % job_id)
+
+        while True:
+            state, exitcode = service_rpc.status(job_id)
+            if state == 'done':
+                return exitcode
+            elif state == 'unknown':
+                logger.critical('Service lost track of job %s.' % job_id)
+                return 1
+            time.sleep(self.poll_interval)
+
+
+def absolute_path_args(args):
+    """Returns the args with local paths converted to absolute paths.
+
+    An arg is converted if it names an existing file or directory or if it
+    is the last arg (the output directory of the default `MapReduce.run`).
+    Urls (such as hdfs://) are left alone.
+    """
+    new_args = []
+    for i, arg in enumerate(args):
+        if '://' not in arg and (os.path.exists(arg) or i == len(args) - 1):
+            arg = os.path.abspath(arg)
+        new_args.append(arg)
+    return new_args
+
+
 class Slave(BaseImplementation, FileParams, NetworkParams):
     _params = dict(
         master=Param(shortopt='-M', doc='URL of the Master RPC server'),
+        daemon=Param(type='bool',
+            doc='Keep running between jobs, signing in to each new master'),
         )
 
     def _main(self, opts, args):
@@ -384,7 +584,8 @@ class Slave(BaseImplementation, FileParams, NetworkParams):
         self.start_worker_process(opts.mrs__profile)
 
         s = slave.Slave(self.program_class, self.master, self.tmpdir,
-                self.pingdelay, self.timeout, self.worker_pipe)
+                self.pingdelay, self.timeout, self.worker_pipe, self.daemon,
+                self.worker_pid)
         try:
             exitcode = s.run()
         finally:
@@ -42,6 +42,35 @@ separately for each implementation."""
 )
 
 
+def mutates_input(f):
+    """A decorator for map, reduce, or combine functions that modify the
+    objects they are given.
+
+    In the Serial implementation, records are passed between operations in
+    RAM without being copied, so a function that modifies its input records
+    in place must be marked with this decorator.
+    """
+    f.mutates_input = True
+    return f
+
+
+def vectorized(f):
+    """A decorator for map, reduce, or partition functions that operate on
+    whole arrays of records at a time.
+
+    A vectorized map function takes an array of keys and an array of values
+    and returns a pair of arrays of output keys and values.  A vectorized
+    reduce function takes a key and an array of all of its values and returns
+    an iterable of output values.  A vectorized partition function takes an
+    array of keys and the number of splits and returns an array of split
+    indices.  The arrays are NumPy arrays if NumPy is installed (and are
+    read directly from `StructWriter` buckets when possible) and are
+    otherwise lists.
+    """
+    f.vectorized = True
+    return f
+
+
 class MapReduce(object):
     """MapReduce program definition.
 
@@ -209,6 +238,17 @@ class MapReduce(object):
         """
         return int(key) % n
 
+    @vectorized
+    def vectorized_mod_partition(self, keys, n):
+        """A vectorized partition function that mods an array of keys.
+
+        This is the vectorized version of `mod_partition`.
+        """
+        if hasattr(keys, 'dtype'):
+            return keys % n
+        else:
+            return [int(key) % n for key in keys]
+
     # The default partition function is md5_partition:
     partition = md5_partition
 
@@ -258,6 +298,8 @@ class MapReduce(object):
         parser.usage = DEFAULT_USAGE
         return parser
 
+    auto_serializer = serializers.auto_serializer
+    pickle_serializer = serializers.pickle_serializer
     raw_serializer = serializers.raw_serializer
     int_serializer = serializers.int_serializer
     str_serializer = serializers.str_serializer
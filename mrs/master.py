@@ -21,6 +21,7 @@ from __future__ import division, print_function
 # /proc/sys/net/core/somaxconn (which seems to be 128 by default)
 
 import collections
+import math
 import os
 import socket
 import sys
@@ -28,6 +29,7 @@ import threading
 import time
 
 from . import http
+from . import peons
 from . import registry
 from . import computed_data
 from . import runner
@@ -53,6 +55,15 @@ if not PY3:
 INITIAL_PEON_THREADS = 4
 MAX_PEON_THREADS = 20
 
+# Number of heartbeat intervals kept by each failure detector.
+HEARTBEAT_WINDOW = 100
+# Lower bound on the standard deviation of heartbeat intervals, as a fraction
+# of the expected interval (so that a little jitter isn't alarming).
+MIN_STD_FRACTION = 0.25
+
+# Results of `_phi_deviations`, by phi.
+_deviations_memo = {}
+
 
 class MasterRunner(runner.TaskRunner):
     """A TaskRunner that assigns tasks to remote slaves.
@@ -61,6 +72,8 @@ class MasterRunner(runner.TaskRunner):
         idle_slaves: a set of slaves that are ready to be assigned
         result_maps: a dict mapping a dataset id to the corresponding result
             map, which keeps track of which slaves produced which data
+        checkpointed_results: result maps of removed datasets whose files
+            are kept for the latest checkpoint
     """
     def __init__(self, *args):
         super(MasterRunner, self).__init__(*args)
@@ -69,6 +82,7 @@ class MasterRunner(runner.TaskRunner):
         self.idle_slaves = IdleSlaves()
         self.dead_slaves = set()
         self.result_maps = {}
+        self.checkpointed_results = {}
 
         self.rpc_interface = None
         self.rpc_thread = None
@@ -82,24 +96,22 @@ class MasterRunner(runner.TaskRunner):
         self.sched_pipe, sched_write_pipe = os.pipe()
         self.event_loop.register_fd(self.sched_pipe, self.read_sched_pipe)
         self.slaves = Slaves(sched_write_pipe, self.chore_queue,
-                self.opts.mrs__timeout, self.opts.mrs__pingdelay)
+                self.opts.mrs__timeout, self.opts.mrs__pingdelay,
+                self.opts.mrs__phi_threshold)
 
         try:
             self.start_rpc_server()
             self.event_loop.run(timeout_function=self.maintain_chore_queue)
         finally:
-            if self.opts.mrs__runfile:
-                # Rewrite the runfile with a hyphen to signify that
-                # execution is complete.
-                with open(self.opts.mrs__runfile, 'w') as f:
-                    print('-', file=f)
+            # Rewrite the runfile with a hyphen to signify that execution is
+            # complete.
+            self.write_runfile('-')
             self.slaves.disconnect_all()
         return self.exitcode
 
     def start_rpc_server(self):
         program_hash = registry.object_hash(self.program_class)
-        self.rpc_interface = MasterInterface(self.slaves, program_hash,
-                self.opts, self.args, self.jobdir)
+        self.rpc_interface = self.make_rpc_interface(program_hash)
         port = getattr(self.opts, 'mrs__port', 0)
         rpc_server = http.ThreadingRPCServer(('', port), self.rpc_interface)
         if port == 0:
@@ -111,9 +123,17 @@ class MasterRunner(runner.TaskRunner):
         self.rpc_thread.start()
 
         logger.info('Listening on port %s.' % port)
+        self.write_runfile(port)
+
+    def write_runfile(self, value):
+        """Writes the given value to the runfile (if there is one)."""
         if self.opts.mrs__runfile:
             with open(self.opts.mrs__runfile, 'w') as f:
-                print(port, file=f)
+                print(value, file=f)
+
+    def make_rpc_interface(self, program_hash):
+        return MasterInterface(self.slaves, program_hash, self.opts,
+                self.args, self.jobdir)
 
     def maintain_chore_queue(self):
         """Maintains the chore_queue and returns the timeout value for poll."""
@@ -155,7 +175,8 @@ class MasterRunner(runner.TaskRunner):
                     dataset_id, task_index = assignment
                     self.task_lost(dataset_id, task_index)
 
-        for slave, dataset_id, source, urls in results:
+        for slave, dataset_id, source, urls, sort_path in results:
+            self.record_sort_path(sort_path)
             try:
                 self.result_maps[dataset_id].add(slave, source)
             except KeyError:
@@ -170,12 +191,7 @@ class MasterRunner(runner.TaskRunner):
                 logger.info('Ignoring a redundant result (%s, %s).' %
                         (dataset_id, source))
 
-        # Add one peon thread for each new active slave (minus dead slaves).
-        if self.peon_thread_count < MAX_PEON_THREADS:
-            slave_count = len(self.slaves) - len(self.dead_slaves)
-            new_peon_thread_count = slave_count + INITIAL_PEON_THREADS
-            for i in range(new_peon_thread_count - self.peon_thread_count):
-                self.start_peon_thread()
+        self.add_peon_threads()
 
         chore_list = []
         while self.idle_slaves:
@@ -190,7 +206,7 @@ class MasterRunner(runner.TaskRunner):
             dataset = self.datasets[dataset_id]
 
             slave = None
-            if dataset.affinity:
+            if self.wants_affinity(dataset):
                 # Slave-task affinity: when possible, assign to the slave that
                 # computed the task with the same source id in the input
                 # dataset.
@@ -219,6 +235,14 @@ class MasterRunner(runner.TaskRunner):
             chore_list.append(chore_item)
         self.chore_queue.do_many(chore_list)
 
+    def add_peon_threads(self):
+        """Adds one peon thread for each new active slave."""
+        if self.peon_thread_count < MAX_PEON_THREADS:
+            slave_count = len(self.slaves) - len(self.dead_slaves)
+            new_peon_thread_count = slave_count + INITIAL_PEON_THREADS
+            for i in range(new_peon_thread_count - self.peon_thread_count):
+                self.start_peon_thread()
+
     def available_workers(self):
         """Returns the total number of idle workers."""
         return len(self.idle_slaves)
@@ -231,11 +255,22 @@ class MasterRunner(runner.TaskRunner):
     def remove_dataset(self, ds):
         if isinstance(ds, computed_data.ComputedData):
             delete = not ds.permanent
-            slave_source_list = self.result_maps[ds.id].all()
-            self.remove_sources(ds.id, slave_source_list, delete)
-            del self.result_maps[ds.id]
+            # There is no result map if the dataset was never started.
+            result_map = self.result_maps.pop(ds.id, ResultMap())
+            if delete and ds.id in self.checkpointed:
+                # The files are needed to resume until the checkpoint is
+                # superseded (see `delete_checkpointed`).
+                self.checkpointed_results[ds.id] = result_map
+            else:
+                self.remove_sources(ds.id, result_map.all(), delete)
         super(MasterRunner, self).remove_dataset(ds)
 
+    def delete_checkpointed(self, ds):
+        result_map = self.checkpointed_results.pop(ds.id, None)
+        if result_map is not None:
+            self.remove_sources(ds.id, result_map.all(), True)
+        super(MasterRunner, self).delete_checkpointed(ds)
+
     def remove_sources(self, dataset_id, slave_source_list, delete):
         """Remove a single source from a slave.
 
@@ -247,6 +282,11 @@ class MasterRunner(runner.TaskRunner):
                 for slave, source in slave_source_list]
         self.chore_queue.do_many(items)
 
+    def discard_cached(self, dataset_id):
+        items = [(slave.discard, (dataset_id,))
+                for slave in self.slaves.alive_slaves()]
+        self.chore_queue.do_many(items)
+
     def sched_timing_stats(self):
         if self.opts.mrs__timing_interval > 0:
             self.chore_queue.do(self.do_timing_stats,
@@ -353,17 +393,19 @@ class MasterInterface(object):
 
     @http.uses_host
     def xmlrpc_done(self, slave_id, dataset_id, source, urls, cookie,
-            host=None):
+            sort_path='', host=None):
         """Slave is done with the task it was working on.
 
-        The output is available in the list of urls.
+        The output is available in the list of urls.  The sort_path is
+        'memory' or 'external' if the task sorted its input.
         """
         slave = self.slaves.get_slave(slave_id, cookie)
         if slave is not None:
             logger.debug('Slave %s reported completion of task: %s, %s'
                     % (slave_id, dataset_id, source))
             slave.update_timestamp()
-            self.slaves.slave_result(slave, dataset_id, source, urls)
+            self.slaves.slave_result(slave, dataset_id, source, urls,
+                    sort_path)
             return True
         else:
             logger.error('Invalid slave reported done (host %s, id %s).'
@@ -387,24 +429,131 @@ class MasterInterface(object):
             return False
 
     @http.uses_host
-    def xmlrpc_ping(self, slave_id, cookie, host=None):
-        """Slave checking if we're still here."""
+    def xmlrpc_heartbeat(self, slave_id, cookie, status, host=None):
+        """Slave reporting that it is alive, along with its status.
+
+        Returns False if the slave is unknown (so that it can give up).
+        """
         slave = self.slaves.get_slave(slave_id, cookie)
         if slave is not None:
-            logger.debug('Received a ping from slave %s.' % slave_id)
-            slave.update_timestamp()
+            logger.debug('Received a heartbeat from slave %s: %s'
+                    % (slave_id, status))
+            slave.heartbeat(status)
             return True
         else:
-            logger.error('Invalid slave sent ping (host %s, id %s).'
+            logger.error('Invalid slave sent heartbeat (host %s, id %s).'
                     % (host, slave_id))
             return False
 
 
+class PhiAccrualDetector(object):
+    """A phi accrual failure detector (Hayashibara et al., 2004).
+
+    Rather than declaring a slave dead after a fixed timeout, the detector
+    keeps a window of the intervals between heartbeats and computes phi,
+    which is -log10 of the probability that the slave would stay silent for
+    at least as long as it has been.  The intervals are assumed to be
+    normally distributed.  Until enough heartbeats have arrived, the window
+    is seeded with the expected interval.
+
+    Any message from the slave (not just a heartbeat) resets the silence,
+    but only heartbeats, which are regular, are added to the window.
+    """
+    def __init__(self, interval, window=HEARTBEAT_WINDOW):
+        self.min_std = interval * MIN_STD_FRACTION
+        self._intervals = collections.deque([interval], window)
+        self._sum = interval
+        self._sum_squares = interval * interval
+        self._last_heartbeat = None
+        self._last_heard = None
+        self._lock = threading.Lock()
+
+    def heartbeat(self, now):
+        """Records the arrival of a heartbeat at the given time."""
+        with self._lock:
+            if self._last_heartbeat is not None:
+                interval = now - self._last_heartbeat
+                intervals = self._intervals
+                if len(intervals) == intervals.maxlen:
+                    old = intervals.popleft()
+                    self._sum -= old
+                    self._sum_squares -= old * old
+                intervals.append(interval)
+                self._sum += interval
+                self._sum_squares += interval * interval
+            self._last_heartbeat = now
+        self.heard(now)
+
+    def heard(self, now):
+        """Records that some message arrived at the given time."""
+        with self._lock:
+            if self._last_heard is None or now > self._last_heard:
+                self._last_heard = now
+
+    def _stats(self):
+        """Returns the mean and standard deviation of the intervals."""
+        n = len(self._intervals)
+        mean = self._sum / n
+        variance = max(self._sum_squares / n - mean * mean, 0)
+        return mean, max(math.sqrt(variance), self.min_std)
+
+    def silence_limit(self, threshold):
+        """Returns the length of silence at which phi reaches the threshold.
+        """
+        with self._lock:
+            mean, std = self._stats()
+        return mean + std * _phi_deviations(threshold)
+
+    def last_heard(self):
+        """Returns the time when the slave was last heard (or None)."""
+        return self._last_heard
+
+    def phi(self, now):
+        """Returns the suspicion level at the given time.
+
+        A phi of 1 means that there is a 10% chance that a live slave would
+        have been silent this long, a phi of 2 means a 1% chance, etc.
+        """
+        with self._lock:
+            if self._last_heard is None:
+                return 0.0
+            silence = now - self._last_heard
+            mean, std = self._stats()
+
+        y = (silence - mean) / std
+        p_later = 0.5 * math.erfc(y / math.sqrt(2))
+        if p_later <= 0:
+            return float('inf')
+        return -math.log10(p_later)
+
+
+def _phi_deviations(phi):
+    """Returns how many standard deviations above the mean give this phi.
+
+    This inverts the normal tail probability by bisection (the results are
+    memoized, since there is usually only one threshold).
+    """
+    y = _deviations_memo.get(phi)
+    if y is None:
+        p_later = 10 ** -phi
+        low, high = -10.0, 40.0
+        for _ in range(100):
+            y = (low + high) / 2
+            if 0.5 * math.erfc(y / math.sqrt(2)) > p_later:
+                low = y
+            else:
+                high = y
+        _deviations_memo[phi] = y
+    return y
+
+
 class RemoteSlave(object):
     """The master's view of a remote slave.
 
     The master can use this object to make assignments, check status, etc.
     """
+    proxy_class = http.TimeoutServerProxy
+
     def __init__(self, slave_id, host, port, cookie, slaves):
         self.id = slave_id
         self.host = host
@@ -413,9 +562,12 @@ class RemoteSlave(object):
         self.slaves = slaves
         self.chore_queue = slaves.chore_queue
         self.pingdelay = slaves.pingdelay
+        self.phi_threshold = slaves.phi_threshold
+        self.detector = PhiAccrualDetector(self.pingdelay)
+        self.status = {}
 
         uri = "http://%s:%s" % (host, port)
-        self._rpc = http.TimeoutServerProxy(uri, slaves.rpc_timeout)
+        self._rpc = self.proxy_class(uri, slaves.rpc_timeout)
         self._rpc_lock = threading.Lock()
 
         self._assignment = None
@@ -426,12 +578,13 @@ class RemoteSlave(object):
         # The `_state` is either 'alive', 'failed', 'exiting', or 'exited'
         self._state = 'alive'
 
-        # The pinging_active variable assures that only one ping "task" is
+        # The checking_active variable assures that only one check "task" is
         # active at a time.
-        self._pinging_active = False
-        self._pinglock = threading.Lock()
-        self._schedule_ping(self.pingdelay)
+        self._checking_active = False
+        self._checklock = threading.Lock()
+        self._check_timer = None
         self.update_timestamp()
+        self._schedule_check(self._silence_limit())
 
     def check_cookie(self, cookie):
         return (cookie == self.cookie)
@@ -572,6 +725,37 @@ class RemoteSlave(object):
             logger.info('Failed to remove data on slave %s.' % self.id)
             self.critical_failure()
 
+    def discard(self, dataset_id):
+        with self._rpc_lock:
+            if self._state != 'alive':
+                return
+
+            logger.debug('Sending discard request to slave %s: %s'
+                    % (self.id, dataset_id))
+            try:
+                self._rpc.discard(dataset_id, self.cookie)
+                success = True
+            except Fault as f:
+                logger.error('Fault in discard call to slave %s: %s'
+                        % (self.id, f.faultString))
+                success = False
+            except ProtocolError as e:
+                logger.error('Protocol error in discard call to slave %s: %s'
+                        % (self.id, e.errmsg))
+                success = False
+            except http.ConnectionFailed:
+                logger.error('Connection failed in discard call to slave %s' %
+                        self.id)
+                success = False
+
+            if success:
+                self.update_timestamp()
+
+        if not success:
+            logger.info('Failed to discard cached data on slave %s.'
+                    % self.id)
+            self.critical_failure()
+
     def update_timestamp(self):
         """Set the timestamp to the current time."""
         if self._state in ('exiting', 'exited'):
@@ -581,6 +765,18 @@ class RemoteSlave(object):
                     % self.id)
             self.resurrect()
         self.timestamp = time.time()
+        self.detector.heard(self.timestamp)
+        # Postpone the check until the slave would become suspicious.  If
+        # the check is already running, it sees the new timestamp.
+        timer = self._check_timer
+        if timer is not None:
+            timer.reset(self._silence_limit())
+
+    def heartbeat(self, status):
+        """Records a heartbeat (with the given status dict) from the slave."""
+        self.status = status
+        self.detector.heartbeat(time.time())
+        self.update_timestamp()
 
     def critical_failure(self):
         """Report that a slave had a critical failure.
@@ -605,78 +801,69 @@ class RemoteSlave(object):
         if self._state == 'failed':
             logger.warning('Resurrected slave %s (%s)' %
                     (self.id, self.host))
-            with self._pinglock:
+            with self._checklock:
                 self._state = 'alive'
-                restart_pinging = not self._pinging_active
-                if restart_pinging:
-                    self._pinging_active = True
-            if restart_pinging:
-                self._schedule_ping(self.pingdelay)
+                restart_checking = not self._checking_active
+                if restart_checking:
+                    self._checking_active = True
+            if restart_checking:
+                self._schedule_check(self._silence_limit())
             return True
         else:
             return False
 
-    def ping(self):
-        """Ping the slave and schedule a follow-up ping."""
+    def check(self):
+        """Declares the slave failed if it has been silent for too long.
+
+        The slave is considered lost when the phi of its failure detector
+        reaches the threshold.  The check is scheduled for when that would
+        happen, and every message from the slave postpones it (see
+        `update_timestamp`), so a live slave is rarely checked.  If the
+        check finds that the slave is not yet suspicious, then it is
+        scheduled again.
+        """
         # The only place where we can change from not alive to alive is in
-        # resurrect, which holds the pinglock to ensure that we don't
-        # accidentally stop pinging during a resurrect.
+        # resurrect, which holds the checklock to ensure that we don't
+        # accidentally stop checking during a resurrect.
         if not self.alive():
-            with self._pinglock:
+            with self._checklock:
                 if not self.alive():
-                    self._pinging_active = False
+                    self._checking_active = False
                     return
 
-        delta = time.time() - self.timestamp
-        if delta < self.pingdelay:
-            self._schedule_ping(self.pingdelay - delta)
+        now = time.time()
+        phi = self.detector.phi(now)
+        if phi < self.phi_threshold:
+            silence = now - self.detector.last_heard()
+            self._schedule_check(self._silence_limit() - silence)
             return
 
-        if not self._rpc_lock.acquire(False):
-            # RPC socket busy; try again later.
-            self._schedule_ping(self.pingdelay)
-            return
+        logger.error('No heartbeat from slave %s in %.1f seconds (phi %.1f).'
+                % (self.id, now - self.timestamp, phi))
+        # Mark checking as inactive _before_ setting slave as failed.
+        self._checking_active = False
+        self.critical_failure()
 
-        try:
-            logger.debug('Sending ping to slave %s.' % self.id)
-            self._rpc.ping(self.cookie)
-            success = True
-        except Fault as f:
-            logger.error('Fault in ping to slave %s: %s'
-                    % (self.id, f.faultString))
-            success = False
-        except ProtocolError as e:
-            logger.error('Protocol error in ping to slave %s: %s'
-                    % (self.id, e.errmsg))
-            success = False
-        except http.ConnectionFailed:
-            logger.error('Connection failed in ping to slave %s' % self.id)
-            success = False
-        finally:
-            self._rpc_lock.release()
-
-        if success:
-            self.update_timestamp()
-            self._schedule_ping(self.pingdelay)
-        else:
-            # Mark pinging as inactive _before_ setting slave as failed.
-            self._pinging_active = False
-            self.critical_failure()
+    def _silence_limit(self):
+        return self.detector.silence_limit(self.phi_threshold)
 
-    def _schedule_ping(self, delay=None):
-        """Schedules a ping to occur after the given delay.
+    def _schedule_check(self, delay):
+        """Schedules a check of the failure detector after the delay.
 
-        Ensures that the ping keeps repeating, i.e., when a ping finishes,
-        a new ping is immediately scheduled.
+        Ensures that the checks keep repeating, i.e., when a check finishes
+        without finding the slave lost, a new check is scheduled.
         """
-        logger.debug('Scheduling a ping to slave %s.' % self.id)
-        self._pinging_active = True
-        self.chore_queue.do(self.ping, delay=delay)
+        self._checking_active = True
+        # A zero delay would run the check immediately (without a timer).
+        delay = max(delay, peons.TIMER_RESOLUTION)
+        self._check_timer = self.chore_queue.do(self.check, delay=delay)
 
     def disconnect(self, write_pipe=None):
         """Disconnect the slave by sending a quit request."""
         if self._state not in ('exiting', 'exited'):
             self._state = 'exiting'
+            if self._check_timer is not None:
+                self._check_timer.cancel()
             self.chore_queue.do(self.send_exit, (write_pipe,))
 
     def send_exit(self, write_pipe=None):
@@ -705,11 +892,15 @@ class RemoteSlave(object):
 
 class Slaves(object):
     """List of remote slaves."""
-    def __init__(self, sched_pipe, chore_queue, rpc_timeout, pingdelay):
+    slave_class = RemoteSlave
+
+    def __init__(self, sched_pipe, chore_queue, rpc_timeout, pingdelay,
+            phi_threshold):
         self._sched_pipe = sched_pipe
         self.chore_queue = chore_queue
         self.rpc_timeout = rpc_timeout
         self.pingdelay = pingdelay
+        self.phi_threshold = phi_threshold
 
         self._lock = threading.Lock()
         self._next_slave_id = 0
@@ -746,7 +937,8 @@ class Slaves(object):
                 return None
             slave_id = self._next_slave_id
             self._next_slave_id += 1
-            slave = RemoteSlave(slave_id, host, slave_port, cookie, self)
+            slave = self.slave_class(slave_id, host, slave_port, cookie,
+                    self)
             self._slaves[slave_id] = slave
         return slave
 
@@ -763,7 +955,8 @@ class Slaves(object):
 
         self.trigger_sched()
 
-    def slave_result(self, slave, dataset_id, task_index, urls):
+    def slave_result(self, slave, dataset_id, task_index, urls,
+            sort_path=''):
         """Called when a slave reports a successfully completed assignment.
 
         Note that in the case of retried timeouts, this may be called multiple
@@ -771,7 +964,8 @@ class Slaves(object):
         """
         success = slave.clear_assignment((dataset_id, task_index))
         if success:
-            self._results.append((slave, dataset_id, task_index, urls))
+            self._results.append((slave, dataset_id, task_index, urls,
+                sort_path))
             self._changed_slaves.append(slave)
             self.trigger_sched()
         else:
@@ -791,6 +985,12 @@ class Slaves(object):
         else:
             logger.error("Ignoring a possibly duplicate slave_failed call.")
 
+    def alive_slaves(self):
+        """Returns a list of the slaves that are currently alive."""
+        with self._lock:
+            return [slave for slave in self._slaves.values()
+                    if slave.alive()]
+
     def slave_dead(self, slave):
         self._changed_slaves.append(slave)
         self.trigger_sched()
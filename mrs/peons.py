@@ -18,7 +18,7 @@
 from __future__ import division
 
 import collections
-import heapq
+import math
 import os
 import random
 import sys
@@ -31,6 +31,13 @@ import logging
 logger = logging.getLogger('mrs')
 del logging
 
+# Timers are rounded up to a multiple of the resolution (in seconds).
+TIMER_RESOLUTION = 0.1
+# With 64 slots in each of 4 levels, the wheel covers 64 ** 4 ticks (about
+# 19 days); any later timers wait in an overflow set.
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
 
 class PeonThread(object):
     """The body of each peon thread.
@@ -63,20 +70,169 @@ def start_peon_thread(chore_queue):
     t.start()
 
 
+class Timer(object):
+    """A chore that is scheduled to be done at a given time.
+
+    Returned by `ChoreQueue.do` when a delay is given.
+    """
+    __slots__ = ('queue', 'when', 'item', 'tick', 'slot')
+
+    def __init__(self, queue, when, item):
+        self.queue = queue
+        self.when = when
+        self.item = item
+        self.tick = None
+        # The set that holds the timer in a TimerWheel (if it is pending).
+        self.slot = None
+
+    def pending(self):
+        """Indicates whether the timer has not yet expired or been canceled.
+        """
+        return self.slot is not None
+
+    def cancel(self):
+        """Cancels the chore.
+
+        Returns False if the chore was already started (or canceled).
+        """
+        return self.queue.cancel_timer(self)
+
+    def reset(self, delay):
+        """Reschedules the chore to be done after the given delay.
+
+        Returns False (and does nothing) if the chore was already started (or
+        canceled).
+        """
+        return self.queue.reset_timer(self, delay)
+
+
+class TimerWheel(object):
+    """A hierarchical timing wheel.
+
+    Time is divided into ticks of the given resolution.  Each level of the
+    wheel has the same number of slots, and a slot in level `l` holds the
+    timers that expire in a span of `slots ** l` ticks.  When the wheel
+    reaches the start of such a span, the timers of the slot are cascaded
+    down to the lower levels.  Adding and removing a timer take constant
+    time.  The wheel is not thread-safe.
+    """
+    def __init__(self, now=None, resolution=TIMER_RESOLUTION,
+            slots=WHEEL_SLOTS, levels=WHEEL_LEVELS):
+        if now is None:
+            now = time.time()
+        self.resolution = resolution
+        self._slots = slots
+        self._levels = levels
+        # All timers up to and including this tick have expired.
+        self._tick = int(now / resolution)
+        self._wheels = [[set() for i in range(slots)]
+                for j in range(levels)]
+        self._overflow = set()
+        self._count = 0
+
+    def add(self, timer):
+        """Adds the timer and returns the time when it will expire.
+
+        The expiration time is the timer's time rounded up to a tick.
+        """
+        tick = int(math.ceil(timer.when / self.resolution))
+        timer.tick = max(tick, self._tick + 1)
+        self._place(timer)
+        self._count += 1
+        return timer.tick * self.resolution
+
+    def remove(self, timer):
+        """Removes a pending timer."""
+        timer.slot.remove(timer)
+        timer.slot = None
+        self._count -= 1
+
+    def _place(self, timer):
+        delta = timer.tick - self._tick
+        span = 1
+        for level in range(self._levels):
+            if delta < span * self._slots:
+                slot = self._wheels[level][(timer.tick // span) % self._slots]
+                break
+            span *= self._slots
+        else:
+            slot = self._overflow
+        slot.add(timer)
+        timer.slot = slot
+
+    def advance(self, now):
+        """Advances the wheel to the given time and returns expired timers.
+
+        The timers are returned in order of expiration.
+        """
+        expired = []
+        target = int(now / self.resolution)
+        slots = self._slots
+        while self._count and self._tick < target:
+            self._tick += 1
+            tick = self._tick
+
+            # Cascade from the highest level down.
+            span = slots ** (self._levels - 1)
+            if tick % span == 0:
+                self._cascade(self._overflow)
+            for level in range(self._levels - 1, 0, -1):
+                if tick % span == 0:
+                    self._cascade(self._wheels[level][(tick // span) % slots])
+                span //= slots
+
+            slot = self._wheels[0][tick % slots]
+            if slot:
+                for timer in slot:
+                    timer.slot = None
+                self._count -= len(slot)
+                expired.extend(slot)
+                slot.clear()
+        if not self._count and self._tick < target:
+            self._tick = target
+        return expired
+
+    def _cascade(self, slot):
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._place(timer)
+
+    def next_expiry(self):
+        """Returns the time when the wheel should next be advanced.
+
+        This is when the next timer in the lowest level expires or when the
+        timers of the next slot of a higher level are cascaded (whichever is
+        earlier).  Returns None if there are no timers.
+        """
+        if not self._count:
+            return None
+        slots = self._slots
+        for i in range(1, slots + 1):
+            tick = self._tick + i
+            if self._wheels[0][tick % slots] or tick % slots == 0:
+                return tick * self.resolution
+
+    def __len__(self):
+        return self._count
+
+
 class ChoreQueue(object):
     """An unbounded time-based priority queue of chores for peons.
 
     For the sake of simplicity, the ChoreQueue requires that reschedule() be
     called periodically.  The time_to_reschedule() method gives the number
     of seconds until the next call, and the new_earliest_fd file descriptor
-    is written to whenever this time is reduced.
+    is written to whenever this time is reduced.  Delayed chores are kept in
+    a TimerWheel, so timers that expire in the same tick share a wakeup, and
+    postponing a timer (see `Timer.reset`) never causes a wakeup.
     """
     def __init__(self, new_earliest_fd):
         # Python's collections.deque is officially thread-safe.
         self._q = collections.deque()
         self._q_not_empty = threading.Condition(threading.Lock())
-        self._heap = []
-        self._heaplock = threading.Lock()
+        self._wheel = TimerWheel()
+        self._timerlock = threading.Lock()
 
         self._new_earliest_fd = new_earliest_fd
         self._earliest = None
@@ -85,20 +241,42 @@ class ChoreQueue(object):
         """Run a function with given args.
 
         The action will be performed after a delay (in seconds) if the option
-        is specified.
+        is specified, in which case a Timer is returned.
         """
         item = f, args
         if delay:
-            when = time.time() + delay
-            with self._heaplock:
-                heapq.heappush(self._heap, (when, item))
-
-                if (self._earliest is None) or (when < self._earliest):
-                    self._earliest = when
-                    os.write(self._new_earliest_fd, b'\0')
+            timer = Timer(self, time.time() + delay, item)
+            with self._timerlock:
+                self._add_timer(timer)
+            return timer
         else:
             self._put(item)
 
+    def _add_timer(self, timer):
+        """Adds the timer to the wheel (with the timer lock held)."""
+        expiry = self._wheel.add(timer)
+        if (self._earliest is None) or (expiry < self._earliest):
+            self._earliest = expiry
+            os.write(self._new_earliest_fd, b'\0')
+
+    def cancel_timer(self, timer):
+        """Cancels a timer (see `Timer.cancel`)."""
+        with self._timerlock:
+            if not timer.pending():
+                return False
+            self._wheel.remove(timer)
+            return True
+
+    def reset_timer(self, timer, delay):
+        """Reschedules a timer (see `Timer.reset`)."""
+        with self._timerlock:
+            if not timer.pending():
+                return False
+            self._wheel.remove(timer)
+            timer.when = time.time() + delay
+            self._add_timer(timer)
+            return True
+
     def do_many(self, items):
         """Run the given items, each of which is an (f, args) pair."""
         self._put_many(items)
@@ -131,29 +309,12 @@ class ChoreQueue(object):
             return max(0, earliest - now)
 
     def reschedule(self):
-        """Moves any pending items to the queue."""
-        items = []
+        """Moves any expired timers' items to the queue."""
+        with self._timerlock:
+            timers = self._wheel.advance(time.time())
+            self._earliest = self._wheel.next_expiry()
 
-        with self._heaplock:
-            now = time.time()
-            while True:
-                if self._heap:
-                    when, item = self._heap[0]
-                else:
-                    when = None
-
-                if (when is not None) and (when <= now):
-                    heapq.heappop(self._heap)
-                    items.append(item)
-                else:
-                    break
-
-            if self._heap:
-                self._earliest, _ = self._heap[0]
-            else:
-                self._earliest = None
-
-        self._put_many(items)
+        self._put_many([timer.item for timer in timers])
 
     def _put(self, item):
         """Put the given item on self._q."""
@@ -18,11 +18,14 @@
 from __future__ import division, print_function
 
 import collections
+import multiprocessing
 import os
 import sys
 import time
 
 from . import job
+from . import journal
+from . import lineage
 from . import peons
 from . import computed_data
 from . import serializers
@@ -56,8 +59,8 @@ class BaseRunner(object):
             methods such as run, map, reduce, partition, etc.
         opts: command-line options which are sent to workers
         args: command-line arguments which are sent to workers
-        job_conn: connection (from the multiprocessing module) to/from the
-            job process
+        job_conn: FramedConnection (see `util.framed_pipe`) to/from the
+            job process (None if jobs are started later, as in a service)
         jobdir: optional shared directory for storage of output datasets
         default_dir: temporary directory for storage of output datasets
 
@@ -68,6 +71,10 @@ class BaseRunner(object):
         data_dependents: maps a dataset id to a deque listing datasets that
             cannot start until it has finished
         datasets: maps a dataset id to the corresponding Dataset object
+        result_cache: ResultCache of permanent output from previous runs
+            (None unless the --mrs-result-cache option is given)
+        journal: checkpoint Journal (None unless the --mrs-checkpoint option
+            is given)
     """
 
     def __init__(self, program_class, opts, args, job_conn, jobdir,
@@ -79,22 +86,48 @@ class BaseRunner(object):
         self.jobdir = jobdir
         self.default_dir = default_dir
 
-        self.event_loop = util.EventLoop()
-        self.event_loop.register_fd(self.job_conn.fileno(), self.read_job_conn)
+        self.event_loop = self.make_event_loop()
+        if job_conn is not None:
+            self.job_conn.attach(self.event_loop)
+            self.event_loop.register_fd(self.job_conn.fileno(),
+                    self.read_job_conn)
         if worker_pipe is not None:
             self.worker_pipe = worker_pipe
+            self.worker_pipe.attach(self.event_loop)
             self.event_loop.register_fd(self.worker_pipe.fileno(),
                     self.read_worker_pipe)
 
         self.datasets = {}
         self.data_dependents = collections.defaultdict(collections.deque)
 
+        result_cache = getattr(opts, 'mrs__result_cache', None)
+        if result_cache:
+            self.result_cache = lineage.ResultCache(result_cache)
+        else:
+            self.result_cache = None
+
+        checkpoint = getattr(opts, 'mrs__checkpoint', None)
+        if checkpoint:
+            self.journal = journal.Journal(checkpoint, opts.mrs__resume,
+                    jobdir, default_dir)
+        else:
+            self.journal = None
+
+    def make_event_loop(self):
+        """Creates the event loop that the runner's handlers run on."""
+        return util.EventLoop()
+
     def read_job_conn(self):
         try:
-            message = self.job_conn.recv()
+            messages = self.job_conn.read_messages()
         except EOFError:
+            self.event_loop.unregister_fd(self.job_conn.fileno())
             return
+        for message in messages:
+            self.handle_job_message(message)
 
+    def handle_job_message(self, message):
+        """Handles a message from the job process."""
         if isinstance(message, job.DatasetSubmission):
             ds = message.dataset
             # Fix the breaking of serializers caused by pickling.
@@ -106,19 +139,34 @@ class BaseRunner(object):
             if input_id:
                 self.data_dependents[input_id].append(ds.id)
             if isinstance(ds, computed_data.ComputedData):
-                self.compute_dataset(ds)
+                if not self.restore_result(ds):
+                    self.compute_dataset(ds)
         elif isinstance(message, job.CloseDataset):
             ds = self.datasets[message.dataset_id]
             self.close_dataset(ds)
+        elif isinstance(message, job.CacheDataset):
+            self.datasets[message.dataset_id].cache = True
+        elif isinstance(message, job.Checkpoint):
+            self.save_checkpoint(message.state, message.dataset_ids)
         elif isinstance(message, job.JobDone):
-            if message.exitcode != 0:
-                logger.critical('Job execution failed.')
-            self.exitcode = message.exitcode
-            self.job_conn.send(job.QuitJobProcess())
-            self.event_loop.running = False
+            self.job_done(message.exitcode)
         else:
             assert False, 'Unknown message type.'
 
+    def job_done(self, exitcode):
+        """Called when the job process reports that the job is done."""
+        if exitcode != 0:
+            logger.critical('Job execution failed.')
+        self.exitcode = exitcode
+        if self.journal is not None:
+            self.journal.finish(exitcode == 0)
+        self.job_conn.send(job.QuitJobProcess())
+        self.event_loop.running = False
+
+    def send_to_job(self, dataset_id, message):
+        """Sends a message to the job process that submitted the dataset."""
+        self.job_conn.send(message)
+
     def run(self):
         raise NotImplementedError
 
@@ -126,10 +174,59 @@ class BaseRunner(object):
         """Called when a new ComputedData set is submitted."""
         raise NotImplementedError
 
+    def save_checkpoint(self, state, dataset_ids):
+        """Records the program's state in the checkpoint journal."""
+        logger.warning('Checkpoints are not supported by this runner.')
+
+    def restore_result(self, dataset):
+        """Uses the output of an identical dataset from a previous run.
+
+        Returns True if the dataset's fingerprint was found in the result
+        cache (see `mrs.lineage`) or among the completed datasets in the
+        checkpoint journal (see `mrs.journal`), in which case the dataset is
+        complete.
+        """
+        if dataset.fingerprint is None:
+            return False
+        result = None
+        if self.result_cache is not None and dataset.permanent:
+            result = self.result_cache.lookup(dataset.fingerprint)
+        if result is None and self.journal is not None:
+            result = self.journal.lookup_dataset(dataset.fingerprint)
+        if result is None:
+            return False
+
+        splits, entries = result
+        if dataset.permanent and dataset.dir:
+            # The fingerprint does not include the output directory.
+            entries = lineage.link_entries(entries, dataset.dir)
+            if entries is None:
+                return False
+
+        logger.info('Using previous result for dataset: %s' % dataset.id)
+        dataset.splits = splits
+        for source, split, url in entries:
+            bucket = dataset[source, split]
+            bucket.url = url
+            self.send_to_job(dataset.id, job.BucketReady(dataset.id, bucket))
+        dataset.notify_urls_known()
+        dataset.computation_done()
+        self.send_to_job(dataset.id, job.DatasetComputed(dataset.id, False))
+
+        input_id = dataset.input_id
+        self.data_dependents[input_id].remove(dataset.id)
+        self.try_to_remove_recursive(input_id)
+        return True
+
     def dataset_done(self, dataset):
         """Called when a dataset's computation is finished."""
 
         dataset.computation_done()
+        if (self.result_cache is not None and dataset.permanent and
+                dataset.fingerprint is not None):
+            self.result_cache.store(dataset.fingerprint, dataset)
+        if self.journal is not None and dataset.fingerprint is not None:
+            self.journal.dataset_done(dataset)
 
         # Check whether any datasets can be closed as a result of the newly
         # completed computation.
@@ -139,7 +236,8 @@ class BaseRunner(object):
 
         self.send_dataset_response(dataset)
 
-        # TODO: preface with `if not self.opts.checkpointing:` or similar.
+        # Data needed to resume from a checkpoint are kept by the checkpoint
+        # (see `TaskRunner.save_checkpoint`).
         input_id = getattr(dataset, 'input_id', None)
         # Completing computation decrements the refcount of the input dataset.
         self.data_dependents[input_id].remove(dataset.id)
@@ -150,9 +248,11 @@ class BaseRunner(object):
             for bucket in dataset[:, :]:
                 if len(bucket) or bucket.url:
                     response = job.BucketReady(dataset.id, bucket)
-                    self.job_conn.send(response)
-        response = job.DatasetComputed(dataset.id, not dataset.closed)
-        self.job_conn.send(response)
+                    self.send_to_job(dataset.id, response)
+        # Data that were spilled to disk must be fetched from the urls.
+        fetched = not dataset.closed and dataset._fetched
+        response = job.DatasetComputed(dataset.id, fetched)
+        self.send_to_job(dataset.id, response)
 
     def close_dataset(self, dataset):
         """Close the given dataset, performing any necessary cleanup."""
@@ -266,13 +366,19 @@ class TaskRunner(BaseRunner):
         self.forward_links = collections.defaultdict(set)
         self.transitive_backlinks = collections.defaultdict(set)
         self.task_counter = 0
+        self.sort_path_counter = collections.defaultdict(int)
         self.last_status_time = time.time()
+        self.checkpointed = {}
+
+        self.chore_queue = self.make_chore_queue()
+        self.peon_thread_count = 0
 
+    def make_chore_queue(self):
+        """Creates the queue of chores to be done by peon threads."""
         self.chore_queue_pipe, chore_queue_write_pipe = os.pipe()
         self.event_loop.register_fd(self.chore_queue_pipe,
                 self.read_chore_queue_pipe)
-        self.chore_queue = peons.ChoreQueue(chore_queue_write_pipe)
-        self.peon_thread_count = 0
+        return peons.ChoreQueue(chore_queue_write_pipe)
 
     def start_peon_thread(self):
         """Starts a PeonThread.
@@ -369,7 +475,8 @@ class TaskRunner(BaseRunner):
         backlink_tasks = set()
         done_tasks = set()
 
-        if ds.backlink_id is not None:
+        # Datasets restored from the result cache have no tasklists.
+        if ds.backlink_id in self.tasklists:
             backlink_ds = self.datasets[ds.backlink_id]
             backlink_tasklist = self.tasklists[ds.backlink_id]
             backlink_tasks = backlink_tasklist.async_incomplete()
@@ -398,8 +505,29 @@ class TaskRunner(BaseRunner):
         tasklist = TaskList(ds, input_ds)
         self.tasklists[ds.id] = tasklist
         tasklist.make_tasks(done_tasks, backlink_tasks, incomplete_sources)
+        if self.journal is not None and ds.fingerprint is not None:
+            self.restore_tasks(ds, tasklist)
         return tasklist
 
+    def restore_tasks(self, ds, tasklist):
+        """Marks tasks that were completed in a previous run as done.
+
+        The completed tasks are found in the checkpoint journal.
+        """
+        restored = 0
+        for task_index, outurls in self.journal.completed_tasks(
+                ds.fingerprint):
+            if not tasklist.restore_task(task_index):
+                continue
+            restored += 1
+            for split, url in outurls:
+                bucket = ds[task_index, split]
+                bucket.url = url
+                self.send_to_job(ds.id, job.BucketReady(ds.id, bucket))
+        if restored:
+            logger.info('Restored %s completed tasks of dataset: %s'
+                    % (restored, ds.id))
+
     def task_done(self, dataset_id, task_index, outurls, backlinked=False):
         """Report that the given source of the given dataset is computed.
 
@@ -412,7 +540,11 @@ class TaskRunner(BaseRunner):
             outurls: list of (number, string) pairs representing the split and
                 url of the outputs.
         """
-        tasklist = self.tasklists[dataset_id]
+        tasklist = self.tasklists.get(dataset_id)
+        if tasklist is None:
+            # The dataset was removed before it was complete (see
+            # `remove_dataset`).
+            return False
         if tasklist.is_task_done(task_index):
             return False
 
@@ -426,11 +558,14 @@ class TaskRunner(BaseRunner):
             bucket.url = url
             if not dataset.closed:
                 response = job.BucketReady(dataset_id, bucket)
-                self.job_conn.send(response)
+                self.send_to_job(dataset_id, response)
+        if self.journal is not None and dataset.fingerprint is not None:
+            self.journal.task_done(dataset.fingerprint, task_index,
+                    dataset[task_index, :])
         if tasklist.time_to_report_progress():
             response = job.ProgressUpdate(dataset_id,
                     tasklist.fraction_complete())
-            self.job_conn.send(response)
+            self.send_to_job(dataset_id, response)
         dataset.notify_urls_known()
 
         if tasklist.complete():
@@ -497,7 +632,7 @@ class TaskRunner(BaseRunner):
 
     def send_dataset_response(self, dataset):
         response = job.DatasetComputed(dataset.id, False)
-        self.job_conn.send(response)
+        self.send_to_job(dataset.id, response)
 
     def _runnable_or_pending(self, ds):
         """Add the dataset to runnable or pending list as appropriate.
@@ -515,6 +650,42 @@ class TaskRunner(BaseRunner):
     def schedule(self):
         raise NotImplementedError
 
+    def save_checkpoint(self, state, dataset_ids):
+        """Records the program's state and the datasets needed to resume.
+
+        The files of the datasets are kept until they are superseded by a
+        later checkpoint, even if the datasets are closed and removed.
+        """
+        if self.journal is None:
+            return
+        datasets = [self.datasets[ds_id] for ds_id in dataset_ids]
+        if not self.journal.checkpoint(state, datasets):
+            logger.warning('Skipping a checkpoint with data that are not on'
+                    ' shared storage.')
+            return
+
+        previous = self.checkpointed
+        self.checkpointed = dict((ds.id, ds) for ds in datasets)
+        for ds_id, ds in previous.items():
+            if ds_id not in self.checkpointed and ds_id not in self.datasets:
+                self.delete_checkpointed(ds)
+
+    def delete_checkpointed(self, dataset):
+        """Deletes the files of a removed dataset that is not checkpointed."""
+        self.chore_queue.do(dataset.delete)
+
+    def wants_affinity(self, dataset):
+        """Reports whether tasks should go where their input was computed.
+
+        This is true for datasets created with `affinity=True` and for
+        datasets whose input is cached in the memory of the workers (see
+        `Job.cache_data`).
+        """
+        if getattr(dataset, 'affinity', False):
+            return True
+        input_ds = self.datasets.get(getattr(dataset, 'input_id', None))
+        return getattr(input_ds, 'cache', False)
+
     def available_workers(self):
         """Returns the total number of idle workers."""
         raise NotImplementedError
@@ -525,21 +696,47 @@ class TaskRunner(BaseRunner):
             del self.tasklists[dataset.id]
         except KeyError:
             pass
+        # A dataset that is no longer needed (e.g., because its dependents
+        # were restored from the result cache) may be removed before it is
+        # computed.
+        if dataset in self.runnable_datasets:
+            self.runnable_datasets.remove(dataset)
+        self.pending_datasets.discard(dataset)
         del self.datasets[dataset.id]
         del self.data_dependents[dataset.id]
         if dataset.permanent:
             dataset.clear()
-        else:
+        elif dataset.id not in self.checkpointed:
             self.chore_queue.do(dataset.delete)
+        if getattr(dataset, 'cache', False):
+            self.discard_cached(dataset.id)
+
+    def discard_cached(self, dataset_id):
+        """Asks the workers to drop the dataset from their bucket caches."""
+        raise NotImplementedError
+
+    def record_sort_path(self, sort_path):
+        """Counts a completed task that used the given sort path.
+
+        The sort_path is 'memory' or 'external' (see Task.sort_path), or
+        a false value if the task didn't sort its input.
+        """
+        if sort_path:
+            self.sort_path_counter[sort_path] += 1
 
     def timing_stats(self):
         num_tasks = self.task_counter
         self.task_counter = 0
+        sort_paths = self.sort_path_counter
+        self.sort_path_counter = collections.defaultdict(int)
         now = time.time()
         elapsed_time = now - self.last_status_time
         self.last_status_time = now
         print('TIMING: Completed tasks (since last):',
                 num_tasks, file=sys.stderr)
+        print('TIMING: Sorted tasks by path (since last): memory %s,'
+                ' external %s' % (sort_paths['memory'],
+                    sort_paths['external']), file=sys.stderr)
         print('TIMING: Elapsed time (since last):', elapsed_time,
                 file=sys.stderr)
 
@@ -636,6 +833,20 @@ class TaskList(object):
         """Returns True if the task has been completed."""
         return task_index not in self._remaining_tasks
 
+    def restore_task(self, task_index):
+        """Marks a ready task as done (restored from a previous run).
+
+        The last remaining task is never restored, so that the dataset is
+        completed as usual (by `TaskRunner.task_done`).  Returns whether the
+        task was restored.
+        """
+        if (len(self._remaining_tasks) <= 1 or
+                task_index not in self._ready_tasks):
+            return False
+        self._ready_tasks.remove(task_index)
+        self._remaining_tasks.remove(task_index)
+        return True
+
     def pop(self):
         """Pop off the next available task (or None if none are available).
 
@@ -700,11 +911,144 @@ class MockParallelRunner(TaskRunner, worker.WorkerManager):
 
     def worker_success(self, r):
         """Called when a worker sends a WorkerSuccess."""
+        self.record_sort_path(r.sort_path)
         self.task_done(r.dataset_id, r.task_index, r.outurls)
         self.schedule()
 
+    def discard_cached(self, dataset_id):
+        self.submit_request(worker.WorkerDiscardRequest(dataset_id))
+
     def worker_failure(self, r):
         """Called when a worker sends a WorkerFailure."""
         raise RuntimeError('Task failed')
 
+
+class LocalRunner(TaskRunner):
+    """Runs tasks on a pool of worker processes on the local machine.
+
+    All of the workers share the local temporary directory, so they read
+    their input directly from the paths written by other workers, and no
+    bucket server is needed.
+
+    Attributes:
+        workers: list of LocalWorker objects, one for each worker process
+        task_workers: map from (dataset_id, task_index) to the LocalWorker
+            that completed the task (for slave-task affinity)
+    """
+    def __init__(self, *args):
+        super(LocalRunner, self).__init__(*args)
+        self.workers = []
+        self.task_workers = {}
+
+    def run(self):
+        # The worker processes must be forked before any threads start.
+        worker_count = self.opts.mrs__workers or multiprocessing.cpu_count()
+        self.start_workers(worker_count)
+        try:
+            for _ in range(INITIAL_PEON_THREADS):
+                self.start_peon_thread()
+            for local_worker in self.workers:
+                if not local_worker.worker_setup(self.opts, self.args,
+                        self.default_dir):
+                    return 1
+            self.schedule()
+            self.event_loop.run()
+        finally:
+            self.stop_workers()
+        return self.exitcode
+
+    def start_workers(self, count):
+        """Starts the given number of worker processes."""
+        logger.info('Starting %s worker processes.' % count)
+        for i in range(count):
+            worker_pipe, worker_pipe2 = util.framed_pipe()
+            w = worker.Worker(self.program_class, worker_pipe2)
+            worker_process = multiprocessing.Process(target=w.run,
+                    name='Worker %s' % i)
+            worker_process.start()
+
+            local_worker = LocalWorker(self, worker_pipe, worker_process)
+            self.workers.append(local_worker)
+            worker_pipe.attach(self.event_loop)
+            self.event_loop.register_fd(worker_pipe.fileno(),
+                    local_worker.read_worker_pipe)
+
+    def stop_workers(self):
+        """Asks all worker processes to quit and waits for them."""
+        for local_worker in self.workers:
+            try:
+                local_worker.worker_pipe.send(worker.WorkerQuitRequest())
+            except (IOError, OSError):
+                pass
+        for local_worker in self.workers:
+            local_worker.process.join()
+
+    def schedule(self):
+        """Assigns available tasks to idle workers.
+
+        When a dataset wants affinity, each task is assigned to the worker
+        that computed the same source of the input (if it is idle).
+        """
+        idle_workers = [w for w in self.workers if w.current_task is None]
+        while idle_workers:
+            next_task = self.next_task()
+            if next_task is None:
+                break
+            dataset_id, task_index = next_task
+            ds = self.datasets[dataset_id]
+
+            local_worker = None
+            if self.wants_affinity(ds):
+                key = (ds.input_id, task_index)
+                local_worker = self.task_workers.get(key)
+            if local_worker not in idle_workers:
+                local_worker = idle_workers[0]
+            idle_workers.remove(local_worker)
+
+            task = ds.get_task(task_index, self.datasets, self.jobdir)
+            request = worker.WorkerTaskRequest(*task.to_args())
+            result = local_worker.submit_request(request)
+            assert result
+
+    def available_workers(self):
+        """Returns the total number of idle workers."""
+        return sum(1 for w in self.workers if w.current_task is None)
+
+    def worker_success(self, r):
+        """Called when a worker sends a WorkerSuccess."""
+        self.record_sort_path(r.sort_path)
+        self.task_done(r.dataset_id, r.task_index, r.outurls)
+        self.schedule()
+
+    def worker_failure(self, r):
+        """Called when a worker sends a WorkerFailure."""
+        self.task_lost(r.dataset_id, r.task_index)
+        self.schedule()
+
+    def discard_cached(self, dataset_id):
+        for local_worker in self.workers:
+            local_worker.submit_request(
+                    worker.WorkerDiscardRequest(dataset_id))
+
+    def remove_dataset(self, dataset):
+        for key in [key for key in self.task_workers if key[0] == dataset.id]:
+            del self.task_workers[key]
+        super(LocalRunner, self).remove_dataset(dataset)
+
+
+class LocalWorker(worker.WorkerManager):
+    """Keeps track of a single worker process of a LocalRunner."""
+    def __init__(self, runner, worker_pipe, process):
+        self.runner = runner
+        self.worker_pipe = worker_pipe
+        self.process = process
+        self.current_task = None
+
+    def worker_success(self, r):
+        self.runner.task_workers[r.dataset_id, r.task_index] = self
+        self.runner.worker_success(r)
+
+    def worker_failure(self, r):
+        self.runner.worker_failure(r)
+
 # vim: et sw=4 sts=4
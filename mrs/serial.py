@@ -16,11 +16,14 @@
 """Mrs Serial Runner"""
 
 import multiprocessing
+import os
 import select
+import tempfile
 import threading
 import traceback
 
 from . import runner
+from . import util
 
 import logging
 logger = logging.getLogger('mrs')
@@ -32,6 +35,7 @@ class SerialRunner(runner.BaseRunner):
 
         self.program = None
         self.worker_conn = None
+        self.spill_dir = None
 
     def run(self):
         try:
@@ -41,16 +45,31 @@ class SerialRunner(runner.BaseRunner):
                     % traceback.format_exc())
             return 1
 
-        self.start_worker()
-        self.event_loop.register_fd(self.worker_conn.fileno(),
-                self.read_worker_conn)
+        # The directory is created only if some output is spilled.  An empty
+        # spill_dir keeps all of the data in RAM.
+        spill_root = getattr(self.opts, 'mrs__spill_dir', None)
+        if spill_root is None:
+            spill_root = tempfile.gettempdir()
+        if spill_root:
+            self.spill_dir = os.path.join(spill_root, 'mrs_serial_%s_%s'
+                    % (os.getpid(), util.random_string(6)))
 
-        self.event_loop.run()
+        try:
+            self.start_worker()
+            self.event_loop.register_fd(self.worker_conn.fileno(),
+                    self.read_worker_conn)
+
+            self.event_loop.run()
+        finally:
+            if self.spill_dir and os.path.exists(self.spill_dir):
+                util.remove_recursive(self.spill_dir)
         return self.exitcode
 
     def start_worker(self):
         self.worker_conn, remote_worker_conn = multiprocessing.Pipe()
-        worker = SerialWorker(self.program, self.datasets, remote_worker_conn)
+        max_ram_size = getattr(self.opts, 'mrs__max_ram_size', None)
+        worker = SerialWorker(self.program, self.datasets, remote_worker_conn,
+                self.spill_dir, max_ram_size)
         worker_thread = threading.Thread(target=worker.run,
                 name='Serial Worker')
         worker_thread.daemon = True
@@ -68,9 +87,13 @@ class SerialRunner(runner.BaseRunner):
         """
         try:
             response = self.worker_conn.recv()
-            if isinstance(response, SerialWorkerSuccess):
-                dataset_id = response.dataset_id
-            else:
+            dataset_id = response.dataset_id
+            if dataset_id is not None and dataset_id not in self.datasets:
+                # The dataset was removed while it was computed (e.g.,
+                # because its dependents were restored from the result
+                # cache), so any failure is moot.
+                return
+            if not isinstance(response, SerialWorkerSuccess):
                 logger.error(response.traceback)
                 self.exitcode = 1
                 self.event_loop.running = False
@@ -85,23 +108,30 @@ class SerialRunner(runner.BaseRunner):
 
 
 class SerialWorker(object):
-    def __init__(self, program, datasets, conn):
+    def __init__(self, program, datasets, conn, spill_dir=None,
+            max_ram_size=None):
         self.program = program
         self.datasets = datasets
         self.conn = conn
+        self.spill_dir = spill_dir
+        self.max_ram_size = max_ram_size
 
     def run(self):
         while True:
+            dataset_id = None
             try:
                 try:
                     dataset_id = self.conn.recv()
                 except EOFError:
                     return
-                ds = self.datasets[dataset_id]
-                ds.run_serial(self.program, self.datasets)
+                ds = self.datasets.get(dataset_id)
+                if ds is not None:
+                    ds.run_serial(self.program, self.datasets,
+                            self.spill_dir, self.max_ram_size)
                 response = SerialWorkerSuccess(dataset_id)
             except Exception as e:
-                response = SerialWorkerFailure(e, traceback.format_exc())
+                response = SerialWorkerFailure(dataset_id, e,
+                        traceback.format_exc())
 
             self.conn.send(response)
 
@@ -114,7 +144,8 @@ class SerialWorkerSuccess(object):
 
 class SerialWorkerFailure(object):
     """Failure response from SerialWorker."""
-    def __init__(self, exception, traceback):
+    def __init__(self, dataset_id, exception, traceback):
+        self.dataset_id = dataset_id
         self.exception = exception
         self.traceback = traceback
 
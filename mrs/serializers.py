@@ -15,15 +15,27 @@
 
 from __future__ import division, print_function
 
+from binascii import hexlify, unhexlify
 from collections import namedtuple
 import functools
+import importlib
+import marshal
 import struct
+import sys
 
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+PY3 = sys.version_info[0] == 3
+if PY3:
+    text_type = str
+    int_types = (int,)
+else:
+    text_type = unicode
+    int_types = (int, long)
+
 
 Serializer = namedtuple('Serializer', ('dumps', 'loads'))
 
@@ -68,27 +80,23 @@ class Serializers(object):
 
 
 def from_names(names, program):
-    """Create a Serializers from a pair of names and a MapReduce program."""
+    """Create a Serializers from a pair of names and a MapReduce program.
+
+    Each name is an attribute of the program or a registered name (see
+    `lookup`).
+    """
 
     if not names:
         return None
     key_s_name, value_s_name = names
 
     if key_s_name:
-        try:
-            key_s = getattr(program, key_s_name)
-        except AttributeError:
-            msg = 'Key serializer not an attribute of the program'
-            raise RuntimeError(msg)
+        key_s = lookup(key_s_name, program)
     else:
         key_s = None
 
     if value_s_name:
-        try:
-            value_s = getattr(program, value_s_name)
-        except AttributeError:
-            msg = 'Value serializer not an attribute of the program'
-            raise RuntimeError(msg)
+        value_s = lookup(value_s_name, program)
     else:
         value_s = None
 
@@ -101,7 +109,8 @@ def dumps_functions(serializers):
     Parameters:
         serializers: A Serializers instance (such as a namedtuple) for
             serializing from Python objects to bytes.  If a serializer is None,
-            use pickle.  Otherwise, use the serializer's `dumps` function.
+            use the auto serializer.  Otherwise, use the serializer's `dumps`
+            function.
     """
     if serializers is None:
         key_s = None
@@ -111,12 +120,12 @@ def dumps_functions(serializers):
         value_s = serializers.value_s
 
     if key_s is None:
-        dumps_key = functools.partial(pickle.dumps, protocol=-1)
+        dumps_key = auto_dumps
     else:
         dumps_key = key_s.dumps
 
     if value_s is None:
-        dumps_value = functools.partial(pickle.dumps, protocol=-1)
+        dumps_value = auto_dumps
     else:
         dumps_value = value_s.dumps
 
@@ -129,7 +138,8 @@ def loads_functions(serializers):
     Parameters:
         serializers: A Serializers instance (such as a namedtuple) for
             serializing from Python objects to bytes.  If a serializer is
-            None, use pickle.  Otherwise, use its `dumps` function.
+            None, use the auto serializer.  Otherwise, use its `loads`
+            function.
     """
     if serializers is None:
         key_s = None
@@ -139,18 +149,145 @@ def loads_functions(serializers):
         value_s = serializers.value_s
 
     if key_s is None:
-        loads_key = pickle.loads
+        loads_key = auto_loads
     else:
         loads_key = key_s.loads
 
     if value_s is None:
-        loads_value = pickle.loads
+        loads_value = auto_loads
     else:
         loads_value = value_s.loads
 
     return loads_key, loads_value
 
 
+###############################################################################
+# any picklable object <-> bytes
+
+pickle_serializer = Serializer(functools.partial(pickle.dumps, protocol=-1),
+        pickle.loads)
+
+###############################################################################
+# any picklable object <-> bytes, with compact encodings for common types
+#
+# Ints, floats, strs, bytes, and tuples of these are encoded as a one-byte
+# type tag followed by a payload.  Anything else is pickled (pickles begin
+# with a byte that is never used as a tag).  An object always has the same
+# encoding, so serialized keys can be hashed for partitioning.  A writer may
+# store the tag shared by all of its records in its header and write only the
+# payloads (see `fileformats.BinWriter`).
+
+AUTO_INT = b'i'
+AUTO_FLOAT = b'f'
+AUTO_STR = b's'
+AUTO_BYTES = b'b'
+AUTO_TUPLE = b't'
+
+float_struct = struct.Struct('<d')
+item_len_struct = struct.Struct('<I')
+
+if PY3:
+    def _int_payload(i):
+        return i.to_bytes((i.bit_length() + 8) // 8, 'little', signed=True)
+
+    def _int_from_payload(b):
+        return int.from_bytes(b, 'little', signed=True)
+else:
+    def _int_payload(i):
+        length = (i.bit_length() + 8) // 8
+        if i < 0:
+            i += 1 << (8 * length)
+        return unhexlify('%0*x' % (2 * length, i))[::-1]
+
+    def _int_from_payload(b):
+        i = int(hexlify(b[::-1]), 16)
+        if ord(b[-1]) & 0x80:
+            i -= 1 << (8 * len(b))
+        return i
+
+def _str_payload(s):
+    return s.encode('utf-8')
+
+if PY3:
+    # The default encoding of bytes.decode is UTF-8.
+    _str_from_payload = bytes.decode
+else:
+    def _str_from_payload(b):
+        return b.decode('utf-8')
+
+def _bytes_payload(b):
+    return b
+
+def _tuple_payload(t):
+    parts = []
+    for item in t:
+        data = auto_dumps(item)
+        parts.append(item_len_struct.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+def _tuple_from_payload(b):
+    unpack_from = item_len_struct.unpack_from
+    size = item_len_struct.size
+    items = []
+    pos = 0
+    end = len(b)
+    while pos < end:
+        length, = unpack_from(b, pos)
+        pos += size
+        items.append(auto_loads(b[pos:pos + length]))
+        pos += length
+    return tuple(items)
+
+# Maps types to (tag, payload function) pairs.
+auto_encoders = {
+        float: (AUTO_FLOAT, float_struct.pack),
+        text_type: (AUTO_STR, _str_payload),
+        bytes: (AUTO_BYTES, _bytes_payload),
+        tuple: (AUTO_TUPLE, _tuple_payload),
+        }
+for _int_type in int_types:
+    auto_encoders[_int_type] = (AUTO_INT, _int_payload)
+
+# Maps tags to functions that decode payloads.
+auto_decoders = {
+        AUTO_INT: _int_from_payload,
+        AUTO_FLOAT: lambda b: float_struct.unpack(b)[0],
+        AUTO_STR: _str_from_payload,
+        AUTO_BYTES: bytes,
+        AUTO_TUPLE: _tuple_from_payload,
+        }
+
+def auto_dumps(obj):
+    try:
+        tag, encode = auto_encoders[type(obj)]
+    except KeyError:
+        return pickle.dumps(obj, protocol=-1)
+    return tag + encode(obj)
+
+def auto_loads(b):
+    decode = auto_decoders.get(b[:1])
+    if decode is None:
+        return pickle.loads(b)
+    return decode(b[1:])
+
+def auto_dumps_batch(objs):
+    """Serializes a list of objects, specializing on their type.
+
+    If all of the objects have the same type (with a compact encoding),
+    returns the type's tag and a list of payloads.  Otherwise, returns None
+    and a list of complete encodings.
+    """
+    if objs:
+        obj_type = type(objs[0])
+        entry = auto_encoders.get(obj_type)
+        if entry is not None and all(type(obj) is obj_type for obj in objs):
+            tag, encode = entry
+            return tag, list(map(encode, objs))
+    return None, list(map(auto_dumps, objs))
+
+auto_serializer = Serializer(auto_dumps, auto_loads)
+
 ###############################################################################
 # bytes <-> bytes (no-op)
 
@@ -181,6 +318,31 @@ int_serializer = Serializer(int_dumps, int_loads)
 ###############################################################################
 # struct <-> bytes
 
+class StructSerializer(Serializer):
+    """A Serializer for fixed-width values described by a struct format.
+
+    Since every serialized value has the same size, these can be stored in
+    packed arrays (see `fileformats.StructWriter`).
+
+    Attributes:
+        format: the format string as defined in the `struct` module
+        primitive: True if each value is a single primitive (rather than a
+            tuple of values)
+    """
+    def __new__(cls, dumps, loads, format, primitive):
+        self = super(StructSerializer, cls).__new__(cls, dumps, loads)
+        self.format = format
+        self.primitive = primitive
+        return self
+
+    def __reduce__(self):
+        # Struct objects cannot be pickled, so rebuild from the format.
+        if self.primitive:
+            return make_primitive_serializer, (self.format,)
+        else:
+            return make_struct_serializer, (self.format,)
+
+
 def make_primitive_serializer(format):
     """Create a serializer for a primitive type from a struct format string.
 
@@ -193,7 +355,7 @@ def make_primitive_serializer(format):
     def loads(b):
         return structure.unpack(b)[0]
 
-    return Serializer(structure.pack, loads)
+    return StructSerializer(structure.pack, loads, format, True)
 
 def make_struct_serializer(format):
     """Create a serializer from a struct format string.
@@ -206,7 +368,104 @@ def make_struct_serializer(format):
     def dumps(values):
         return structure.pack(*values)
 
-    return Serializer(dumps, structure.unpack)
+    return StructSerializer(dumps, structure.unpack, format, False)
+
+###############################################################################
+# int <-> bytes (zigzag varint)
+
+def _uvarint_dumps(n):
+    """Encode a non-negative int as a little-endian base-128 varint."""
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _uvarint_loads_from(b, pos=0):
+    """Decode a varint at the given position of a bytearray.
+
+    Returns the int and the position after the varint.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = b[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+_one_byte_varints = [bytes(bytearray([n])) for n in range(0x80)]
+
+def varint_dumps(i):
+    """Encode an int as a zigzag varint (small magnitudes take one byte)."""
+    if i >= 0:
+        n = i << 1
+    else:
+        n = ((-i) << 1) - 1
+    if n < 0x80:
+        return _one_byte_varints[n]
+    return _uvarint_dumps(n)
+
+def varint_loads(b):
+    buf = bytearray(b)
+    if len(buf) == 1:
+        n = buf[0]
+    else:
+        n, _ = _uvarint_loads_from(buf)
+    return (n >> 1) ^ -(n & 1)
+
+varint_serializer = Serializer(varint_dumps, varint_loads)
+
+###############################################################################
+# builtin types and containers <-> bytes
+
+def marshal_dumps(obj):
+    return marshal.dumps(obj, marshal.version)
+
+marshal_serializer = Serializer(marshal_dumps, marshal.loads)
+
+###############################################################################
+# tuple <-> bytes (composed from a serializer for each element)
+
+def make_tuple_serializer(*serializers):
+    """Create a serializer for fixed-length tuples from element serializers.
+
+    Each element is serialized with the corresponding serializer (or left as
+    bytes if the serializer's `dumps` is None) and is prefixed with its
+    length as a varint.
+    """
+    dumps_functions = [s.dumps for s in serializers]
+    loads_functions = [s.loads for s in serializers]
+
+    def dumps(values):
+        if len(values) != len(dumps_functions):
+            raise ValueError('Expected a tuple of length %s'
+                    % len(dumps_functions))
+        parts = []
+        for dumps, value in zip(dumps_functions, values):
+            if dumps is not None:
+                value = dumps(value)
+            parts.append(_uvarint_dumps(len(value)))
+            parts.append(value)
+        return b''.join(parts)
+
+    def loads(b):
+        buf = bytearray(b)
+        values = []
+        pos = 0
+        for loads in loads_functions:
+            length, pos = _uvarint_loads_from(buf, pos)
+            value = bytes(buf[pos:pos + length])
+            pos += length
+            if loads is not None:
+                value = loads(value)
+            values.append(value)
+        return tuple(values)
+
+    return Serializer(dumps, loads)
 
 ###############################################################################
 # Protocol Buffer <-> bytes
@@ -221,10 +480,88 @@ def make_protobuf_serializer(protobuf):
     """
     def protobuf_dumps(message):
         """Dump the given Protocol Buffers message to bytes."""
-        message.SerializeToString()
+        return message.SerializeToString()
 
-    protobuf_loads = protobuf.ParseFromString
+    def protobuf_loads(b):
+        """Load a new Protocol Buffers message from bytes."""
+        message = protobuf()
+        message.ParseFromString(b)
+        return message
 
     return Serializer(protobuf_dumps, protobuf_loads)
 
+###############################################################################
+# Serializer registry
+#
+# Serializers registered by name can be used without being attributes of
+# the program (see `lookup`).  A name of the form "prefix:argument" calls
+# the factory registered for the prefix with the argument.
+
+_named_serializers = {}
+_serializer_names = {}
+_serializer_factories = {}
+
+def register(name, serializer):
+    """Register a serializer under the given name."""
+    _named_serializers[name] = serializer
+    _serializer_names[serializer] = name
+
+def register_factory(prefix, factory):
+    """Register a function that makes a serializer from a string argument.
+
+    The serializer for the name "prefix:argument" is `factory(argument)`.
+    """
+    _serializer_factories[prefix] = factory
+
+def lookup(name, program=None):
+    """Find a serializer by name.
+
+    An attribute of the program takes precedence over a registered name.
+    """
+    if program is not None:
+        try:
+            return getattr(program, name)
+        except AttributeError:
+            pass
+    try:
+        return _named_serializers[name]
+    except KeyError:
+        pass
+
+    prefix, sep, argument = name.partition(':')
+    if sep and prefix in _serializer_factories:
+        serializer = _serializer_factories[prefix](argument)
+        register(name, serializer)
+        return serializer
+    raise RuntimeError('Unknown serializer: %s' % name)
+
+def registered_name(serializer):
+    """Return the name of a registered serializer (or None)."""
+    try:
+        return _serializer_names.get(serializer)
+    except TypeError:
+        return None
+
+def _make_tuple_from_names(names):
+    return make_tuple_serializer(*[lookup(name) for name in names.split(',')])
+
+def _make_protobuf_from_path(path):
+    module_name, _, class_name = path.rpartition('.')
+    module = importlib.import_module(module_name)
+    return make_protobuf_serializer(getattr(module, class_name))
+
+for _name, _serializer in (('auto_serializer', auto_serializer),
+        ('pickle_serializer', pickle_serializer),
+        ('raw_serializer', raw_serializer),
+        ('str_serializer', str_serializer),
+        ('int_serializer', int_serializer),
+        ('varint_serializer', varint_serializer),
+        ('marshal_serializer', marshal_serializer)):
+    register(_name, _serializer)
+
+register_factory('struct', make_struct_serializer)
+register_factory('primitive', make_primitive_serializer)
+register_factory('tuple', _make_tuple_from_names)
+register_factory('protobuf', _make_protobuf_from_path)
+
 # vim: et sw=4 sts=4
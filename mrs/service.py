@@ -0,0 +1,306 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mrs Service
+
+A service is a resident master: slaves sign in to it once, and any number
+of jobs are submitted to it over its RPC port (see the Submit
+implementation).  Each job runs in its own job process on the service host,
+and the tasks of all running jobs are multiplexed onto the shared pool of
+slaves, with fair-share scheduling across jobs.
+
+The map and reduce functions on the slaves use a program instance that is
+created with the service's options and args, so the options and args of a
+submitted job only affect its run method (which runs in the job process).
+"""
+
+from __future__ import division, print_function
+
+import collections
+import multiprocessing
+import optparse
+import os
+import threading
+
+from . import job
+from . import master
+from . import util
+from .version import __version__
+
+import logging
+logger = logging.getLogger('mrs')
+del logging
+
+
+class ServiceJob(object):
+    """A job submitted to the service.
+
+    Attributes:
+        id: integer id of the job
+        opts: optparse.Values for the job (the service's options updated
+            with the submitted user options)
+        args: list of command-line arguments
+        state: 'queued', 'running', or 'done'
+        exitcode: exit code reported by the job (once it is done)
+        running: number of tasks that are assigned but not yet completed
+        dataset_ids: set of ids of the job's open datasets
+    """
+    def __init__(self, job_id, opts, args):
+        self.id = job_id
+        self.opts = opts
+        self.args = args
+        self.state = 'queued'
+        self.exitcode = None
+        self.running = 0
+        self.dataset_ids = set()
+
+        self.process = None
+        self.conn = None
+        self.quit_pipe = None
+        self.default_dir = None
+
+
+class ServiceRunner(master.MasterRunner):
+    """A MasterRunner that runs many submitted jobs on one pool of slaves.
+
+    The `start_job_process` attribute must be set to a function that takes
+    (opts, args, default_dir), starts a job process, and returns a
+    (process, conn, quit_pipe) triple (see
+    `Implementation.start_job_process`).
+
+    Attributes:
+        jobs: map from a job id to the corresponding ServiceJob
+        dataset_jobs: map from a dataset id to the ServiceJob that submitted
+            it
+    """
+    def __init__(self, *args):
+        super(ServiceRunner, self).__init__(*args)
+        self.exitcode = 0
+        self.start_job_process = None
+
+        self.jobs = {}
+        self.dataset_jobs = {}
+        self._queued_jobs = collections.deque()
+        self._jobs_lock = threading.Lock()
+        self._job_counter = 0
+
+        self.submit_pipe, self._submit_write_pipe = os.pipe()
+        self.event_loop.register_fd(self.submit_pipe, self.read_submit_pipe)
+
+    def make_rpc_interface(self, program_hash):
+        return ServiceInterface(self, self.slaves, program_hash, self.opts,
+                self.args, self.jobdir)
+
+    def submit_job(self, optdict, args):
+        """Queues a job to be started by the runner.
+
+        The user options in optdict override the service's options.  Returns
+        the id of the new job.  Called from the RPC thread.
+        """
+        opts = optparse.Values(vars(self.opts))
+        for name, value in optdict.items():
+            if not name.startswith('mrs__'):
+                setattr(opts, name, value)
+
+        with self._jobs_lock:
+            self._job_counter += 1
+            svc_job = ServiceJob(self._job_counter, opts, args)
+            self.jobs[svc_job.id] = svc_job
+            self._queued_jobs.append(svc_job)
+        os.write(self._submit_write_pipe, b'\0')
+        logger.info('Received job %s.' % svc_job.id)
+        return svc_job.id
+
+    def job_status(self, job_id):
+        """Returns the state and exit code of a job (-1 if not done).
+
+        Called from the RPC thread.
+        """
+        with self._jobs_lock:
+            svc_job = self.jobs.get(job_id)
+            if svc_job is None:
+                return 'unknown', -1
+            if svc_job.state == 'done':
+                return svc_job.state, svc_job.exitcode
+            return svc_job.state, -1
+
+    def read_submit_pipe(self):
+        """Starts any newly submitted jobs."""
+        os.read(self.submit_pipe, 4096)
+        while True:
+            with self._jobs_lock:
+                if not self._queued_jobs:
+                    break
+                svc_job = self._queued_jobs.popleft()
+            self.start_job(svc_job)
+
+    def start_job(self, svc_job):
+        """Starts the job process for the given job."""
+        if self.default_dir:
+            svc_job.default_dir = util.mktempdir(self.default_dir,
+                    'job_%s_' % svc_job.id)
+        process, conn, quit_pipe = self.start_job_process(svc_job.opts,
+                svc_job.args, svc_job.default_dir)
+        svc_job.process = process
+        svc_job.conn = conn
+        svc_job.quit_pipe = quit_pipe
+        with self._jobs_lock:
+            svc_job.state = 'running'
+        conn.attach(self.event_loop)
+        self.event_loop.register_fd(conn.fileno(),
+                lambda: self.read_service_job_conn(svc_job))
+        logger.info('Started job %s.' % svc_job.id)
+
+    def read_service_job_conn(self, svc_job):
+        try:
+            messages = svc_job.conn.read_messages()
+        except EOFError:
+            logger.error('Job %s exited unexpectedly.' % svc_job.id)
+            self.finish_job(svc_job, 1)
+            return
+
+        for message in messages:
+            if isinstance(message, job.DatasetSubmission):
+                ds_id = message.dataset.id
+                self.dataset_jobs[ds_id] = svc_job
+                svc_job.dataset_ids.add(ds_id)
+            elif isinstance(message, job.JobDone):
+                self.finish_job(svc_job, message.exitcode)
+                return
+            self.handle_job_message(message)
+
+    def finish_job(self, svc_job, exitcode):
+        """Stops the job process and closes any datasets left open."""
+        if exitcode != 0:
+            logger.error('Job %s failed.' % svc_job.id)
+        else:
+            logger.info('Job %s completed.' % svc_job.id)
+        self.event_loop.unregister_fd(svc_job.conn.fileno())
+        try:
+            svc_job.conn.send(job.QuitJobProcess())
+        except (IOError, OSError):
+            pass
+        os.write(svc_job.quit_pipe, b'\0')
+        os.close(svc_job.quit_pipe)
+        svc_job.conn.close()
+        with self._jobs_lock:
+            svc_job.state = 'done'
+            svc_job.exitcode = exitcode
+
+        for ds_id in list(svc_job.dataset_ids):
+            ds = self.datasets.get(ds_id)
+            if ds is not None and not ds.closed:
+                self.close_dataset(ds)
+        if not svc_job.dataset_ids:
+            self.remove_job_dir(svc_job)
+        # Reap the job process (and any others that have exited).
+        multiprocessing.active_children()
+        self.schedule()
+
+    def send_to_job(self, dataset_id, message):
+        svc_job = self.dataset_jobs.get(dataset_id)
+        if svc_job is not None and svc_job.state == 'running':
+            svc_job.conn.send(message)
+
+    def remove_dataset(self, dataset):
+        svc_job = self.dataset_jobs.pop(dataset.id, None)
+        super(ServiceRunner, self).remove_dataset(dataset)
+        if svc_job is not None:
+            svc_job.dataset_ids.discard(dataset.id)
+            if svc_job.state == 'done' and not svc_job.dataset_ids:
+                self.remove_job_dir(svc_job)
+
+    def remove_job_dir(self, svc_job):
+        if svc_job.default_dir and not self.opts.mrs__keep_tmp:
+            self.chore_queue.do(util.remove_recursive,
+                    (svc_job.default_dir,))
+        svc_job.default_dir = None
+
+    def next_task(self):
+        """Returns the next task from the job with the fewest running tasks.
+
+        Jobs with the same number of running tasks are served in the order
+        in which their datasets became runnable.
+        """
+        job_datasets = collections.OrderedDict()
+        for ds in self.runnable_datasets:
+            svc_job = self.dataset_jobs.get(ds.id)
+            job_datasets.setdefault(svc_job, []).append(ds)
+
+        for svc_job in sorted(job_datasets, key=_running_tasks):
+            for ds in job_datasets[svc_job]:
+                try:
+                    tasklist = self.tasklists[ds.id]
+                except KeyError:
+                    tasklist = self.make_tasklist(ds)
+                t = tasklist.pop()
+                if t is not None:
+                    if svc_job is not None:
+                        svc_job.running += 1
+                    return t
+                if self.opts.mrs__sequential_datasets:
+                    break
+        return None
+
+    def task_done(self, dataset_id, task_index, outurls, backlinked=False):
+        svc_job = self.dataset_jobs.get(dataset_id)
+        success = super(ServiceRunner, self).task_done(dataset_id,
+                task_index, outurls, backlinked)
+        if success and not backlinked and svc_job is not None:
+            svc_job.running = max(svc_job.running - 1, 0)
+        return success
+
+    def task_lost(self, dataset_id, task_index):
+        svc_job = self.dataset_jobs.get(dataset_id)
+        if svc_job is not None:
+            svc_job.running = max(svc_job.running - 1, 0)
+        super(ServiceRunner, self).task_lost(dataset_id, task_index)
+
+
+def _running_tasks(svc_job):
+    if svc_job is None:
+        return 0
+    return svc_job.running
+
+
+class ServiceInterface(master.MasterInterface):
+    """Public XML-RPC Interface of a service.
+
+    In addition to the master's interface for slaves, it accepts job
+    submissions and reports their status.
+    """
+    def __init__(self, runner, *args):
+        super(ServiceInterface, self).__init__(*args)
+        self.runner = runner
+
+    def xmlrpc_submit(self, version, program_hash, optdict, args):
+        """Submits a job with the given user options and args.
+
+        Returns the job id, or -1 if the job is rejected.
+        """
+        if version != __version__:
+            logger.warning('Job submitted with mismatched version.')
+            return -1
+        if self.program_hash != program_hash:
+            logger.warning('Job submitted with nonmatching code.')
+            return -1
+        return self.runner.submit_job(optdict, args)
+
+    def xmlrpc_status(self, job_id):
+        """Returns the state of the job and its exit code (-1 if not done).
+        """
+        return self.runner.job_status(job_id)
+
+# vim: et sw=4 sts=4
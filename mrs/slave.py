@@ -23,21 +23,30 @@ and waits for them to finish.  If the user hits CTRL-C, the main thread will
 be interrupted, and it will shut down the event thread.  The only reason that
 the main thread exists at all is to deal with signals.
 
+While the slave is signed in, a heartbeat thread periodically sends the
+slave's status to the master.  The master does not ping slaves; it treats
+any message from a slave as evidence that the slave is alive.
+
 The worker process executes the user's map function and reduce function.
 That's it.  It just does what the main process tells it to.  The worker
 process is terminated when the main process exits.
 """
 
-# Number of ping timeouts before giving up:
-PING_ATTEMPTS = 50
-
 COOKIE_LEN = 8
 
+# Seconds between attempts to sign in to a master in daemon mode:
+SIGNIN_RETRY_DELAY = 5
+# Heartbeat intervals without reaching the master before the slave gives up
+# (about when the master's failure detector gives up on the slave with the
+# default phi threshold):
+HEARTBEAT_GRACE = 2.4
+
 import datetime
 import multiprocessing
 import optparse
 import socket
 import threading
+import time
 
 from . import bucket
 from . import http
@@ -46,6 +55,11 @@ from . import util
 from . import worker
 from .version import __version__
 
+try:
+    from xmlrpc.client import Fault
+except ImportError:
+    from xmlrpclib import Fault
+
 from logging import getLogger
 logger = getLogger('mrs')
 
@@ -53,16 +67,22 @@ logger = getLogger('mrs')
 class Slave(worker.WorkerManager):
     """State of a Mrs slave
 
+    In daemon mode, the slave keeps running after the master asks it to
+    exit, and it signs in again (to the next master at the same url) so
+    that the worker and its program stay warm between jobs.
+
     Attributes:
         _outdirs: map from a (dataset_id, source) pair to an output directory
     """
     def __init__(self, program_class, master_url, tmpdir, pingdelay,
-            timeout, worker_pipe):
+            timeout, worker_pipe, daemon=False, worker_pid=None):
         self.program_class = program_class
         self.master_url = master_url
         self.tmpdir = tmpdir
         self.pingdelay = pingdelay
         self.timeout = timeout
+        self.daemon = daemon
+        self.worker_pid = worker_pid
 
         self.id = None
         self.cookie = util.random_string(COOKIE_LEN)
@@ -70,11 +90,16 @@ class Slave(worker.WorkerManager):
         self.watchdog_stamp = None
         self.rpc_port = None
         self.bucket_port = None
+        self.bucket_server = None
         self.master_rpc = None
+        # Serializes calls on master_rpc (the heartbeats use their own proxy).
+        self._master_lock = threading.Lock()
+        self._heartbeat_stop = None
         self.url_converter = None
 
         self.setup_complete = False
         self.current_task = None
+        self.task_started = None
         self._outdirs = {}
         self._outdirs_lock = threading.Lock()
 
@@ -88,35 +113,75 @@ class Slave(worker.WorkerManager):
 
     def run(self):
         self.start_rpc_server_thread()
-        self.master_rpc = http.TimeoutServerProxy(self.master_url, self.timeout)
 
+        while True:
+            exitcode = self.run_job()
+            if not self.daemon:
+                return exitcode
+            if exitcode is None:
+                time.sleep(SIGNIN_RETRY_DELAY)
+            self.reset()
+
+    def run_job(self):
+        """Signs in to the master and runs tasks until asked to exit.
+
+        Returns 0 on success or None if signin or setup failed.
+        """
+        # A new proxy avoids reusing a connection to a previous master.
+        self.master_rpc = http.TimeoutServerProxy(self.master_url, self.timeout)
         result = self.signin()
         if not result:
             return
         self.id, addr, jobdir, opts, args = result
         default_dir = self.init_default_dir(jobdir)
 
-        if not jobdir:
-            self.start_bucket_server_thread(default_dir)
-            self.url_converter = bucket.URLConverter(addr, self.bucket_port,
-                    default_dir)
-
-        # Tell the Worker to run the user_setup function and wait for
-        # a response.
-        if not self.worker_setup(opts, args, default_dir):
-            return
-
-        self.setup_complete = True
-
-        # TODO: start a ping and/or watchdog thread
-
-        self.report_ready()
         try:
+            # The master's heartbeat interval is used so that its failure
+            # detector knows what to expect.
+            interval = getattr(opts, 'mrs__pingdelay', None) or self.pingdelay
+            self.start_heartbeat_thread(interval)
+
+            if not jobdir:
+                if self.bucket_server is None:
+                    self.start_bucket_server_thread(default_dir)
+                else:
+                    self.bucket_server.basedir = default_dir
+                self.url_converter = bucket.URLConverter(addr,
+                        self.bucket_port, default_dir)
+
+            # Tell the Worker to run the user_setup function and wait for
+            # a response.
+            if not self.worker_setup(opts, args, default_dir):
+                return
+
+            self.setup_complete = True
+
+            self.report_ready()
+            self.event_loop.running = True
             self.event_loop.run()
         finally:
-            util.remove_recursive(default_dir)
+            self.stop_heartbeat_thread()
+            # A task from a master that was lost may still be writing to
+            # the default directory.
+            self.wait_for_task()
+            # With a checkpoint journal, files in the shared job directory
+            # are needed to resume if the master fails (on success, the
+            # master removes the job directory).
+            if not (jobdir and getattr(opts, 'mrs__checkpoint', None)):
+                util.remove_recursive(default_dir)
         return 0
 
+    def reset(self):
+        """Forgets the state of the previous job (in daemon mode)."""
+        self.id = None
+        self.cookie = util.random_string(COOKIE_LEN)
+        self.url_converter = None
+        self.setup_complete = False
+        self.current_task = None
+        self.task_started = None
+        with self._outdirs_lock:
+            self._outdirs.clear()
+
     def start_rpc_server_thread(self):
         rpc_interface = SlaveInterface(self)
         rpc_server = http.RPCServer(('', 0), rpc_interface)
@@ -130,12 +195,89 @@ class Slave(worker.WorkerManager):
     def start_bucket_server_thread(self, default_dir):
         bucket_server = http.ThreadingBucketServer(('', 0), default_dir)
         _, self.bucket_port = bucket_server.socket.getsockname()
+        self.bucket_server = bucket_server
 
         bucket_thread = threading.Thread(target=bucket_server.serve_forever,
                 name='Bucket Server')
         bucket_thread.daemon = True
         bucket_thread.start()
 
+    def start_heartbeat_thread(self, interval):
+        """Starts a thread that sends a heartbeat every `interval` seconds.
+
+        The heartbeats use their own connection to the master, so they
+        neither wait for nor delay the slave's other messages.
+        """
+        stop = threading.Event()
+        self._heartbeat_stop = stop
+        heartbeat_thread = threading.Thread(target=self.heartbeat_loop,
+                args=(interval, stop), name='Heartbeat')
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+    def stop_heartbeat_thread(self):
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_stop = None
+
+    def heartbeat_loop(self, interval, stop):
+        """Sends heartbeats until `stop` is set.
+
+        A heartbeat that fails is retried at the next interval.  If the
+        master answers that it no longer knows the slave, or if it can't be
+        reached for HEARTBEAT_GRACE intervals, the slave exits (in daemon
+        mode, it then signs in to the next master).
+        """
+        master_rpc = http.TimeoutServerProxy(self.master_url, self.timeout)
+        last_reached = time.time()
+        while not stop.wait(interval):
+            try:
+                known = master_rpc.heartbeat(self.id, self.cookie,
+                        self.status())
+            except Fault as f:
+                logger.error('Fault in heartbeat to master: %s'
+                        % f.faultString)
+                known = None
+            except (socket.error, http.ConnectionFailed) as e:
+                logger.error('Unable to send a heartbeat to master at'
+                        ' %s: %s' % (self.master_url, e))
+                known = None
+            if stop.is_set():
+                return
+
+            now = time.time()
+            if known:
+                last_reached = now
+                continue
+            if known is None:
+                if now - last_reached < HEARTBEAT_GRACE * interval:
+                    continue
+                logger.critical('Lost contact with the master.')
+            else:
+                logger.critical('The master no longer knows this slave.')
+            self.exit()
+            return
+
+    def status(self):
+        """Returns the status dict that is sent with each heartbeat.
+
+        It includes the current task (an empty list if idle), the seconds
+        spent on it so far, the number of tasks queued at the slave (which
+        works on one task at a time), and the resident memory of the worker
+        in kB (if known).
+        """
+        task = self.current_task
+        status = {'task': [], 'queue': 0}
+        if task is not None:
+            status['task'] = list(task)
+            status['queue'] = 1
+            if self.task_started is not None:
+                status['elapsed'] = time.time() - self.task_started
+        rss = util.ram_usage(self.worker_pid)
+        if rss is not None:
+            status['rss'] = rss
+        return status
+
     def signin(self):
         """Start Slave RPC Server and sign in to master.
 
@@ -148,7 +290,7 @@ class Slave(worker.WorkerManager):
         try:
             slave_id, addr, jobdir, optdict, args = self.master_rpc.signin(
                     __version__, cookie, self.rpc_port, program_hash)
-        except socket.error as e:
+        except (socket.error, http.ConnectionFailed) as e:
             msg = str(e)
             logger.critical('Unable to contact master at %s: %s' %
                     (self.master_url, msg))
@@ -182,7 +324,8 @@ class Slave(worker.WorkerManager):
         assert self.current_task is None
 
         try:
-            self.master_rpc.ready(self.id, self.cookie)
+            with self._master_lock:
+                self.master_rpc.ready(self.id, self.cookie)
         except socket.error as e:
             msg = e.args[0]
             logger.critical('Failed to report due to network error: %s' % msg)
@@ -197,14 +340,16 @@ class Slave(worker.WorkerManager):
         if self.url_converter:
             convert_url = self.url_converter.local_to_global
             outurls = [(s, convert_url(url)) for s, url in outurls]
-        self.master_rpc.done(self.id, r.dataset_id, r.task_index, outurls,
-                self.cookie)
+        with self._master_lock:
+            self.master_rpc.done(self.id, r.dataset_id, r.task_index,
+                    outurls, self.cookie, r.sort_path or '')
 
     def worker_failure(self, r):
         """Called when a worker sends a WorkerFailure."""
         try:
-            self.master_rpc.failed(self.id, r.dataset_id, r.task_index,
-                    self.cookie)
+            with self._master_lock:
+                self.master_rpc.failed(self.id, r.dataset_id, r.task_index,
+                        self.cookie)
         except socket.error as e:
             msg = e.args[0]
             logger.critical('Failed to report due to network error: %s' % msg)
@@ -213,6 +358,7 @@ class Slave(worker.WorkerManager):
         self.update_timestamp()
 
     def read_exit_pipe(self):
+        self.exit_pipe_recv.recv()
         self.event_loop.running = False
 
     def update_timestamp(self):
@@ -255,7 +401,8 @@ class SlaveInterface(object):
 
     @http.uses_host
     def xmlrpc_start_task(self, op_args, urls, dataset_id, task_index, splits,
-            storage, ext, input_ser_names, ser_names, cookie, host=None):
+            storage, ext, input_ser_names, ser_names, input_cache_id,
+            cache_output, cookie, host=None):
         self.slave.check_cookie(cookie)
         self.slave.update_timestamp()
         op_name = op_args[0]
@@ -267,8 +414,12 @@ class SlaveInterface(object):
             urls = [convert_url(url, host) for url in urls]
 
         request = worker.WorkerTaskRequest(op_args, urls, dataset_id,
-                task_index, splits, storage, ext, input_ser_names, ser_names)
-        return self.slave.submit_request(request)
+                task_index, splits, storage, ext, input_ser_names, ser_names,
+                input_cache_id, cache_output)
+        accepted = self.slave.submit_request(request)
+        if accepted:
+            self.slave.task_started = time.time()
+        return accepted
 
     def xmlrpc_remove(self, dataset_id, source, delete, cookie):
         self.slave.check_cookie(cookie)
@@ -283,6 +434,13 @@ class SlaveInterface(object):
 
         return success
 
+    def xmlrpc_discard(self, dataset_id, cookie):
+        self.slave.check_cookie(cookie)
+        self.slave.update_timestamp()
+        logger.debug('Received discard request: %s' % dataset_id)
+        request = worker.WorkerDiscardRequest(dataset_id)
+        return self.slave.submit_request(request)
+
     def xmlrpc_exit(self, cookie):
         self.slave.check_cookie(cookie)
         self.slave.update_timestamp()
@@ -292,14 +450,6 @@ class SlaveInterface(object):
         self.slave.exit()
         return True
 
-    def xmlrpc_ping(self, cookie):
-        """Master checking if we're still here.
-        """
-        self.slave.check_cookie(cookie)
-        self.slave.update_timestamp()
-        logger.debug('Received a ping from the master.')
-        return True
-
 
 class CookieValidationError(Exception):
     pass
@@ -20,8 +20,10 @@ A Task represents a unit of work and the mechanism for carrying it out.
 
 from __future__ import division, print_function
 
+import collections
 import copy
 import itertools
+import multiprocessing
 from operator import itemgetter
 
 from . import datasets
@@ -32,6 +34,11 @@ from . import util
 from logging import getLogger
 logger = getLogger('mrs')
 
+# Input records are sent to the process pool of a parallel map in chunks
+# that start small (so all of the processes get busy quickly) and double in
+# size up to this limit.
+MAX_PARALLEL_CHUNK = 1024
+
 
 class Task(object):
     """Manage input and output for a piece of a map or reduce operation.
@@ -54,6 +61,10 @@ class Task(object):
         self.outdir = None
         self.output = None
         self.sorted_ds = None
+        self.sort_path = None
+        self.input_cached = False
+        self.cache_output = False
+        self.output_cache = None
 
     def outurls(self):
         return [(b.split, b.url) for b in self.output[:, :] if b.url]
@@ -64,12 +75,18 @@ class Task(object):
 
     @staticmethod
     def from_args(op_args, urls, dataset_id, task_index, splits, storage,
-            ext, input_ser_names, ser_names, program):
+            ext, input_ser_names, ser_names, input_cache_id, cache_output,
+            program, cache=None):
         """Converts from a simple tuple to a Task.
 
         The elements of the tuple correspond to the arguments of the
         Task.__init__ method, with the difference that the first argument
-        is an Operation args tuple, and the second is a list of urls.
+        is an Operation args tuple, and the second is a list of urls.  If
+        the input dataset is cached (`input_cache_id` is its id) and a
+        BucketCache is given, then the input is read through the cache (or
+        from the urls as usual if it doesn't fit in the cache).  If
+        `cache_output` is true, then the output is kept in RAM to be added
+        to the cache (see `save_output_to_cache`).
         """
         op = Operation.from_args(*op_args)
 
@@ -78,8 +95,20 @@ class Task(object):
 
         input_ds = datasets.FileData(urls, program, splits=1,
                 first_split=task_index, serializers=input_serializers)
-        return Task.from_op(op, input_ds, dataset_id, task_index, splits,
+        task = Task.from_op(op, input_ds, dataset_id, task_index, splits,
                 storage, ext, output_serializers)
+        if cache is not None and input_cache_id:
+            buckets = [b for b in input_ds[:, :] if b.url]
+            if all(cache.load(b, input_cache_id) for b in buckets):
+                task.input_cached = True
+            else:
+                # Input that doesn't all fit is streamed from the urls.
+                for b in buckets:
+                    b._data = []
+        if cache is not None and cache_output:
+            task.cache_output = True
+            task.output_cache = cache
+        return task
 
     def to_args(self):
         """Converts the Task to a simple tuple.
@@ -88,7 +117,9 @@ class Task(object):
         method.  The first two elements of the tuples are lists of strings.
         The first is a list-of-strings representation of an operation, and the
         second is a list of urls.  The remaining elements are identical
-        to the corresponding elements of the init method.
+        to the corresponding elements of the init method, followed by the id
+        of the input dataset if its buckets should be cached (or '') and by
+        whether the output should be cached.
         """
         op_args = self.op.to_args()
         urls = [b.url for b in self.input_ds[:, self.task_index] if b.url]
@@ -107,35 +138,74 @@ class Task(object):
         else:
             ser_names = ''
 
+        if getattr(self.input_ds, 'cache', False):
+            input_cache_id = self.input_ds.id
+        else:
+            input_cache_id = ''
+
         return (op_args, urls, self.dataset_id, self.task_index, self.splits,
-                self.storage, self.ext, input_ser_names, ser_names)
+                self.storage, self.ext, input_ser_names, ser_names,
+                input_cache_id, self.cache_output)
 
-    def _get_all_input(self, serial, sort=False, default_dir=None,
+    def _get_all_input(self, program, serial, sort=False, default_dir=None,
             max_sort_size=None):
-        """Returns an iterator over all input data."""
-        if serial:
-            self.input_ds.fetchall(_called_in_runner=True)
-            uncopied_data = self.input_ds.data()
-            # Avoid subtle race conditions in serial MapReduce when objects
-            # are mutable by recklessly copying everything.  In the future, we
-            # might make this disableable, but performance in serial MapReduce
-            # is not a high priority.
-            data = (copy.deepcopy(x) for x in uncopied_data)
+        """Returns an iterator over all input data.
+
+        In serial mode, input that was spilled to disk is sorted externally
+        like in the parallel case.  Input from a worker's bucket cache is
+        already in RAM, so it is handled like serial input.
+        """
+        in_memory = serial or self.input_cached
+        spilled = serial and any(b.spilled for b in self.input_ds[:, :])
+        if in_memory and not (sort and spilled):
+            data = self.input_ds.stream_data(_called_in_runner=True)
+            # In serial MapReduce (or with cached input), records are shared
+            # with the input dataset in RAM, so they are copied only if the
+            # program declares that it modifies them (see mrs.mutates_input).
+            if self.op.mutates_input(program):
+                data = (copy.deepcopy(x) for x in data)
             if sort:
                 data = sorted(data, key=itemgetter(0))
+                self.sort_path = 'memory'
         elif sort:
             tmpdir = util.mktempdir(default_dir, 'merge_%s_' % self.dataset_id)
             sorted_ds = datasets.MergeSortData(self.input_ds, self.task_index,
                     max_sort_size, dir=tmpdir, _called_in_runner=True)
             data = sorted_ds.stream_data(_called_in_runner=True)
             self.sorted_ds = sorted_ds
+            if sorted_ds.in_memory:
+                self.sort_path = 'memory'
+            else:
+                self.sort_path = 'external'
+            logger.debug('Task %s of dataset %s used the %s sort path'
+                    % (self.task_index, self.dataset_id, self.sort_path))
         else:
             data = self.input_ds.stream_split(self.task_index,
                     _called_in_runner=True)
         return data
 
-    def _outdata_kwds(self, program, permanent, serial):
+    def _get_input_arrays(self, program, serial):
+        """Returns an iterator over all input data as (keys, values) arrays.
+
+        In parallel mode, the arrays are read directly from the input files
+        (see `fileformats.Reader.iter_arrays`).
+        """
+        if serial:
+            data = self._get_all_input(program, serial)
+            return (fileformats.pairs_to_arrays(batch) for batch in
+                    fileformats.batches(data, fileformats.VECTOR_BATCH_SIZE))
+        else:
+            buckets = [b for b in self.input_ds[:, self.task_index] if b.url]
+            return itertools.chain.from_iterable(b.stream_arrays()
+                    for b in buckets)
+
+    def _outdata_kwds(self, program, permanent, serial, default_dir=None,
+            max_sort_size=None):
         """Returns arguments for the output dataset (common to all task types).
+
+        In serial mode, output is kept in RAM up to max_sort_size MB per
+        bucket and is then spilled to a file in the default_dir.  Output that
+        will be cached is kept in RAM up to the size of the cache.
         """
         kwds = {'source': self.task_index,
                 'parter': self.op.parter(program),
@@ -145,17 +215,49 @@ class Task(object):
                 'splits': self.splits,
                 }
         if not serial:
-            kwds['write_only'] = True
+            if self.output_cache is not None:
+                kwds['max_ram_bytes'] = self.output_cache.max_bytes
+            else:
+                kwds['write_only'] = True
+        elif max_sort_size is not None:
+            kwds['spill_dir'] = default_dir
+            kwds['max_ram_bytes'] = 1024 * 1024 * max_sort_size
         return kwds
 
-    def make_outdir(self, default_dir):
+    def save_output_to_cache(self):
+        """Adds the output buckets to the output cache (if any).
+
+        Buckets that were spilled because they were too big to keep in RAM
+        (or that don't fit in the cache) are left to be read from their
+        files, and a warning is logged.
+        """
+        if self.output_cache is None:
+            return
+        uncached = 0
+        buckets = [b for b in self.output[:, :] if b.url]
+        for b in buckets:
+            if b.spilled:
+                uncached += 1
+            elif not self.output_cache.put(self.dataset_id, b.url, b._data):
+                uncached += 1
+        if uncached:
+            logger.warning('Task %s of dataset %s: %s of %s output buckets'
+                    ' are too big for the bucket cache (see --mrs-cache-size)'
+                    ' and will be read from disk.' % (self.task_index,
+                        self.dataset_id, uncached, len(buckets)))
+
+    def make_outdir(self, default_dir, serial=False):
         """Makes an output directory if necessary.
 
         Returns a bool indicating whether the files should be preserved (as
         opposed to automatically deleted).  Sets self.outdir, a path to a
-        directory where output files should be created.
+        directory where output files should be created.  In serial mode,
+        temporary output stays in RAM unless it is spilled, so only permanent
+        storage gets an output directory.
         """
         permanent = False
+        if serial:
+            default_dir = None
         if self.storage or default_dir:
             if self.storage:
                 self.outdir = self.storage
@@ -181,22 +283,35 @@ class MapTask(Task):
     def run(self, program, default_dir, serial=False, max_sort_size=None):
         assert isinstance(self.op, MapOperation)
 
-        all_input = self._get_all_input(serial)
-        permanent = self.make_outdir(default_dir)
-        kwds = self._outdata_kwds(program, permanent, serial)
-        map_itr = self.op.map(program, all_input)
-        self.output = datasets.LocalData(map_itr, permanent=permanent, **kwds)
+        # A vectorized mapper without a combiner reads and writes whole
+        # arrays.  Otherwise, its input and output are converted to pairs.
+        vectorized = (self.op.is_vectorized(program) and
+                not self.op.combine_name)
+        if vectorized:
+            all_input = self._get_input_arrays(program, serial)
+        else:
+            all_input = self._get_all_input(program, serial)
+        permanent = self.make_outdir(default_dir, serial)
+        kwds = self._outdata_kwds(program, permanent, serial, default_dir,
+                max_sort_size)
+        if vectorized:
+            map_itr = self.op.map_arrays(program, all_input)
+        else:
+            map_itr = self.op.map(program, all_input)
+        self.output = datasets.LocalData(map_itr, permanent=permanent,
+                vectorized=vectorized, **kwds)
 
 
 class ReduceTask(Task):
     def run(self, program, default_dir, serial=False, max_sort_size=None):
         assert isinstance(self.op, ReduceOperation)
 
-        all_input = self._get_all_input(serial, sort=True,
+        all_input = self._get_all_input(program, serial, sort=True,
                 default_dir=default_dir, max_sort_size=max_sort_size)
 
-        permanent = self.make_outdir(default_dir)
-        kwds = self._outdata_kwds(program, permanent, serial)
+        permanent = self.make_outdir(default_dir, serial)
+        kwds = self._outdata_kwds(program, permanent, serial, default_dir,
+                max_sort_size)
         reduce_itr = self.op.reduce(program, all_input)
         self.output = datasets.LocalData(reduce_itr, permanent=permanent,
                 **kwds)
@@ -208,11 +323,12 @@ class ReduceMapTask(Task):
     def run(self, program, default_dir, serial=False, max_sort_size=None):
         assert isinstance(self.op, ReduceMapOperation)
 
-        all_input = self._get_all_input(serial, sort=True,
+        all_input = self._get_all_input(program, serial, sort=True,
                 default_dir=default_dir, max_sort_size=max_sort_size)
 
-        permanent = self.make_outdir(default_dir)
-        kwds = self._outdata_kwds(program, permanent, serial)
+        permanent = self.make_outdir(default_dir, serial)
+        kwds = self._outdata_kwds(program, permanent, serial, default_dir,
+                max_sort_size)
         reduce_itr = self.op.reduce(program, all_input)
         map_itr = self.op.map(program, reduce_itr)
         self.output = datasets.LocalData(map_itr, permanent=permanent, **kwds)
@@ -227,6 +343,18 @@ class Operation(object):
     def parter(self, program):
         return getattr(program, self.part_name)
 
+    def function_names(self):
+        """Returns the names of the program functions applied to records."""
+        return ()
+
+    def mutates_input(self, program):
+        """Reports whether any function may modify the records it is given."""
+        for name in self.function_names():
+            if name and getattr(getattr(program, name), 'mutates_input',
+                    False):
+                return True
+        return False
+
     @staticmethod
     def from_args(op_name, *args):
         cls = OP_CLASSES[op_name]
@@ -234,15 +362,41 @@ class Operation(object):
 
 
 class MapOperation(Operation):
+    """Applies a mapper (and optional combiner) to each input record.
+
+    If `parallelism` is greater than 1, the mapper is applied by a pool of
+    that many processes within the task, and the order of the output records
+    is not guaranteed.  A vectorized mapper (see `mrs.vectorized`) is applied
+    to arrays of records and ignores `parallelism`.
+    """
     op_name = 'map'
     task_class = MapTask
 
-    def __init__(self, map_name, combine_name, *args):
-        Operation.__init__(self, *args)
+    def __init__(self, map_name, combine_name, part_name, parallelism=1):
+        Operation.__init__(self, part_name)
         self.map_name = map_name
         self.combine_name = combine_name
+        self.parallelism = parallelism
         self.id = '%s' % self.map_name
 
+    def function_names(self):
+        return (self.map_name, self.combine_name)
+
+    def is_vectorized(self, program):
+        """Reports whether the mapper takes arrays of keys and values."""
+        return bool(self.map_name and getattr(getattr(program,
+            self.map_name), 'vectorized', False))
+
+    def map_arrays(self, program, input):
+        """Yields (keys, values) arrays from a vectorized mapper.
+
+        The input is an iterator over (keys, values) arrays.
+        """
+        mapper = getattr(program, self.map_name)
+        for keys, values in input:
+            out_keys, out_values = mapper(keys, values)
+            yield out_keys, out_values
+
     def map(self, program, input):
         """Yields map output iterating over the entries in input."""
         if self.map_name is None:
@@ -255,7 +409,10 @@ class MapOperation(Operation):
         else:
             combine_op = None
 
-        map_iter = self._map(mapper, input)
+        if self.is_vectorized(program):
+            map_iter = _vectorized_map(mapper, input)
+        else:
+            map_iter = self._map(mapper, input)
         if combine_op:
             # SORT PHASE
             sorted_map_iter = sorted(map_iter, key=itemgetter(0))
@@ -265,13 +422,14 @@ class MapOperation(Operation):
             return map_iter
 
     def _map(self, mapper, input):
-        for inkey, invalue in input:
-            for key, value in mapper(inkey, invalue):
-                yield (key, value)
+        if self.parallelism > 1:
+            return _parallel_map(mapper, input, self.parallelism)
+        else:
+            return _serial_map(mapper, input)
 
     def to_args(self):
         return (self.op_name, self.map_name, self.combine_name,
-                self.part_name)
+                self.part_name, self.parallelism)
 
 
 class ReduceOperation(Operation):
@@ -283,19 +441,28 @@ class ReduceOperation(Operation):
         self.reduce_name = reduce_name
         self.id = '%s' % self.reduce_name
 
+    def function_names(self):
+        return (self.reduce_name,)
+
     def reduce(self, program, input):
         """Yields reduce output iterating over the entries in input.
 
         A reducer is an iterator taking a key and an iterator over values for
-        that key.  It yields values for that key.
+        that key.  It yields values for that key.  A vectorized reducer (see
+        `mrs.vectorized`) is instead given an array of all of the values for
+        the key.
         """
         if self.reduce_name is None:
             reducer = None
         else:
             reducer = getattr(program, self.reduce_name)
 
-        grouped_input = ((k, (pair[1] for pair in v)) for k, v in
-            itertools.groupby(input, key=itemgetter(0)))
+        if getattr(reducer, 'vectorized', False):
+            grouped_input = ((k, fileformats.as_array([pair[1] for pair in v]))
+                for k, v in itertools.groupby(input, key=itemgetter(0)))
+        else:
+            grouped_input = ((k, (pair[1] for pair in v)) for k, v in
+                itertools.groupby(input, key=itemgetter(0)))
 
         for key, iterator in grouped_input:
             for value in reducer(key, iterator):
@@ -309,19 +476,90 @@ class ReduceMapOperation(MapOperation, ReduceOperation):
     op_name = 'reducemap'
     task_class = ReduceMapTask
 
-    def __init__(self, reduce_name, map_name, combine_name, *args):
-        Operation.__init__(self, *args)
+    def __init__(self, reduce_name, map_name, combine_name, part_name,
+            parallelism=1):
+        Operation.__init__(self, part_name)
         self.reduce_name = reduce_name
         self.map_name = map_name
         self.combine_name = combine_name
+        self.parallelism = parallelism
         self.id = '%s_%s' % (self.reduce_name, self.map_name)
 
+    def function_names(self):
+        return (self.reduce_name, self.map_name, self.combine_name)
+
     def to_args(self):
         return (self.op_name, self.reduce_name, self.map_name,
-                self.combine_name, self.part_name)
+                self.combine_name, self.part_name, self.parallelism)
 
 
 OP_CLASSES = dict((op.op_name, op) for op in (MapOperation, ReduceOperation,
     ReduceMapOperation))
 
+
+def _serial_map(mapper, input):
+    for inkey, invalue in input:
+        for key, value in mapper(inkey, invalue):
+            yield (key, value)
+
+
+def _vectorized_map(mapper, input):
+    """Yields the output of a vectorized mapper applied to batches of pairs."""
+    for batch in fileformats.batches(input, fileformats.VECTOR_BATCH_SIZE):
+        keys, values = mapper(*fileformats.pairs_to_arrays(batch))
+        for pair in fileformats.arrays_to_pairs(keys, values):
+            yield pair
+
+
+def _parallel_map(mapper, input, processes):
+    """Yields map output computed by a pool of processes.
+
+    At most two chunks per process are outstanding at a time, so the input
+    is consumed no faster than the pool can map it.
+    """
+    if hasattr(multiprocessing, 'get_context'):
+        # The mapper is inherited by the pool processes rather than pickled.
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+    pool = context.Pool(processes, _init_map_process, (mapper,))
+    try:
+        pending = collections.deque()
+        for chunk in _chunks(input, MAX_PARALLEL_CHUNK):
+            pending.append(pool.apply_async(_map_chunk, (chunk,)))
+            if len(pending) >= 2 * processes:
+                for pair in pending.popleft().get():
+                    yield pair
+        while pending:
+            for pair in pending.popleft().get():
+                yield pair
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _chunks(input, max_size):
+    """Splits the input iterator into lists of doubling size."""
+    input = iter(input)
+    size = 1
+    while True:
+        chunk = list(itertools.islice(input, size))
+        if not chunk:
+            return
+        yield chunk
+        size = min(2 * size, max_size)
+
+
+# The mapper of a parallel map (set in each process of the pool).
+_process_mapper = None
+
+
+def _init_map_process(mapper):
+    global _process_mapper
+    _process_mapper = mapper
+
+
+def _map_chunk(chunk):
+    return list(_serial_map(_process_mapper, chunk))
+
 # vim: et sw=4 sts=4
@@ -40,7 +40,18 @@ def run_mockparallel(program, args, tmpdir):
     assert exitcode == 0
 
 
-def run_master_slave(program, args, tmpdir):
+def run_local(program, args, tmpdir, workers=2):
+    args = ['-I', 'Local', '--mrs-tmpdir', tmpdir.strpath, '--mrs-workers',
+            str(workers)] + args
+
+    with pytest.raises(SystemExit) as excinfo:
+        main(program, args=args)
+    exitcode = excinfo.value.args[0]
+    assert exitcode == 0
+
+
+def run_master_slave(program, args, tmpdir, implementation='Master',
+        expected_exitcode=0):
     runfile = tmpdir.join('runfile')
 
     procs = []
@@ -49,13 +60,13 @@ def run_master_slave(program, args, tmpdir):
         p.start()
         procs.append(p)
 
-    args = ['-I', 'Master', '--mrs-runfile', runfile.strpath, '--mrs-tmpdir',
+    args = ['-I', implementation, '--mrs-runfile', runfile.strpath, '--mrs-tmpdir',
             tmpdir.strpath] + args
 
     with pytest.raises(SystemExit) as excinfo:
         main(program, args=args)
     exitcode = excinfo.value.args[0]
-    assert exitcode == 0
+    assert exitcode == expected_exitcode
 
     for p in procs:
         p.join()
@@ -17,17 +17,26 @@
 
 from __future__ import division, print_function
 
+import collections
 import errno
 import math
 import os
 import random
 import select
+import socket
 import string
+import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 from logging import getLogger
 logger = getLogger('mrs')
 
@@ -38,6 +47,13 @@ BITS_IN_DOUBLE = 53
 ID_MAXLEN = int(BITS_IN_DOUBLE * math.log(2) / math.log(len(ID_CHARACTERS)))
 ID_RANGES = [len(ID_CHARACTERS) ** i for i in range(ID_MAXLEN + 1)]
 
+# Framing for FramedConnection: each pickle is preceded by its length.
+FRAME_HEADER = struct.Struct('!Q')
+READ_SIZE = 65536
+# Maximum number of bytes read from a connection per event.
+MAX_READ = 16 * READ_SIZE
+NO_MESSAGE = object()
+
 # Python 3 compatibility
 PY3 = sys.version_info[0] == 3
 if not PY3:
@@ -45,38 +61,89 @@ if not PY3:
 
 
 class EventLoop(object):
-    """A very simple event loop that wraps select.poll.
+    """A simple event loop that wraps epoll (or poll if epoll is missing).
 
-    As far as event loops go, this is pretty lame.  Since the multiprocessing
-    module's send/recv methods don't support partial reads, there will still
-    be a significant amount of blocking.  Likewise, this simplistic loop does
-    not support POLLOUT.  If it becomes necessary, it won't be too hard to
-    write a simple replacement for multiprocessing's Pipe that supports
-    partial reading and writing.
+    Each file descriptor has a handler that is called when it is readable
+    (or closed), and it may also have a write handler that is called when
+    it is writable.  A FramedConnection that is attached to the loop
+    registers a write handler only while it has data left to send, so a
+    large message is written a piece at a time between other events.
 
     Attributes:
         handler_map: map from file descriptors to methods for handling reads
-        poll: poll object (from the select module)
+        writer_map: map from file descriptors to methods for handling writes
+        poll: epoll or poll object (from the select module)
         running: bool indicating whether the event loop should continue
     """
     def __init__(self):
         self.handler_map = {}
+        self.writer_map = {}
         self.running = True
-        self.poll = select.poll()
+        self._registered = set()
+        if hasattr(select, 'epoll'):
+            self.poll = select.epoll()
+            self._epoll = True
+            self._read_events = select.EPOLLIN | select.EPOLLPRI
+            self._write_events = select.EPOLLOUT
+            self._error_events = select.EPOLLERR | select.EPOLLHUP
+        else:
+            self.poll = select.poll()
+            self._epoll = False
+            self._read_events = select.POLLIN | select.POLLPRI
+            self._write_events = select.POLLOUT
+            self._error_events = (select.POLLERR | select.POLLHUP |
+                    select.POLLNVAL)
 
     def register_fd(self, fd, handler):
-        """Registers the given file descriptor and handler with poll.
+        """Registers the given file descriptor and read handler."""
+        self.handler_map[fd] = handler
+        self._update(fd)
+
+    def unregister_fd(self, fd):
+        """Stops watching the given file descriptor."""
+        del self.handler_map[fd]
+        self.writer_map.pop(fd, None)
+        self._update(fd)
+
+    def register_writer(self, fd, handler):
+        """Calls the given handler whenever the file descriptor is writable.
 
-        Assumes that the file descriptors are only used in read mode.
+        The handler is called until `unregister_writer` is called.  This may
+        be called from another thread (with epoll, the change takes effect
+        immediately; with poll, it takes effect after the next event).
         """
-        self.handler_map[fd] = handler
-        self.poll.register(fd, select.POLLIN)
+        self.writer_map[fd] = handler
+        self._update(fd)
+
+    def unregister_writer(self, fd):
+        """Stops calling the write handler of the given file descriptor."""
+        if self.writer_map.pop(fd, None) is not None:
+            self._update(fd)
+
+    def _update(self, fd):
+        events = 0
+        if fd in self.handler_map:
+            events |= self._read_events
+        if fd in self.writer_map:
+            events |= self._write_events
+        if events and fd in self._registered:
+            self.poll.modify(fd, events)
+        elif events:
+            self.poll.register(fd, events)
+            self._registered.add(fd)
+        elif fd in self._registered:
+            self._registered.discard(fd)
+            try:
+                self.poll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                # The descriptor was already closed.
+                pass
 
     def run(self, timeout_function=None):
-        """Repeatedly calls poll to read from various file descriptors.
+        """Repeatedly waits for events and calls their handlers.
 
         The timeout_function is called each time through the loop, and its
-        value is used as the timeout for poll (None means to wait
+        value is used as the timeout in seconds (None means to wait
         indefinitely).
         """
         while self.running:
@@ -85,18 +152,216 @@ class EventLoop(object):
             try:
                 if timeout_function:
                     timeout = timeout_function()
+                else:
+                    timeout = None
+                if self._epoll:
+                    if timeout is None:
+                        timeout = -1
+                    events = self.poll.poll(timeout)
+                else:
                     # Note that the timeout of poll is in milliseconds.
                     if timeout is not None:
                         timeout *= 1000
-                else:
-                    timeout = None
-                for fd, event in self.poll.poll(timeout):
-                    self.handler_map[fd]()
+                    events = self.poll.poll(timeout)
+                for fd, event in events:
+                    # A handler may have unregistered another descriptor.
+                    if event & (self._read_events | self._error_events):
+                        handler = self.handler_map.get(fd)
+                        if handler is not None:
+                            handler()
+                    if event & (self._write_events | self._error_events):
+                        handler = self.writer_map.get(fd)
+                        if handler is not None:
+                            handler()
             except select.error as e:
                 if e.args[0] != errno.EINTR:
                     raise
 
 
+def framed_pipe():
+    """Returns a pair of connected FramedConnections.
+
+    This is a replacement for multiprocessing.Pipe (in duplex mode).
+    """
+    sock1, sock2 = socket.socketpair()
+    return FramedConnection(sock1), FramedConnection(sock2)
+
+
+class FramedConnection(object):
+    """A connection for sending pickled objects over a socket.
+
+    Each object is sent as a frame: its length (as an 8-byte integer)
+    followed by its pickle.  The socket is non-blocking, and partial frames
+    are buffered in both directions.  The `send` and `recv` methods block
+    like those of a multiprocessing Connection.  However, once the
+    connection is attached to an EventLoop, `send` only queues whatever
+    cannot be written immediately, and the rest is written by the event
+    loop as the socket becomes writable.  The reader of a connection in an
+    event loop should call `read_messages` rather than `recv`.
+
+    Sending is thread-safe, but only one thread should receive.
+    """
+    def __init__(self, sock):
+        self._sock = sock
+        self._sock.setblocking(False)
+        self._fd = sock.fileno()
+        self._rbuf = bytearray()
+        self._wbuf = collections.deque()
+        self._wlock = threading.Lock()
+        self._eof = False
+        self._event_loop = None
+
+    def __getstate__(self):
+        # Needed for start methods other than fork.
+        return self._sock
+
+    def __setstate__(self, sock):
+        self.__init__(sock)
+
+    def fileno(self):
+        return self._fd
+
+    def attach(self, event_loop):
+        """Makes the event loop responsible for finishing partial writes."""
+        self._event_loop = event_loop
+
+    def close(self):
+        if self._event_loop is not None:
+            self._event_loop.unregister_writer(self._fd)
+            self._event_loop = None
+        self._sock.close()
+
+    def send(self, obj):
+        """Sends the given object.
+
+        If the connection is attached to a running event loop, this never
+        blocks.  Otherwise, it waits until the whole frame is written.
+        """
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        with self._wlock:
+            self._wbuf.append(FRAME_HEADER.pack(len(data)))
+            self._wbuf.append(data)
+            self._write()
+            if not self._wbuf:
+                return
+            event_loop = self._event_loop
+            if event_loop is not None and event_loop.running:
+                event_loop.register_writer(self._fd, self._write_ready)
+                return
+            while self._wbuf:
+                select.select([], [self._sock], [])
+                self._write()
+
+    def _write(self):
+        """Writes as much of the buffered data as possible without blocking.
+
+        Must be called with the write lock held.
+        """
+        while self._wbuf:
+            data = self._wbuf[0]
+            try:
+                n = self._sock.send(data)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            if n == len(data):
+                self._wbuf.popleft()
+            else:
+                self._wbuf[0] = memoryview(data)[n:]
+                return
+
+    def _write_ready(self):
+        """Called by the event loop when the socket is writable."""
+        with self._wlock:
+            try:
+                self._write()
+            except (IOError, OSError):
+                # The other end is closed, so the data can't be delivered.
+                self._wbuf.clear()
+            if not self._wbuf and self._event_loop is not None:
+                self._event_loop.unregister_writer(self._fd)
+
+    def _read(self, limit=None):
+        """Reads available data without blocking (up to about limit bytes).
+
+        Sets the eof flag if the other end is closed.
+        """
+        total = 0
+        while limit is None or total < limit:
+            try:
+                data = self._sock.recv(READ_SIZE)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if e.args[0] == errno.ECONNRESET:
+                    self._eof = True
+                    return
+                raise
+            if not data:
+                self._eof = True
+                return
+            self._rbuf += data
+            total += len(data)
+
+    def _pop_message(self):
+        """Returns the next complete message in the buffer (or NO_MESSAGE)."""
+        header_size = FRAME_HEADER.size
+        if len(self._rbuf) < header_size:
+            return NO_MESSAGE
+        size, = FRAME_HEADER.unpack(bytes(self._rbuf[:header_size]))
+        end = header_size + size
+        if len(self._rbuf) < end:
+            return NO_MESSAGE
+        message = pickle.loads(bytes(self._rbuf[header_size:end]))
+        del self._rbuf[:end]
+        return message
+
+    def read_messages(self):
+        """Returns a list of the complete messages that have been received.
+
+        Reads at most MAX_READ bytes, so a large message arrives over
+        several calls.  Raises EOFError if the other end is closed and no
+        complete messages remain.
+        """
+        self._read(MAX_READ)
+        messages = []
+        while True:
+            message = self._pop_message()
+            if message is NO_MESSAGE:
+                break
+            messages.append(message)
+        if not messages and self._eof:
+            raise EOFError
+        return messages
+
+    def recv(self):
+        """Waits for and returns the next message.
+
+        Raises EOFError if the other end is closed.
+        """
+        while True:
+            message = self._pop_message()
+            if message is not NO_MESSAGE:
+                return message
+            if self._eof:
+                raise EOFError
+            select.select([self._sock], [], [])
+            self._read()
+
+    def poll(self, timeout=0):
+        """Returns whether a message (or EOF) is available to recv."""
+        if len(self._rbuf) >= FRAME_HEADER.size:
+            size, = FRAME_HEADER.unpack(bytes(self._rbuf[:FRAME_HEADER.size]))
+            if len(self._rbuf) >= FRAME_HEADER.size + size:
+                return True
+        if self._eof:
+            return True
+        readable, _, _ = select.select([self._sock], [], [], timeout)
+        return bool(readable)
+
+
+
 def try_makedirs(path):
     """Do the equivalent of mkdir -p."""
     # Workaround for Python issue #14702:
@@ -241,14 +506,27 @@ def profile_call(function, args, kwds, filename):
         prof.dump_stats(tmp_path)
         os.rename(tmp_path, path)
 
+def ram_usage(pid=None):
+    """Returns the resident set size (in kB) of the given process.
+
+    The pid defaults to the current process.  Returns None if the size is
+    unavailable (e.g., if there is no /proc filesystem).
+    """
+    if pid is None:
+        pid = os.getpid()
+    try:
+        with open('/proc/%s/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    _, value = line.split(':')
+                    return int(value.split()[0])
+    except (IOError, OSError):
+        pass
+    return None
+
+
 def log_ram_usage():
     """Log the amount of memory being used by the current process."""
-    pid = os.getpid()
-    with open('/proc/%s/status' % pid) as f:
-        for line in f:
-            if line.startswith('VmRSS:'):
-                _, value = line.split(':')
-                rss = value.strip()
-    logger.debug('Memory usage (RSS): %s' % rss)
+    logger.debug('Memory usage (RSS): %s kB' % ram_usage())
 
 # vim: et sw=4 sts=4
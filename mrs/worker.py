@@ -23,7 +23,9 @@ process is terminated when the main process quits.
 import os
 import traceback
 
+from . import bucket
 from . import datasets
+from . import registry
 from . import tasks
 from . import util
 
@@ -35,7 +37,6 @@ class WorkerSetupRequest(object):
     """Request the worker to run the setup function."""
 
     def __init__(self, opts, args, default_dir):
-        self.id = 'worker_setup'
         self.opts = opts
         self.args = args
         self.default_dir = default_dir
@@ -52,11 +53,21 @@ class WorkerRemoveRequest(object):
         return self.__class__.__name__
 
 
+class WorkerDiscardRequest(object):
+    """Request the worker to drop a removed dataset from its bucket cache."""
+
+    def __init__(self, *args):
+        (self.dataset_id,) = args
+
+    def id(self):
+        return self.__class__.__name__
+
+
 class WorkerTaskRequest(object):
     """Request the to worker to run a task."""
 
     def __init__(self, *args):
-        _, _, self.dataset_id, self.task_index, _, _, _, _, _ = args
+        _, _, self.dataset_id, self.task_index, _, _, _, _, _, _, _ = args
         self.args = args
 
     def id(self):
@@ -84,13 +95,31 @@ class WorkerSetupSuccess(object):
 
 
 class WorkerSuccess(object):
-    """Successful response from worker."""
-    def __init__(self, dataset_id, task_index, outdir, outurls, request_id):
+    """Successful response from worker.
+
+    The sort_path is 'memory' or 'external' if the task sorted its input
+    (see Task.sort_path) and None otherwise.
+    """
+    def __init__(self, dataset_id, task_index, outdir, outurls, request_id,
+            sort_path=None):
         self.dataset_id = dataset_id
         self.task_index = task_index
         self.outdir = outdir
         self.outurls = outurls
         self.request_id = request_id
+        self.sort_path = sort_path
+
+
+def program_key(program_class, opts, args):
+    """Returns a key that identifies a program instance for memoization.
+
+    Implementation options (the ones starting with "mrs__") are left out of
+    the key, since they differ between jobs (e.g., the random seed).
+    """
+    optitems = sorted((name, value) for name, value in vars(opts).items()
+            if not name.startswith('mrs__'))
+    return (registry.object_hash(program_class), repr(optitems),
+            tuple(args))
 
 
 class Worker(object):
@@ -100,7 +129,14 @@ class Worker(object):
     start_map and start_reduce.
 
     This needs to run in a daemon thread rather than in the main thread so
-    that it can be killed by other threads.
+    that it can be killed by other threads.  Input from datasets created
+    with `cache=True` is kept in a BucketCache of up to `mrs__cache_size` MB
+    across tasks.
+
+    A worker may be set up again for a new job (see the slave's daemon mode).
+    If the class, options and args are the same as for the previous job, the
+    program instance is reused rather than instantiated again (its `opts`
+    attribute, if any, is updated for the new job).
     """
     def __init__(self, program_class, request_pipe):
         self.program_class = program_class
@@ -109,6 +145,8 @@ class Worker(object):
         self.program = None
         self.opts = None
         self.args = None
+        self.cache = None
+        self._program_key = None
 
     def run(self):
         while self.run_once():
@@ -126,13 +164,26 @@ class Worker(object):
             request = self.request_pipe.recv()
 
             if isinstance(request, WorkerSetupRequest):
-                assert self.program is None
                 self.opts = request.opts
                 self.args = request.args
-                logger.debug('Starting to run the user setup function.')
-                util.log_ram_usage()
-                self.program = self.program_class(self.opts, self.args)
+                key = program_key(self.program_class, self.opts, self.args)
+                if self.program is not None and key == self._program_key:
+                    logger.info('Reusing the program from the previous job.')
+                    if hasattr(self.program, 'opts'):
+                        self.program.opts = self.opts
+                else:
+                    # Release any previous program before making a new one.
+                    self.program = None
+                    self._program_key = None
+                    logger.debug('Starting to run the user setup function.')
+                    util.log_ram_usage()
+                    self.program = self.program_class(self.opts, self.args)
+                    self._program_key = key
                 self.default_dir = request.default_dir
+                self.cache = None
+                cache_size = getattr(self.opts, 'mrs__cache_size', 0)
+                if cache_size:
+                    self.cache = bucket.BucketCache(1024 * 1024 * cache_size)
                 response = WorkerSetupSuccess()
 
             elif isinstance(request, WorkerQuitRequest):
@@ -141,30 +192,38 @@ class Worker(object):
             elif isinstance(request, WorkerRemoveRequest):
                 util.remove_recursive(request.directory)
 
+            elif isinstance(request, WorkerDiscardRequest):
+                if self.cache is not None:
+                    self.cache.discard(request.dataset_id)
+
             else:
                 assert self.program is not None
                 logger.info('Running task: %s, %s' %
                         (request.dataset_id, request.task_index))
                 util.log_ram_usage()
                 max_sort_size = getattr(self.opts, 'mrs__max_sort_size', None)
-                t = tasks.Task.from_args(*request.args, program=self.program)
+                t = tasks.Task.from_args(*request.args, program=self.program,
+                        cache=self.cache)
                 t.run(self.program, self.default_dir,
                         max_sort_size=max_sort_size)
+                t.save_output_to_cache()
                 response = WorkerSuccess(request.dataset_id,
                         request.task_index, t.outdir, t.outurls(),
-                        request.id())
+                        request.id(), t.sort_path)
                 logger.info('Completed task: %s, %s' %
                         (request.dataset_id, request.task_index))
                 util.log_ram_usage()
         except KeyboardInterrupt:
             return
         except Exception as e:
-            logger.info('Failed task: %s, %s' %
-                    (request.dataset_id, request.task_index))
+            # Setup requests have no dataset_id or task_index.
+            dataset_id = getattr(request, 'dataset_id', None)
+            task_index = getattr(request, 'task_index', None)
+            logger.info('Failed task: %s, %s' % (dataset_id, task_index))
             request_id = request.id() if request else None
             tb = traceback.format_exc()
-            response = WorkerFailure(request.dataset_id, request.task_index,
-                    e, tb, request_id)
+            response = WorkerFailure(dataset_id, task_index, e, tb,
+                    request_id)
 
         if response:
             self.request_pipe.send(response)
@@ -189,9 +248,20 @@ class WorkerManager(object):
     attribute is available.
     """
     def worker_setup(self, opts, args, default_dir):
+        """Asks the worker to run the setup function and waits for it.
+
+        Any response to a task from before the setup (e.g., one assigned by
+        a previous master) is dropped.
+        """
         request = WorkerSetupRequest(opts, args, default_dir)
         self.worker_pipe.send(request)
-        response = self.worker_pipe.recv()
+        while True:
+            response = self.worker_pipe.recv()
+            if (isinstance(response, (WorkerSuccess, WorkerFailure)) and
+                    response.request_id != request.id()):
+                self.drop_task_response(response)
+            else:
+                break
         if isinstance(response, WorkerSetupSuccess):
             return True
         if isinstance(response, WorkerFailure):
@@ -203,10 +273,34 @@ class WorkerManager(object):
         else:
             raise RuntimeError('Invalid message type.')
 
+    def wait_for_task(self):
+        """Waits for the worker to finish the current task (if any).
+
+        The response is dropped rather than handled, so this is only for
+        when the result can no longer be reported (e.g., the master is gone).
+        """
+        while self.current_task is not None:
+            try:
+                response = self.worker_pipe.recv()
+            except EOFError:
+                self.current_task = None
+                return
+            if isinstance(response, (WorkerSuccess, WorkerFailure)):
+                self.drop_task_response(response)
+
+    def drop_task_response(self, response):
+        logger.warning('Dropping the result of task %s, %s, which can no'
+                ' longer be reported.'
+                % (response.dataset_id, response.task_index))
+        self.current_task = None
+
     def read_worker_pipe(self):
-        """Reads a single response from the worker pipe."""
+        """Reads any complete responses from the worker pipe."""
+        for r in self.worker_pipe.read_messages():
+            self.handle_worker_response(r)
 
-        r = self.worker_pipe.recv()
+    def handle_worker_response(self, r):
+        """Handles a single response from the worker."""
         if not (isinstance(r, WorkerSuccess) or isinstance(r, WorkerFailure)):
             assert False, 'Unexpected response type'
 
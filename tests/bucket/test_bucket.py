@@ -1,4 +1,8 @@
-from mrs.bucket import WriteBucket
+import pickle
+import pytest
+
+from mrs import bucket
+from mrs.bucket import BucketCache, ReadBucket, WriteBucket
 from mrs import BinWriter, HexWriter
 
 def test_writebucket():
@@ -108,4 +112,122 @@ def test_roundtrip_write_only(tmpdir):
     listdir = tmpdir.listdir()
     assert listdir == []
 
+def test_spill(tmpdir):
+    spill_dir = tmpdir.join('spill')
+    b = WriteBucket(0, 0, spill_dir=spill_dir.strpath, max_ram_bytes=400)
+    b.collect([(1, 'This'), (2, 'is')])
+    assert not b.spilled
+    # The spill directory is only created when it is needed.
+    assert tmpdir.listdir() == []
+
+    b.collect([(3, 'a'), (4, 'test')])
+    assert b.spilled
+    assert len(b) == 0
+    b.close_writer(do_sync=False)
+
+    readonly_copy = b.readonly_copy()
+    assert readonly_copy.spilled
+    assert readonly_copy.url == spill_dir.listdir()[0].strpath
+    values = ' '.join(value for key, value in readonly_copy.stream())
+    assert values == 'This is a test'
+
+def test_pickle_in_memory():
+    b = WriteBucket(0, 0)
+    b.collect([(1, 'This'), (2, 'is')])
+
+    copy = pickle.loads(pickle.dumps(b.readonly_copy()))
+    assert copy._lazy_bytes is not None
+    assert len(copy) == 2
+    assert copy._lazy_bytes is not None
+    assert list(copy) == [(1, 'This'), (2, 'is')]
+    assert copy._lazy_bytes is None
+
+def test_pickle_file_backed(tmpdir):
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=BinWriter)
+    b.collect([(1, 'This'), (2, 'is')])
+    b.close_writer(do_sync=False)
+
+    data = pickle.dumps(b.readonly_copy())
+    assert b'This' not in data
+
+    copy = pickle.loads(data)
+    assert copy._lazy_url
+    assert len(copy) == 2
+    assert list(copy.stream()) == [(1, 'This'), (2, 'is')]
+    assert copy._lazy_url
+    assert list(copy) == [(1, 'This'), (2, 'is')]
+    assert not copy._lazy_url
+
+@pytest.mark.skipif(bucket.shared_memory is None,
+        reason='shared memory is not supported')
+def test_unreceived_shared_memory(monkeypatch):
+    monkeypatch.setattr(bucket, 'SHARED_MEMORY_MIN_BYTES', 0)
+    b = WriteBucket(0, 0)
+    b.collect([(1, 'x')])
+    received = pickle.loads(pickle.dumps(b.readonly_copy()))
+    pickle.dumps(b.readonly_copy())
+    assert len(bucket._created_segments) == 2
+    assert list(received) == [(1, 'x')]
+
+    # Only the segment that was never received is still linked.
+    names = list(bucket._created_segments)
+    bucket.unlink_shared_memory()
+    assert not bucket._created_segments
+    for name in names:
+        with pytest.raises(OSError):
+            bucket.shared_memory.SharedMemory(name)
+
+@pytest.mark.skipif(bucket.shared_memory is None,
+        reason='shared memory is not supported')
+def test_pickle_shared_memory(monkeypatch):
+    monkeypatch.setattr(bucket, 'SHARED_MEMORY_MIN_BYTES', 0)
+    pairs = [(i, str(i)) for i in range(1000)]
+    b = WriteBucket(0, 0)
+    b.collect(pairs)
+
+    data = pickle.dumps(b.readonly_copy())
+    # Only the name of the segment is pickled, not the 1000 pairs.
+    assert len(data) < 1000
+
+    copy = pickle.loads(data)
+    assert copy._lazy_shm is not None
+    assert len(copy) == 1000
+    assert list(copy) == pairs
+    assert copy._lazy_shm is None
+
+
+def test_bucket_cache_eviction():
+    pairs = [(i, str(i)) for i in range(100)]
+    size = bucket._estimate_size(pairs[:])
+    cache = BucketCache(2 * size)
+
+    a = pairs[:]
+    assert cache.put('ds', 'a', a)
+    assert cache.put('ds', 'b', pairs[:])
+    assert cache.get('ds', 'a') is a
+    # The least recently used entry ('b') is evicted.
+    assert cache.put('ds', 'c', pairs[:])
+    assert cache.get('ds', 'b') is None
+    assert cache.get('ds', 'a') is a
+    assert len(cache) == 2 and cache.size == 2 * size
+
+    assert not cache.put('ds', 'd', pairs * 3)
+    cache.discard('ds')
+    assert len(cache) == 0 and cache.size == 0
+
+
+def test_bucket_cache_oversized(tmpdir):
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=BinWriter)
+    b.collect((i, str(i)) for i in range(1000))
+    b.close_writer(False)
+    copy = ReadBucket(0, 0)
+    copy.url = b.readonly_copy().url
+
+    cache = BucketCache(1000)
+    assert not cache.load(copy, 'ds')
+    # The bucket is left to be streamed from its url.
+    assert not copy._in_memory()
+    assert len(list(copy.stream())) == 1000
+    assert len(cache) == 0 and cache.size == 0
+
 # vim: et sw=4 sts=4
@@ -0,0 +1,34 @@
+import pytest
+
+from mrs.datasets import FileData
+
+
+def test_combine_to(tmpdir):
+    urls = []
+    for dirname in ('a', 'b'):
+        d = tmpdir.mkdir(dirname)
+        for i in range(5):
+            path = d.join('%s.txt' % i)
+            path.write('%s\n' % dirname * (10 * (i + 1)))
+            urls.append(path.strpath)
+    big = tmpdir.join('big.txt')
+    big.write('big\n' * 100)
+    urls.append(big.strpath)
+
+    ds = FileData(urls, combine_to=100)
+    assert ds.splits == 9
+    assert sorted(b.url for b in ds[:, :]) == sorted(urls)
+    for split in range(ds.splits):
+        buckets = list(ds[:, split])
+        sources = [b.source for b in buckets]
+        assert len(set(sources)) == len(sources)
+
+    ds.fetchall()
+    assert len(list(ds.data())) == 2 * 150 + 100
+
+    with pytest.raises(RuntimeError):
+        FileData(urls, splits=2, combine_to=100)
+    with pytest.raises(RuntimeError):
+        FileData(urls, sources=2, combine_to=100)
+
+# vim: et sw=4 sts=4
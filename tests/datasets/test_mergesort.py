@@ -0,0 +1,36 @@
+from mrs.bucket import WriteBucket
+from mrs.datasets import FileData, MergeSortData
+from mrs import BinWriter
+
+PAIRS = [(5, 'e'), (3, 'c'), (1, 'a'), (4, 'd'), (2, 'b')]
+
+
+def make_input(tmpdir):
+    urls = []
+    for source, pairs in enumerate((PAIRS[:3], PAIRS[3:])):
+        b = WriteBucket(source, 0, dir=tmpdir.strpath, format=BinWriter)
+        b.collect(pairs)
+        b.close_writer(False)
+        urls.append(b.readonly_copy().url)
+    return FileData(urls, splits=1)
+
+
+def test_in_memory_sort(tmpdir):
+    input = make_input(tmpdir)
+    sorted_ds = MergeSortData(input, 0, 1, dir=tmpdir.mkdir('sort').strpath)
+
+    assert sorted_ds.in_memory
+    assert list(sorted_ds[:, :]) == []
+    assert list(sorted_ds.stream_data()) == sorted(PAIRS)
+
+
+def test_external_sort(tmpdir):
+    input = make_input(tmpdir)
+    sorted_ds = MergeSortData(input, 0, 0, dir=tmpdir.mkdir('sort').strpath)
+
+    assert not sorted_ds.in_memory
+    # Each batch read from an input bucket is flushed separately.
+    assert len(list(sorted_ds[:, :])) == 2
+    assert list(sorted_ds.stream_data()) == sorted(PAIRS)
+
+# vim: et sw=4 sts=4
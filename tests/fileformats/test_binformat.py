@@ -1,5 +1,6 @@
 from mrs.fileformats import BinReader, BinWriter
-from mrs.serializers import raw_serializer, Serializers
+from mrs.serializers import (auto_dumps, pickle_serializer, raw_serializer,
+        Serializers)
 
 try:
     from cStringIO import StringIO as BytesIO
@@ -32,13 +33,13 @@ def test_raw_roundtrip():
     assert new_pairs == kv_pairs
 
 
-def test_pickle_roundtrip():
+def test_auto_roundtrip():
     kv_pairs = [(b'key 1', b'value 1'),
             (b'hello', b'world'),
             (b'the', b'end')]
-    # Each key or value requires 4 bytes for a length field.
-    # Pickling a bytes object requires 7 bytes plus the length.
-    expected_size = 4 + sum(11 + len(k) + 11 + len(v) for k, v in kv_pairs)
+    # Each key or value requires 4 bytes for a length field.  The type tags
+    # of the keys and values are written once in the header.
+    expected_size = 4 + 2 + sum(4 + len(k) + 4 + len(v) for k, v in kv_pairs)
 
     f = BytesIO()
     writer = BinWriter(f)
@@ -56,4 +57,52 @@ def test_pickle_roundtrip():
 
     assert new_pairs == kv_pairs
 
+
+def test_batches():
+    kv_pairs = [(i, str(i) * (i % 7)) for i in range(2500)]
+
+    f = BytesIO()
+    writer = BinWriter(f)
+    writer.writebatch(kv_pairs[:1000])
+    for pair in kv_pairs[1000:]:
+        writer.writepair(pair)
+    writer.finish()
+    f.seek(0)
+
+    reader = BinReader(f)
+    batches = list(reader.iter_batches(1000))
+    assert [len(batch) for batch in batches] == [1000, 1000, 500]
+    assert [pair for batch in batches for pair in batch] == kv_pairs
+
+
+def test_mixed_types():
+    kv_pairs = [(i, i) for i in range(200)] + [('x', None), (3, 4.5)]
+
+    f = BytesIO()
+    writer = BinWriter(f)
+    writer.writebatch(kv_pairs)
+    writer.finish()
+    assert f.getvalue()[:6] == b'MrsTii'
+    f.seek(0)
+
+    assert list(BinReader(f)) == kv_pairs
+
+    f.seek(0)
+    serializers = Serializers(raw_serializer, '', raw_serializer, '')
+    raw_pairs = list(BinReader(f, serializers=serializers))
+    assert raw_pairs == [(auto_dumps(k), auto_dumps(v)) for k, v in kv_pairs]
+
+
+def test_read_pickle():
+    kv_pairs = [(1, 'a'), ((2, 3), ['b'])]
+    serializers = Serializers(pickle_serializer, '', pickle_serializer, '')
+
+    f = BytesIO()
+    writer = BinWriter(f, serializers=serializers)
+    writer.writebatch(kv_pairs)
+    writer.finish()
+    f.seek(0)
+
+    assert list(BinReader(f)) == kv_pairs
+
 # vim: et sw=4 sts=4
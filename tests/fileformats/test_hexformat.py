@@ -33,13 +33,13 @@ def test_raw_roundtrip():
     assert new_pairs == kv_pairs
 
 
-def test_pickle_roundtrip():
+def test_auto_roundtrip():
     kv_pairs = [(b'key 1', b'value 1'),
             (b'hello', b'world'),
             (b'the', b'end')]
     # Each key-value pair adds a space and a newline.
-    # Pickling a bytes object requires 7 bytes plus the length.
-    expected_size = sum(2 + 2 * (7 + len(k)) + 2 * (7 + len(v))
+    # Each key or value has a one-byte type tag.
+    expected_size = sum(2 + 2 * (1 + len(k)) + 2 * (1 + len(v))
             for k, v in kv_pairs)
 
     f = BytesIO()
@@ -58,4 +58,21 @@ def test_pickle_roundtrip():
 
     assert new_pairs == kv_pairs
 
+
+def test_batches():
+    kv_pairs = [(i, str(i) * (i % 7)) for i in range(2500)]
+
+    f = BytesIO()
+    writer = HexWriter(f)
+    writer.writebatch(kv_pairs[:1000])
+    for pair in kv_pairs[1000:]:
+        writer.writepair(pair)
+    writer.finish()
+    f.seek(0)
+
+    reader = HexReader(f)
+    batches = list(reader.iter_batches(1000))
+    assert [len(batch) for batch in batches] == [1000, 1000, 500]
+    assert [pair for batch in batches for pair in batch] == kv_pairs
+
 # vim: et sw=4 sts=4
@@ -1,6 +1,7 @@
 # coding=utf-8
 
-from mrs.fileformats import LineReader
+from mrs.fileformats import (LineReader, BytesLineReader, TextReader,
+        TextWriter, fileformat, open_url, split_url)
 import sys
 
 try:
@@ -40,4 +41,72 @@ def test_bytesio():
 
     assert lines == list(enumerate(orig_lines))
 
+def test_blocks():
+    orig_lines = ['line %s\r\n' % i for i in range(1000)] + ['last']
+    data = ''.join(orig_lines).encode('utf-8')
+
+    reader = BytesLineReader(BytesIO(data))
+    reader_lines = [line.decode('utf-8') for _, line in reader]
+    assert reader_lines == orig_lines
+
+    reader = LineReader(BytesIO(data))
+    reader.block_size = 100
+    expected = [line.replace('\r\n', '\n') for line in orig_lines]
+    assert list(reader) == list(enumerate(expected))
+
+def test_textreader():
+    pairs = [('a', '1'), ('b', 'two words'), (3, 4.5)]
+    f = BytesIO()
+    with TextWriter(f) as writer:
+        for pair in pairs:
+            writer.writepair(pair)
+    f.seek(0)
+    reader = TextReader(f)
+    assert list(reader) == [(str(k), str(v)) for k, v in pairs]
+    # Reading pairs from mtxt files is opt-in.
+    assert fileformat('output.mtxt') is LineReader
+
+def test_byte_ranges():
+    data = b'first\n\nthird line\nfourth\nno newline'
+    offsets = [0, 6, 7, 18, 25]
+    expected = list(zip(offsets, data.splitlines(True)))
+
+    for size in range(1, len(data) + 1):
+        lines = []
+        for start in range(0, len(data), size):
+            end = min(start + size, len(data))
+            f = BytesIO(data)
+            f.seek(max(start - 1, 0))
+            lines.extend(BytesLineReader(f, start=start, end=end))
+        assert lines == expected
+
+def test_split_url(tmpdir):
+    path = tmpdir.join('input.txt')
+    orig_lines = ['line %s\n' % i for i in range(100)]
+    path.write(''.join(orig_lines))
+
+    urls = split_url(path.strpath, 100)
+    assert len(urls) == 8
+
+    lines = []
+    for url in urls:
+        with open_url(url) as reader:
+            lines.extend(value for key, value in reader)
+    assert lines == orig_lines
+
+
+def test_split_url_appended(tmpdir):
+    path = tmpdir.join('input.txt')
+    orig_lines = ['line %s\n' % i for i in range(100)]
+    path.write(''.join(orig_lines[:50]))
+    # The size is out of date (e.g., from a cached directory listing).
+    urls = split_url(path.strpath, 100, path.size())
+    path.write(''.join(orig_lines[50:]), mode='a')
+
+    lines = []
+    for url in urls:
+        with open_url(url) as reader:
+            lines.extend(value for key, value in reader)
+    assert lines == orig_lines
+
 # vim: et sw=4 sts=4
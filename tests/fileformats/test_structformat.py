@@ -0,0 +1,101 @@
+import pickle
+import struct
+
+import pytest
+
+from mrs.fileformats import StructReader, StructWriter
+from mrs.serializers import (Serializers, make_primitive_serializer,
+        make_struct_serializer, raw_serializer)
+
+try:
+    from cStringIO import StringIO as BytesIO
+except ImportError:
+    from io import BytesIO
+
+KV_PAIRS = [(i, (i * 2, -i)) for i in range(10)]
+
+
+def write_pairs(kv_pairs, block_records=4):
+    serializers = Serializers(make_primitive_serializer('<I'), '',
+            make_struct_serializer('<iq'), '')
+    f = BytesIO()
+    writer = StructWriter(f, serializers=serializers)
+    writer.block_records = block_records
+    for pair in kv_pairs:
+        writer.writepair(pair)
+    writer.finish()
+    f.seek(0)
+    return f
+
+
+def test_roundtrip():
+    f = write_pairs(KV_PAIRS)
+    header_size = 4 + 1 + (4 + 2) + (4 + 3)
+    block_count = 3
+    assert len(f.getvalue()) == (header_size + 4 * block_count +
+            len(KV_PAIRS) * (4 + 12))
+
+    reader = StructReader(f)
+    assert list(reader) == KV_PAIRS
+
+
+def test_iter_arrays():
+    f = write_pairs(KV_PAIRS)
+    reader = StructReader(f)
+    blocks = list(reader.iter_arrays())
+    assert len(blocks) == 3
+    keys = [k for block_keys, _ in blocks for k in block_keys]
+    assert keys == [k for k, _ in KV_PAIRS]
+    values = [tuple(v) for _, block_values in blocks for v in block_values]
+    assert values == [v for _, v in KV_PAIRS]
+
+
+def test_iter_arrays_numpy():
+    numpy = pytest.importorskip('numpy')
+    f = write_pairs(KV_PAIRS, block_records=100)
+    reader = StructReader(f)
+    (keys, values), = reader.iter_arrays()
+    assert keys.dtype == numpy.dtype('<u4')
+    assert list(keys) == [k for k, _ in KV_PAIRS]
+    assert list(values['f1']) == [v for _, (_, v) in KV_PAIRS]
+
+
+def test_raw_read():
+    f = write_pairs(KV_PAIRS)
+    serializers = Serializers(raw_serializer, '', raw_serializer, '')
+    reader = StructReader(f, serializers=serializers)
+    key, value = next(iter(reader))
+    assert key == struct.pack('<I', 0)
+    assert value == struct.pack('<iq', 0, 0)
+
+
+def test_writearrays_numpy():
+    numpy = pytest.importorskip('numpy')
+    serializers = Serializers(make_primitive_serializer('<I'), '',
+            make_struct_serializer('<iq'), '')
+    f = BytesIO()
+    writer = StructWriter(f, serializers=serializers)
+    writer.writepair(KV_PAIRS[0])
+    keys = numpy.array([k for k, _ in KV_PAIRS[1:]])
+    values = numpy.array([v for _, v in KV_PAIRS[1:]])
+    writer.writearrays(keys, values)
+    writer.finish()
+    f.seek(0)
+
+    reader = StructReader(f)
+    assert list(reader) == KV_PAIRS
+    assert len(list(StructReader(BytesIO(f.getvalue())).iter_blocks())) == 2
+
+
+def test_pickle_serializer():
+    s = pickle.loads(pickle.dumps(make_struct_serializer('<iq')))
+    assert s.format == '<iq'
+    assert s.loads(s.dumps((1, 2))) == (1, 2)
+
+
+def test_requires_struct_serializers():
+    serializers = Serializers(raw_serializer, '', raw_serializer, '')
+    with pytest.raises(RuntimeError):
+        StructWriter(BytesIO(), serializers=serializers)
+
+# vim: et sw=4 sts=4
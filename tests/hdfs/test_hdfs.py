@@ -42,6 +42,11 @@ def test_missing_file():
     with pytest.raises(hdfs.FileNotFoundException):
         hdfs.hdfs_open('0potato', 'amcnabb', path)
 
+def test_urlsplit():
+    url = 'hdfs://alice@namenode:9000/user/alice/input'
+    assert hdfs.urlsplit(url) == ('namenode:9000', 'alice', '/user/alice/input')
+    assert hdfs.urlsplit('/user/alice/input') is None
+
 
 if __name__ == '__main__':
     test_hdfs()
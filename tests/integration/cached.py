@@ -0,0 +1,53 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import mrs
+
+ITERATIONS = 3
+
+
+class Cached(mrs.MapReduce):
+    """Increments a set of numbers a few times, caching each iteration.
+
+    Each iteration reads the cached output of the previous one, which is
+    then closed, so the workers are asked to discard it from their caches.
+    """
+
+    def increment(self, key, value):
+        yield (key, value + 1)
+
+    def run(self, job):
+        source = job.local_data([(i, i) for i in range(20)], splits=2)
+        data = job.map_data(source, self.increment, splits=2, cache=True)
+        source.close()
+        for _ in range(ITERATIONS - 1):
+            next_data = job.map_data(data, self.increment, splits=2,
+                    cache=True)
+            data.close()
+            data = next_data
+
+        job.wait(data)
+        data.fetchall()
+        total = sum(value for key, value in data.data())
+        with open(self.args[0], 'w') as f:
+            print(total, file=f)
+        return 0
+
+if __name__ == '__main__':
+    mrs.main(Cached)
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,71 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import os
+import time
+
+import mrs
+
+ITERATIONS = 4
+# The first run fails in this iteration, after its input (the data of the
+# latest checkpoint) has been used and removed.
+CRASH_ITERATION = 2
+
+
+class Checkpointed(mrs.MapReduce):
+    """Increments a set of numbers, checkpointing after each iteration.
+
+    The args are an output file and a file that, if it exists, makes the
+    program fail in CRASH_ITERATION (the file is then removed).  The output
+    file gets the total and the iteration that the program started from.
+    """
+
+    def increment(self, key, value):
+        yield (key, value + 1)
+
+    def run(self, job):
+        outfile, crashfile = self.args
+        state, resumed = job.resume()
+        if state is None:
+            start = 0
+            data = job.local_data([(i, i) for i in range(20)], splits=2)
+        else:
+            start = state['iteration']
+            (data,) = resumed
+
+        for iteration in range(start, ITERATIONS):
+            next_data = job.map_data(data, self.increment, splits=2)
+            data.close()
+            data = next_data
+            job.wait(data)
+            if iteration == CRASH_ITERATION and os.path.exists(crashfile):
+                os.remove(crashfile)
+                # Let the runner remove the closed input first.
+                time.sleep(0.5)
+                return 1
+            job.checkpoint({'iteration': iteration + 1}, data)
+
+        data.fetchall()
+        total = sum(value for key, value in data.data())
+        with open(outfile, 'w') as f:
+            print(total, start, file=f)
+        return 0
+
+if __name__ == '__main__':
+    mrs.main(Checkpointed)
+
+# vim: et sw=4 sts=4
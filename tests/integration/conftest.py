@@ -17,8 +17,11 @@ from __future__ import division, print_function
 
 from multiprocessing import Process
 import pytest
+import sys
 import time
 
+PY3 = sys.version_info[0] == 3
+
 
 def pytest_generate_tests(metafunc):
     if 'mrs_impl' in metafunc.funcargnames:
@@ -28,10 +31,19 @@ def pytest_generate_tests(metafunc):
             for i in (1, 3, 5):
                 metafunc.addcall(funcargs={'mrs_impl': 'mockparallel',
                     'mrs_reduce_tasks': i})
+            for i in (1, 3):
+                metafunc.addcall(funcargs={'mrs_impl': 'local',
+                    'mrs_reduce_tasks': i})
             metafunc.addcall(funcargs={'mrs_impl': 'master_slave',
                 'mrs_reduce_tasks': 1})
+            if PY3:
+                metafunc.addcall(funcargs={'mrs_impl': 'async_master_slave',
+                    'mrs_reduce_tasks': 1})
         else:
-            for mrs_impl in ['serial', 'mockparallel', 'master_slave']:
+            mrs_impls = ['serial', 'mockparallel', 'local', 'master_slave']
+            if PY3:
+                mrs_impls.append('async_master_slave')
+            for mrs_impl in mrs_impls:
                 metafunc.addcall(funcargs={'mrs_impl': mrs_impl})
 
 
@@ -0,0 +1,38 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mrs.test import run_master_slave
+from .checkpointed import Checkpointed, ITERATIONS, CRASH_ITERATION
+
+
+def test_master_slave_resume(tmpdir):
+    outfile = tmpdir.join('total')
+    crashfile = tmpdir.join('crash')
+    crashfile.write('')
+    shared = tmpdir.mkdir('shared')
+    journal = tmpdir.join('journal')
+    args = ['--mrs-shared', shared.strpath, '--mrs-checkpoint',
+            journal.strpath, outfile.strpath, crashfile.strpath]
+
+    run_master_slave(Checkpointed, args, tmpdir, expected_exitcode=1)
+    assert not outfile.check()
+
+    run_master_slave(Checkpointed, ['--mrs-resume'] + args, tmpdir)
+    total, start = outfile.read().split()
+    assert int(total) == sum(range(20)) + 20 * ITERATIONS
+    # The program resumed from the checkpoint before the failure.
+    assert int(start) == CRASH_ITERATION
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,59 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import os
+
+from mrs.test import (run_serial, run_mockparallel, run_local,
+        run_master_slave)
+from .wordcount import WordCount
+
+
+def run(mrs_impl, args, tmpdir):
+    if mrs_impl == 'serial':
+        run_serial(WordCount, args)
+    elif mrs_impl == 'mockparallel':
+        run_mockparallel(WordCount, args, tmpdir)
+    elif mrs_impl == 'local':
+        run_local(WordCount, args, tmpdir)
+    elif mrs_impl == 'master_slave':
+        run_master_slave(WordCount, args, tmpdir)
+    elif mrs_impl == 'async_master_slave':
+        run_master_slave(WordCount, args, tmpdir, 'AsyncMaster')
+    else:
+        raise RuntimeError('Unknown mrs_impl: %s' % mrs_impl)
+
+
+def test_rerun_to_new_outdir(mrs_impl, tmpdir):
+    inputs = glob.glob('tests/data/dickens/*')
+    cache_args = ['--mrs-result-cache', tmpdir.join('cache').strpath]
+    outdir1 = tmpdir.join('out1')
+    outdir2 = tmpdir.join('out2')
+
+    run(mrs_impl, cache_args + inputs + [outdir1.strpath], tmpdir)
+    # The output of the default run method is closed before it is complete,
+    # but it is still cached.
+    assert len(tmpdir.join('cache').listdir()) == 1
+
+    run(mrs_impl, cache_args + inputs + [outdir2.strpath], tmpdir)
+    files1 = sorted(outdir1.listdir())
+    files2 = sorted(outdir2.listdir())
+    assert [f.basename for f in files1] == [f.basename for f in files2]
+    # The cached files were linked into the new output directory instead of
+    # being computed again.
+    for f1, f2 in zip(files1, files2):
+        assert os.path.samefile(f1.strpath, f2.strpath)
+
+# vim: et sw=4 sts=4
@@ -16,7 +16,9 @@
 from collections import defaultdict
 import glob
 
-from mrs.test import run_serial, run_mockparallel, run_master_slave
+from mrs.bucket import WriteBucket
+from mrs.test import (run_serial, run_mockparallel, run_local,
+        run_master_slave)
 from .wordcount import WordCount
 
 
@@ -31,9 +33,15 @@ def test_dickens(mrs_impl, mrs_reduce_tasks, tmpdir):
     elif mrs_impl == 'mockparallel':
         args = ['--mrs-reduce-tasks', str(mrs_reduce_tasks)] + args
         run_mockparallel(WordCount, args, tmpdir)
+    elif mrs_impl == 'local':
+        args = ['--mrs-reduce-tasks', str(mrs_reduce_tasks)] + args
+        run_local(WordCount, args, tmpdir)
     elif mrs_impl == 'master_slave':
         args = ['--mrs-reduce-tasks', str(mrs_reduce_tasks)] + args
         run_master_slave(WordCount, args, tmpdir)
+    elif mrs_impl == 'async_master_slave':
+        args = ['--mrs-reduce-tasks', str(mrs_reduce_tasks)] + args
+        run_master_slave(WordCount, args, tmpdir, 'AsyncMaster')
     else:
         raise RuntimeError('Unknown mrs_impl: %s' % mrs_impl)
 
@@ -69,4 +77,25 @@ def test_dickens(mrs_impl, mrs_reduce_tasks, tmpdir):
     assert counts['settled'] == 1
     assert counts['for'] == 3
 
+
+def test_serial_without_spill_dir(tmpdir, monkeypatch):
+    spill_dirs = []
+    orig_spill = WriteBucket.spill
+
+    def spill(bucket):
+        orig_spill(bucket)
+        if bucket.spilled:
+            spill_dirs.append(bucket.dir)
+    monkeypatch.setattr(WriteBucket, 'spill', spill)
+
+    inputs = glob.glob('tests/data/dickens/*')
+    outdir = tmpdir.join('out')
+    args = ['--mrs-spill-dir', '', '--mrs-max-ram-size', '0']
+    run_serial(WordCount, args + inputs + [outdir.strpath])
+
+    # An empty spill dir keeps everything but the output in RAM, even with
+    # no RAM to spare.
+    assert spill_dirs == [outdir.strpath]
+    assert len(outdir.listdir()) == 1
+
 # vim: et sw=4 sts=4
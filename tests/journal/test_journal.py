@@ -0,0 +1,62 @@
+import os
+
+from mrs.datasets import FileData
+from mrs.journal import Journal, journal_dirs, last_checkpoint
+
+
+def make_data(tmpdir, name, contents='data'):
+    path = tmpdir.join(name)
+    path.write(contents)
+    ds = FileData([path.strpath])
+    ds.fingerprint = name
+    return ds
+
+
+def test_resume(tmpdir):
+    path = tmpdir.join('journal').strpath
+    ds1 = make_data(tmpdir, 'a')
+    ds2 = make_data(tmpdir, 'b')
+
+    journal = Journal(path, False, '', tmpdir.strpath)
+    journal.task_done('x', 3, ds1[:, :])
+    journal.dataset_done(ds2)
+    journal.finish(False)
+
+    assert journal_dirs(path) == ('', tmpdir.strpath)
+    journal = Journal(path, True, '', tmpdir.strpath)
+    assert journal.completed_tasks('x') == [(3, [(0, ds1[0, 0].url)])]
+    assert journal.completed_tasks('y') == []
+    assert journal.lookup_dataset('b') == (1, [(0, 0, ds2[0, 0].url)])
+    assert journal.lookup_dataset('a') is None
+
+    # Changed files are not restored.
+    os.utime(ds2[0, 0].url, (0, 0))
+    assert journal.lookup_dataset('b') is None
+
+    journal.finish(True)
+    assert not os.path.exists(path)
+
+
+def test_checkpoint(tmpdir):
+    path = tmpdir.join('journal').strpath
+    ds1 = make_data(tmpdir, 'a')
+    ds2 = make_data(tmpdir, 'b')
+
+    assert last_checkpoint(path) is None
+    journal = Journal(path, False, '', tmpdir.strpath)
+    assert journal.checkpoint({'iteration': 1}, [ds1])
+    assert journal.checkpoint({'iteration': 2}, [ds2])
+    assert not journal.checkpoint({'iteration': 3},
+            [FileData(['http://example.com/x'])])
+    journal.finish(False)
+
+    state, ds_list = last_checkpoint(path)
+    assert state == {'iteration': 2}
+    assert ds_list == [('b', 1, ['', ''], [(0, 0, ds2[0, 0].url)])]
+
+    # If the latest checkpoint's files changed, the previous one is used.
+    tmpdir.join('b').write('changed')
+    state, ds_list = last_checkpoint(path)
+    assert state == {'iteration': 1}
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,102 @@
+import importlib.util
+import os
+import sys
+
+from mrs.datasets import FileData, LocalData
+from mrs.lineage import (ResultCache, code_fingerprint, link_entries,
+        program_fingerprint, source_fingerprint)
+
+
+def f(x):
+    return x * 2
+
+
+def g(x):
+    return x * 3
+
+
+def test_code_fingerprint():
+    assert code_fingerprint(f) != code_fingerprint(g)
+    assert code_fingerprint(f) == code_fingerprint(f)
+
+
+def load_program(monkeypatch, path, name):
+    spec = importlib.util.spec_from_file_location(name, path.strpath)
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, name, module)
+    spec.loader.exec_module(module)
+    return module.Program()
+
+
+def test_program_fingerprint(tmpdir, monkeypatch):
+    source = """
+import mrs
+
+def helper(x):
+    return x + %s
+
+class Program(mrs.MapReduce):
+    def __init__(self):
+        pass
+"""
+    path = tmpdir.join('program.py')
+    path.write(source % 1)
+    program = load_program(monkeypatch, path, 'program1')
+    same_program = load_program(monkeypatch, path, 'program2')
+    assert program_fingerprint(program) == program_fingerprint(same_program)
+
+    # Changing a helper in the program's module changes the fingerprint.
+    path.write(source % 2)
+    new_program = load_program(monkeypatch, path, 'program3')
+    assert program_fingerprint(program) != program_fingerprint(new_program)
+
+def test_source_fingerprint(tmpdir):
+    path = tmpdir.join('input.txt')
+    path.write('a\nb\n')
+    fingerprint = source_fingerprint(FileData([path.strpath]))
+    assert fingerprint == source_fingerprint(FileData([path.strpath]))
+
+    path.write('a\nbc\n')
+    assert fingerprint != source_fingerprint(FileData([path.strpath]))
+    assert source_fingerprint(FileData(['http://example.com/x'])) is None
+
+    local1 = LocalData([(1, 'a'), (2, 'b')], splits=2)
+    local2 = LocalData([(1, 'a'), (2, 'c')], splits=2)
+    assert source_fingerprint(local1) != source_fingerprint(local2)
+
+
+def test_result_cache(tmpdir):
+    path = tmpdir.join('source_0_split_0_.mrsb')
+    path.write('data')
+    ds = FileData([path.strpath])
+    cache = ResultCache(tmpdir.join('cache').strpath)
+
+    assert cache.lookup('abc') is None
+    assert cache.store('abc', ds)
+    assert cache.lookup('abc') == (1, [(0, 0, path.strpath)])
+
+    # A file that changed since it was cached invalidates the result.
+    os.utime(path.strpath, (0, 0))
+    assert cache.lookup('abc') is None
+
+    assert not cache.store('xyz', FileData(['http://example.com/x']))
+    assert cache.lookup('xyz') is None
+
+
+def test_link_entries(tmpdir):
+    path = tmpdir.mkdir('old').join('source_0_split_0_.mrsb')
+    path.write('data')
+    outdir = tmpdir.mkdir('new')
+    new_path = outdir.join('source_0_split_0_.mrsb')
+
+    entries = [(0, 0, path.strpath)]
+    assert link_entries(entries, outdir.strpath) == [(0, 0, new_path.strpath)]
+    assert new_path.read() == 'data'
+    # Files already in the directory are left alone.
+    assert (link_entries([(0, 0, new_path.strpath)], outdir.strpath) ==
+            [(0, 0, new_path.strpath)])
+
+    http_entries = [(0, 0, 'http://example.com/x')]
+    assert link_entries(http_entries, outdir.strpath) is None
+
+# vim: et sw=4 sts=4
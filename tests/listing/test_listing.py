@@ -0,0 +1,58 @@
+import json
+import os
+
+from mrs.listing import expand_urls
+
+
+def make_tree(tmpdir):
+    tmpdir.join('a.txt').write('a\n')
+    tmpdir.join('b.txt').write('bb\n')
+    tmpdir.join('.hidden').write('hidden\n')
+    tmpdir.join('_SUCCESS').write('')
+    sub = tmpdir.mkdir('sub')
+    sub.join('c.txt').write('ccc\n')
+    sub.join('d.dat').write('dddd\n')
+    return tmpdir
+
+
+def test_directory(tmpdir):
+    root = make_tree(tmpdir)
+    files = expand_urls([root.strpath])
+    assert files == [
+            (root.join('a.txt').strpath, 2),
+            (root.join('b.txt').strpath, 3),
+            (root.join('sub', 'c.txt').strpath, 4),
+            (root.join('sub', 'd.dat').strpath, 5),
+            ]
+
+
+def test_glob(tmpdir):
+    root = make_tree(tmpdir)
+    pattern = os.path.join(root.strpath, '*', '*.txt')
+    files = expand_urls([pattern, 'http://example.com/x.txt'])
+    assert files == [(root.join('sub', 'c.txt').strpath, 4),
+            ('http://example.com/x.txt', None)]
+
+
+def test_cache(tmpdir):
+    root = make_tree(tmpdir.mkdir('input'))
+    cache_path = tmpdir.join('listing.json').strpath
+    files = expand_urls([root.strpath], cache_path)
+
+    # An unchanged directory is read from the cache rather than listed.
+    with open(cache_path) as f:
+        manifest = json.load(f)
+    manifest['dirs'][root.strpath]['files'] = [['cached.txt', 7]]
+    with open(cache_path, 'w') as f:
+        json.dump(manifest, f)
+    cached_files = expand_urls([root.strpath], cache_path)
+    assert cached_files[0] == (root.join('cached.txt').strpath, 7)
+    assert cached_files[1:] == files[2:]
+
+    # A modified directory is listed again.
+    root.join('e.txt').write('eeeee\n')
+    os.utime(root.strpath, (0, 0))
+    new_files = expand_urls([root.strpath], cache_path)
+    assert new_files[2] == (root.join('e.txt').strpath, 6)
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,86 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+
+import pytest
+
+if sys.version_info[0] < 3:
+    pytest.skip('asyncio requires Python 3', allow_module_level=True)
+
+import asyncio
+from xmlrpc.client import Fault
+
+from mrs import http
+from mrs.aiomaster import AsyncChoreQueue, AsyncRPCServer, AsyncServerProxy
+
+
+class Interface(object):
+    def xmlrpc_add(self, x, y):
+        return x + y
+
+    @http.uses_host
+    def xmlrpc_whereami(self, host=None):
+        return host
+
+    def xmlrpc_fail(self):
+        raise ValueError('failed')
+
+
+def test_rpc():
+    async def run():
+        server = AsyncRPCServer(Interface())
+        port = await server.start(0)
+        proxy = AsyncServerProxy('127.0.0.1:%s' % port, 5)
+        try:
+            assert await proxy.add(2, 3) == 5
+            # The second call reuses the connection.
+            assert await proxy.whereami() == '127.0.0.1'
+            with pytest.raises(Fault):
+                await proxy.fail()
+            with pytest.raises(Fault):
+                await proxy.missing()
+        finally:
+            proxy.close()
+            await server.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def test_chore_queue():
+    loop = asyncio.new_event_loop()
+    chore_queue = AsyncChoreQueue(loop)
+    done = []
+
+    async def coroutine_chore(x):
+        done.append(x)
+
+    async def run():
+        chore_queue.do(coroutine_chore, ('delayed',), delay=0.01)
+        chore_queue.do_many([(coroutine_chore, ('now',)),
+            (done.append, ('thread',))])
+        # Delays are rounded up to the timer wheel's resolution.
+        await asyncio.sleep(0.3)
+
+    try:
+        loop.run_until_complete(run())
+        loop.run_until_complete(chore_queue.shutdown())
+    finally:
+        loop.close()
+    assert sorted(done) == ['delayed', 'now', 'thread']
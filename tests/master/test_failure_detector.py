@@ -0,0 +1,93 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+from mrs.master import PhiAccrualDetector, RemoteSlave, Slaves
+from mrs.peons import ChoreQueue
+
+
+def test_silence():
+    detector = PhiAccrualDetector(10)
+    assert detector.phi(1000) == 0
+
+    detector.heard(0)
+    assert detector.phi(5) < 1
+    assert detector.phi(10) < 1
+    # After several missed heartbeats, the slave is very suspicious.
+    assert detector.phi(25) > 8
+    assert detector.phi(40) > detector.phi(25)
+
+
+def test_any_message_resets():
+    detector = PhiAccrualDetector(10)
+    detector.heartbeat(0)
+    detector.heard(20)
+    assert detector.phi(25) < 1
+    # The interval history only includes heartbeats.
+    detector.heartbeat(30)
+    assert detector.phi(35) < 1
+
+
+def test_irregular_heartbeats():
+    regular = PhiAccrualDetector(10)
+    irregular = PhiAccrualDetector(10)
+    for i in range(20):
+        regular.heartbeat(i * 10)
+        irregular.heartbeat(i * 10 + (5 if i % 2 else 0))
+    now = 190 + 20
+    # Jittery heartbeats make a silence less suspicious.
+    assert irregular.phi(now) < regular.phi(now)
+
+
+def test_window():
+    windowed = PhiAccrualDetector(10, window=3)
+    unwindowed = PhiAccrualDetector(10)
+    for i in range(10):
+        windowed.heartbeat(i)
+        unwindowed.heartbeat(i)
+    assert windowed.phi(9 + 2) < 1
+    # The seeded interval has been pushed out of the small window, so the
+    # slave is expected to be heard from sooner.
+    assert windowed.phi(9 + 12) > unwindowed.phi(9 + 12)
+
+
+def test_silence_limit():
+    detector = PhiAccrualDetector(10)
+    detector.heard(0)
+    limit = detector.silence_limit(8)
+    assert abs(detector.phi(limit) - 8) < 1e-6
+    assert 20 < limit < 30
+
+
+def test_messages_postpone_check():
+    read_fd, write_fd = os.pipe()
+    chore_queue = ChoreQueue(write_fd)
+    slaves = Slaves(write_fd, chore_queue, 1, 10, 8)
+    slave = RemoteSlave(0, 'localhost', 1, 'cookie', slaves)
+
+    timer = slave._check_timer
+    when = timer.when
+    time.sleep(0.01)
+    slave.heartbeat({})
+    # Each slave has one check timer, which is only postponed.
+    assert slave._check_timer is timer
+    assert timer.pending() and timer.when > when
+    assert timer.when - time.time() > 20
+
+    timer.cancel()
+    os.close(read_fd)
+    os.close(write_fd)
@@ -0,0 +1,80 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import optparse
+
+from mrs.main import absolute_path_args
+from mrs.service import ServiceRunner
+
+
+class Dataset(object):
+    def __init__(self, ds_id):
+        self.id = ds_id
+
+
+class TaskList(object):
+    def __init__(self, tasks):
+        self.tasks = list(tasks)
+
+    def pop(self):
+        if self.tasks:
+            return self.tasks.pop(0)
+
+
+def make_runner():
+    opts = optparse.Values(dict(mrs__sequential_datasets=False, user='x'))
+    return ServiceRunner(None, opts, [], None, None, None, None)
+
+
+def test_submit_overrides_user_options():
+    runner = make_runner()
+    job_id = runner.submit_job(dict(user='y', mrs__sequential_datasets=True),
+            ['arg'])
+
+    svc_job = runner.jobs[job_id]
+    assert svc_job.opts.user == 'y'
+    assert not svc_job.opts.mrs__sequential_datasets
+    assert runner.opts.user == 'x'
+    assert runner.job_status(job_id) == ('queued', -1)
+    assert runner.job_status(job_id + 1) == ('unknown', -1)
+
+
+def test_absolute_path_args(tmpdir, monkeypatch):
+    tmpdir.join('input.txt').write('')
+    monkeypatch.chdir(tmpdir)
+
+    args = ['input.txt', 'missing', 'hdfs://host/input', 'outdir']
+    assert absolute_path_args(args) == [tmpdir.join('input.txt').strpath,
+            'missing', 'hdfs://host/input', tmpdir.join('outdir').strpath]
+
+
+def test_fair_share():
+    runner = make_runner()
+    job1 = runner.jobs[runner.submit_job({}, [])]
+    job2 = runner.jobs[runner.submit_job({}, [])]
+
+    for svc_job, ds_id, tasks in ((job1, 'a', 'a1 a2 a3'),
+            (job2, 'b', 'b1 b2')):
+        runner.dataset_jobs[ds_id] = svc_job
+        runner.runnable_datasets.append(Dataset(ds_id))
+        runner.tasklists[ds_id] = TaskList(tasks.split())
+
+    # Tasks alternate between the jobs even though job1's dataset is first.
+    tasks = [runner.next_task() for _ in range(6)]
+    assert tasks == ['a1', 'b1', 'a2', 'b2', 'a3', None]
+    assert job1.running == 3
+    assert job2.running == 2
+
+# vim: et sw=4 sts=4
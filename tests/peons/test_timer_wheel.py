@@ -0,0 +1,85 @@
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+
+from mrs.peons import ChoreQueue, Timer, TimerWheel
+
+
+def make_wheel():
+    # Each tick is one second, and the wheel covers 4 ** 3 = 64 seconds.
+    return TimerWheel(now=0, resolution=1, slots=4, levels=3)
+
+
+def test_expire_in_order():
+    wheel = make_wheel()
+    whens = [1, 3, 3.5, 5, 17, 40, 63, 64, 100, 1000]
+    for when in reversed(whens):
+        wheel.add(Timer(None, when, when))
+    assert len(wheel) == len(whens)
+
+    expired = []
+    now = 0
+    while len(wheel):
+        now += 0.5
+        for timer in wheel.advance(now):
+            # Timers expire at the first tick that is not before them.
+            assert timer.when <= now < timer.when + 1
+            assert not timer.pending()
+            expired.append(timer.item)
+    assert expired == whens
+
+
+def test_cancel_and_reset():
+    wheel = make_wheel()
+    timer1 = Timer(None, 10, 'a')
+    timer2 = Timer(None, 20, 'b')
+    assert wheel.add(timer1) == 10
+    assert wheel.add(timer2) == 20
+    assert wheel.next_expiry() == 4
+
+    wheel.remove(timer1)
+    assert not timer1.pending()
+    assert wheel.advance(15) == []
+
+    wheel.remove(timer2)
+    timer2.when = 30.5
+    assert wheel.add(timer2) == 31
+    assert wheel.advance(30) == []
+    assert wheel.advance(31) == [timer2]
+    assert wheel.next_expiry() is None
+
+
+def test_chore_queue_timers():
+    read_fd, write_fd = os.pipe()
+    chore_queue = ChoreQueue(write_fd)
+    timer1 = chore_queue.do(len, ('a',), delay=0.01)
+    timer2 = chore_queue.do(len, ('b',), delay=0.02)
+    # Adding a timer that expires earlier than all others wakes the runner.
+    assert os.read(read_fd, 4096)
+    assert 0 < chore_queue.time_to_reschedule() <= 0.2
+
+    assert timer2.cancel()
+    assert not timer2.cancel()
+    assert timer1.reset(0.01)
+
+    time.sleep(0.25)
+    chore_queue.reschedule()
+    assert chore_queue.get() == (len, ('a',))
+    assert chore_queue.time_to_reschedule() is None
+    assert not timer1.reset(1)
+    os.close(read_fd)
+    os.close(write_fd)
@@ -0,0 +1,18 @@
+import optparse
+
+from mrs.runner import TaskRunner
+
+
+def test_sort_path_stats(capsys):
+    opts = optparse.Values(dict(mrs__sequential_datasets=False))
+    runner = TaskRunner(None, opts, [], None, None, None, None)
+    for sort_path in ('memory', 'external', 'memory', ''):
+        runner.record_sort_path(sort_path)
+
+    runner.timing_stats()
+    assert 'by path (since last): memory 2, external 1' in (
+            capsys.readouterr().err)
+    runner.timing_stats()
+    assert 'memory 0, external 0' in capsys.readouterr().err
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,25 @@
+from mrs.serializers import auto_dumps, auto_dumps_batch, auto_loads
+
+
+def test_roundtrip():
+    objs = [0, -1, 128, 2 ** 70, -2 ** 70, 1.5, u'héllo', b'bytes',
+            (1, u'a', (2.0, b'z')), (), None, True, [1, 2]]
+    for obj in objs:
+        loaded = auto_loads(auto_dumps(obj))
+        assert loaded == obj
+        assert type(loaded) == type(obj)
+
+
+def test_compact_encodings():
+    assert auto_dumps(5) == b'i\x05'
+    assert auto_dumps(-129) == b'i\x7f\xff'
+    assert auto_dumps(u'abc') == b'sabc'
+    assert auto_dumps(b'abc') == b'babc'
+
+
+def test_batch():
+    assert auto_dumps_batch([1, 2]) == (b'i', [b'\x01', b'\x02'])
+    assert auto_dumps_batch([1, u'a']) == (None, [b'i\x01', b'sa'])
+    assert auto_dumps_batch([None]) == (None, [auto_dumps(None)])
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,72 @@
+import pytest
+
+from mrs import serializers
+from mrs.serializers import (from_names, lookup, make_tuple_serializer,
+        marshal_serializer, registered_name, str_serializer,
+        varint_serializer)
+
+
+def test_varint():
+    for i in [0, 1, -1, 63, -64, 64, 2 ** 70, -2 ** 70]:
+        data = varint_serializer.dumps(i)
+        assert varint_serializer.loads(data) == i
+    assert len(varint_serializer.dumps(-64)) == 1
+    assert len(varint_serializer.dumps(64)) == 2
+
+
+def test_marshal():
+    obj = {'a': [1, 2.5, (b'x', None)]}
+    assert marshal_serializer.loads(marshal_serializer.dumps(obj)) == obj
+
+
+def test_tuple():
+    s = make_tuple_serializer(str_serializer, varint_serializer,
+            serializers.raw_serializer)
+    value = (u'word', -300, b'\x00\xff')
+    assert s.loads(s.dumps(value)) == value
+    with pytest.raises(ValueError):
+        s.dumps((u'word', 1))
+
+
+def test_protobuf():
+    class Message(object):
+        def __init__(self):
+            self.data = b''
+
+        def SerializeToString(self):
+            return self.data
+
+        def ParseFromString(self, data):
+            self.data = data
+
+    s = serializers.make_protobuf_serializer(Message)
+    message = Message()
+    message.data = b'payload'
+    assert s.loads(s.dumps(message)).data == b'payload'
+
+
+def test_lookup():
+    assert lookup('varint_serializer') is varint_serializer
+    s = lookup('struct:<iq')
+    assert s.loads(s.dumps((1, 2))) == (1, 2)
+    assert lookup('struct:<iq') is s
+    assert registered_name(s) == 'struct:<iq'
+
+    s = lookup('tuple:str_serializer,primitive:<q')
+    assert s.loads(s.dumps((u'a', 5))) == (u'a', 5)
+
+    with pytest.raises(RuntimeError):
+        lookup('no_such_serializer')
+
+
+def test_from_names():
+    class Program(object):
+        varint_serializer = str_serializer
+
+    result = from_names(('varint_serializer', 'marshal_serializer'),
+            Program())
+    # A program attribute takes precedence over a registered name.
+    assert result.key_s is str_serializer
+    assert result.value_s is marshal_serializer
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,121 @@
+import optparse
+import os
+import threading
+import time
+
+from mrs import http
+from mrs import slave
+from mrs import util
+from mrs import worker
+
+
+class FakeMaster(object):
+    """Answers heartbeats with the given results (exceptions are raised)."""
+    def __init__(self, results):
+        self.results = list(results)
+        self.heartbeats = 0
+
+    def __call__(self, url, timeout):
+        return self
+
+    def heartbeat(self, slave_id, cookie, status):
+        self.heartbeats += 1
+        result = self.results.pop(0) if self.results else True
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def run_heartbeats(monkeypatch, results, count):
+    conn, _ = util.framed_pipe()
+    s = slave.Slave(object, 'http://localhost:1', None, 1, 1, conn)
+    master = FakeMaster(results)
+    monkeypatch.setattr(http, 'TimeoutServerProxy', master)
+    stop = threading.Event()
+    thread = threading.Thread(target=s.heartbeat_loop, args=(0.05, stop))
+    thread.start()
+    while master.heartbeats < count and thread.is_alive():
+        time.sleep(0.01)
+    stop.set()
+    thread.join()
+    return s.exit_pipe_recv.poll()
+
+
+def test_heartbeat_retries(monkeypatch):
+    # A failure within the grace period is tolerated.
+    failures = [True, http.ConnectionFailed('localhost')]
+    assert not run_heartbeats(monkeypatch, failures, 4)
+
+
+def test_heartbeat_gives_up(monkeypatch):
+    failures = [http.ConnectionFailed('localhost')] * 5
+    assert run_heartbeats(monkeypatch, failures, 5)
+
+
+def test_heartbeat_unknown_slave(monkeypatch):
+    assert run_heartbeats(monkeypatch, [True, False], 4)
+
+
+def fake_worker(conn, task_started, task_dirs):
+    """Answers setup requests and finishes one slow task.
+
+    Returns when asked to quit or when the slave closes the pipe.
+    """
+    while True:
+        if task_started.is_set():
+            task_started.clear()
+            time.sleep(0.2)
+            default_dir = task_dirs[0]
+            # The task must still be able to write its output.
+            task_dirs.append(os.path.isdir(default_dir))
+            conn.send(worker.WorkerSuccess('ds', 0, default_dir, [],
+                'WorkerTaskRequest_ds_0'))
+        if not conn.poll(0.01):
+            continue
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if isinstance(request, worker.WorkerQuitRequest):
+            return
+        elif isinstance(request, worker.WorkerSetupRequest):
+            conn.send(worker.WorkerSetupSuccess())
+
+
+def test_signin_with_task_in_flight(tmpdir, monkeypatch):
+    conn, worker_conn = util.framed_pipe()
+    s = slave.Slave(object, 'http://localhost:1', tmpdir.strpath, 1, 1,
+            conn, daemon=True)
+    opts = optparse.Values({'mrs__pingdelay': 100})
+    task_started = threading.Event()
+    task_dirs = []
+
+    monkeypatch.setattr(s, 'signin',
+            lambda: (0, 'localhost', '', opts, []))
+    monkeypatch.setattr(s, 'start_heartbeat_thread', lambda interval: None)
+
+    def report_ready():
+        # The first master assigns a task and is then lost.
+        if not task_dirs:
+            s.current_task = ('ds', 0)
+            task_dirs.append(s.bucket_server.basedir)
+            task_started.set()
+        s.exit()
+    monkeypatch.setattr(s, 'report_ready', report_ready)
+
+    worker_thread = threading.Thread(target=fake_worker,
+            args=(worker_conn, task_started, task_dirs))
+    worker_thread.daemon = True
+    worker_thread.start()
+
+    assert s.run_job() == 0
+    default_dir, existed = task_dirs
+    assert existed
+    assert not os.path.exists(default_dir)
+    assert s.current_task is None
+
+    # The slave signs in to the next master, and the worker is set up.
+    s.reset()
+    assert s.run_job() == 0
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,112 @@
+import os
+
+import mrs
+from mrs.bucket import BucketCache, WriteBucket
+from mrs.datasets import FileData
+from mrs.tasks import MapOperation, ReduceOperation, Task
+
+
+class Program(mrs.MapReduce):
+    def __init__(self):
+        pass
+
+    def map(self, key, value):
+        yield key, 2 * value
+
+    def reduce(self, key, values):
+        yield sum(values)
+
+
+def test_cached_reduce_input(tmpdir):
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=mrs.BinWriter)
+    b.collect((i % 3, i) for i in range(30))
+    b.close_writer(False)
+    url = b.readonly_copy().url
+    input = FileData([url], splits=1, cache=True)
+
+    op = ReduceOperation('reduce', 'mod_partition')
+    args = Task.from_op(op, input, 'test', 0, 1, None, 'mrsb', None).to_args()
+    assert args[-2:] == (input.id, False)
+
+    program = Program()
+    cache = BucketCache(1024 * 1024)
+    expected = [(k, sum(range(k, 30, 3))) for k in range(3)]
+    for i in range(2):
+        task = Task.from_args(*args, program=program, cache=cache)
+        assert task.input_cached
+        task.run(program, tmpdir.mkdir('out%s' % i).strpath)
+        assert list(task.output[0, 0].stream()) == expected
+        if i == 0:
+            # The second task is served from the cache.
+            os.remove(url)
+
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_oversized_input(tmpdir):
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=mrs.BinWriter)
+    b.collect((i % 3, i) for i in range(30))
+    b.close_writer(False)
+    input = FileData([b.readonly_copy().url], splits=1, cache=True)
+
+    op = ReduceOperation('reduce', 'mod_partition')
+    args = Task.from_op(op, input, 'test', 0, 1, None, 'mrsb', None).to_args()
+
+    program = Program()
+    cache = BucketCache(100)
+    task = Task.from_args(*args, program=program, cache=cache)
+    # The input doesn't fit in the cache, so it is read from the file.
+    assert not task.input_cached
+    assert len(cache) == 0
+    task.run(program, tmpdir.mkdir('out').strpath, max_sort_size=1)
+    expected = [(k, sum(range(k, 30, 3))) for k in range(3)]
+    assert list(task.output[0, 0].stream()) == expected
+
+
+def test_cached_output(tmpdir):
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=mrs.BinWriter)
+    b.collect((i, i) for i in range(10))
+    b.close_writer(False)
+    input = FileData([b.readonly_copy().url], splits=1)
+
+    op = MapOperation('map', '', 'mod_partition')
+    task = Task.from_op(op, input, 'test', 0, 2, None, 'mrsb', None)
+    task.cache_output = True
+    args = task.to_args()
+
+    cache = BucketCache(1024 * 1024)
+    program = Program()
+    task = Task.from_args(*args, program=program, cache=cache)
+    task.run(program, tmpdir.mkdir('out').strpath)
+    task.save_output_to_cache()
+
+    assert len(cache) == 2
+    for split, url in task.outurls():
+        expected = [(i, 2 * i) for i in range(split, 10, 2)]
+        assert cache.get('test', url) == expected
+
+
+def test_uncached_output(tmpdir, caplog):
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=mrs.BinWriter)
+    b.collect((i, i) for i in range(100))
+    b.close_writer(False)
+    input = FileData([b.readonly_copy().url], splits=1)
+
+    op = MapOperation('map', '', 'mod_partition')
+    task = Task.from_op(op, input, 'test', 0, 2, None, 'mrsb', None)
+    task.cache_output = True
+    args = task.to_args()
+
+    cache = BucketCache(1000)
+    program = Program()
+    task = Task.from_args(*args, program=program, cache=cache)
+    task.run(program, tmpdir.mkdir('out').strpath)
+    task.save_output_to_cache()
+
+    # The output is too big for the cache, so it is only in its files.
+    assert len(cache) == 0
+    assert '2 of 2 output buckets' in caplog.text
+    for split, url in task.outurls():
+        assert os.path.exists(url)
+
+# vim: et sw=4 sts=4
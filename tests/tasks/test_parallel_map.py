@@ -0,0 +1,20 @@
+from mrs.tasks import MapOperation
+
+
+class Program(object):
+    def mapper(self, key, value):
+        for word in value.split():
+            yield (word, key)
+
+
+def test_parallel_map():
+    input = [(i, 'a b c %s' % i) for i in range(1000)]
+    serial_op = MapOperation('mapper', '', None)
+    parallel_op = MapOperation('mapper', '', None, 3)
+    assert parallel_op.to_args()[-1] == 3
+
+    expected = sorted(serial_op.map(Program(), input))
+    assert len(expected) == 4000
+    assert sorted(parallel_op.map(Program(), input)) == expected
+
+# vim: et sw=4 sts=4
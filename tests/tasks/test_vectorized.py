@@ -0,0 +1,75 @@
+import pytest
+
+import mrs
+from mrs.bucket import WriteBucket
+from mrs.datasets import FileData, LocalData
+from mrs.serializers import Serializers, make_primitive_serializer
+from mrs.tasks import MapOperation, ReduceOperation, Task
+
+
+class Program(mrs.MapReduce):
+    def __init__(self):
+        self.map_calls = []
+
+    @mrs.vectorized
+    def map_batch(self, keys, values):
+        self.map_calls.append(len(keys))
+        return keys, [2 * v for v in values]
+
+    @mrs.vectorized
+    def reduce_batch(self, key, values):
+        yield sum(values)
+
+
+def test_vectorized_map():
+    input = [(i % 5, i) for i in range(100)]
+    op = MapOperation('map_batch', '', 'vectorized_mod_partition')
+    program = Program()
+    assert op.is_vectorized(program)
+
+    output = list(op.map(program, input))
+    assert program.map_calls == [100]
+    assert output == [(k, 2 * v) for k, v in input]
+
+
+def test_vectorized_reduce():
+    input = sorted((i % 5, i) for i in range(100))
+    op = ReduceOperation('reduce_batch', 'vectorized_mod_partition')
+    output = list(op.reduce(Program(), input))
+    assert output == [(k, sum(range(k, 100, 5))) for k in range(5)]
+
+
+def test_vectorized_partition():
+    program = Program()
+    pairs = [(i, i * i) for i in range(20)]
+    arrays = [([k for k, _ in pairs], [v for _, v in pairs])]
+    ds = LocalData(arrays, splits=3, parter=program.vectorized_mod_partition,
+            vectorized=True)
+    for split in range(3):
+        assert list(ds[0, split]) == [(k, v) for k, v in pairs
+                if k % 3 == split]
+
+
+def test_map_task_struct_input(tmpdir):
+    numpy = pytest.importorskip('numpy')
+    int_s = make_primitive_serializer('<q')
+    serializers = Serializers(int_s, '', int_s, '')
+    b = WriteBucket(0, 0, dir=tmpdir.strpath, format=mrs.StructWriter,
+            serializers=serializers)
+    b.collect((i, i) for i in range(1000))
+    b.close_writer(False)
+    input = FileData([b.readonly_copy().url], splits=1,
+            serializers=serializers)
+
+    op = MapOperation('map_batch', '', 'vectorized_mod_partition')
+    task = Task.from_op(op, input, 'test', 0, 2, None, 'mrss', serializers)
+    program = Program()
+    task.run(program, tmpdir.mkdir('out').strpath)
+
+    # The input is read in a single block, not a record at a time.
+    assert program.map_calls == [1000]
+    for split in range(2):
+        output = list(task.output[0, split].stream())
+        assert output == [(i, 2 * i) for i in range(split, 1000, 2)]
+
+# vim: et sw=4 sts=4
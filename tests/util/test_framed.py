@@ -0,0 +1,45 @@
+import pytest
+
+from mrs.util import EventLoop, framed_pipe
+
+
+def test_blocking():
+    conn1, conn2 = framed_pipe()
+    conn1.send(('hello', 1))
+    conn1.send(None)
+    assert conn2.poll()
+    assert conn2.recv() == ('hello', 1)
+    assert conn2.recv() is None
+    assert not conn2.poll()
+
+    conn1.close()
+    with pytest.raises(EOFError):
+        conn2.recv()
+
+
+def test_event_loop_writes():
+    conn1, conn2 = framed_pipe()
+    loop = EventLoop()
+    conn1.attach(loop)
+    received = []
+
+    def read():
+        received.extend(conn2.read_messages())
+        if len(received) == 2:
+            loop.running = False
+
+    loop.register_fd(conn2.fileno(), read)
+    # The message is much larger than the socket buffer, so send returns
+    # before it is written, and the loop writes the rest.
+    big = b'x' * (8 * 1024 * 1024)
+    conn1.send(big)
+    assert conn1.fileno() in loop.writer_map
+    conn1.send('small')
+    loop.run()
+
+    assert received == [big, 'small']
+    assert conn1.fileno() not in loop.writer_map
+
+    conn1.close()
+    with pytest.raises(EOFError):
+        conn2.read_messages()
@@ -0,0 +1,91 @@
+import multiprocessing
+import optparse
+import threading
+
+from mrs import worker
+
+
+class Program(object):
+    instances = 0
+
+    def __init__(self, opts, args):
+        Program.instances += 1
+        self.opts = opts
+
+
+class Failing(object):
+    def __init__(self, opts, args):
+        raise ValueError('setup failed')
+
+
+def setup(w, conn, **optdict):
+    opts = optparse.Values(optdict)
+    conn.send(worker.WorkerSetupRequest(opts, ['input'], None))
+    assert w.run_once()
+    assert isinstance(conn.recv(), worker.WorkerSetupSuccess)
+
+
+def test_program_reused_across_jobs():
+    conn, worker_conn = multiprocessing.Pipe()
+    w = worker.Worker(Program, worker_conn)
+    Program.instances = 0
+
+    setup(w, conn, size=3, mrs__seed='1')
+    program = w.program
+    # A new seed does not require a new instance, but it is passed on.
+    setup(w, conn, size=3, mrs__seed='2')
+    assert w.program is program
+    assert program.opts.mrs__seed == '2'
+    assert Program.instances == 1
+
+    setup(w, conn, size=4, mrs__seed='2')
+    assert w.program is not program
+    assert Program.instances == 2
+
+
+def test_discard_request():
+    conn, worker_conn = multiprocessing.Pipe()
+    w = worker.Worker(Program, worker_conn)
+    setup(w, conn, mrs__cache_size=1)
+    w.cache.put('ds', 'url', [(1, 2)])
+    w.cache.put('other', 'url', [(1, 2)])
+
+    conn.send(worker.WorkerDiscardRequest('ds'))
+    assert w.run_once()
+    assert w.cache.get('ds', 'url') is None
+    assert w.cache.get('other', 'url') == [(1, 2)]
+    # Discarding sends no response.
+    assert not conn.poll()
+
+
+class Manager(worker.WorkerManager):
+    def __init__(self, worker_pipe):
+        self.worker_pipe = worker_pipe
+        self.current_task = None
+
+
+def test_setup_drops_stale_response():
+    conn, worker_conn = multiprocessing.Pipe()
+    manager = Manager(conn)
+    manager.current_task = ('ds', 0)
+
+    # The worker finishes a task from before the setup request.
+    worker_conn.send(worker.WorkerSuccess('ds', 0, None, [],
+        'WorkerTaskRequest_ds_0'))
+    worker_conn.send(worker.WorkerSetupSuccess())
+    assert manager.worker_setup(optparse.Values(), [], None)
+    assert isinstance(worker_conn.recv(), worker.WorkerSetupRequest)
+    assert manager.current_task is None
+
+
+def test_setup_failure():
+    conn, worker_conn = multiprocessing.Pipe()
+    manager = Manager(conn)
+    w = worker.Worker(Failing, worker_conn)
+
+    thread = threading.Thread(target=w.run_once)
+    thread.start()
+    assert not manager.worker_setup(optparse.Values(), [], None)
+    thread.join()
+
+# vim: et sw=4 sts=4
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Mrs
+# Copyright 2008-2012 Brigham Young University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Measures the throughput of the built-in serializers.
+
+Each serializer is timed dumping and then loading a list of sample records
+of a type that it supports.
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import sys
+import time
+
+try:
+    import mrs
+except ImportError:
+    import os
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from mrs import serializers
+
+
+def sample_records(n):
+    """Returns a list of (serializer name, records) pairs to benchmark."""
+    ints = [(i * 7919) % 100000 - 50000 for i in range(n)]
+    words = [u'word%s' % (i % 5000) for i in range(n)]
+    pairs = [(word, i) for word, i in zip(words, ints)]
+    return [
+            ('raw_serializer', [word.encode('utf-8') for word in words]),
+            ('str_serializer', words),
+            ('int_serializer', ints),
+            ('varint_serializer', ints),
+            ('primitive:<q', ints),
+            ('auto_serializer', ints),
+            ('auto_serializer', words),
+            ('auto_serializer', pairs),
+            ('pickle_serializer', ints),
+            ('pickle_serializer', pairs),
+            ('marshal_serializer', ints),
+            ('marshal_serializer', pairs),
+            ('struct:<qq', [(i, -i) for i in ints]),
+            ('tuple:str_serializer,varint_serializer', pairs),
+            ]
+
+
+def benchmark(serializer, records):
+    """Returns the dumps and loads throughputs (records per second)."""
+    dumps = serializer.dumps or (lambda x: x)
+    loads = serializer.loads or (lambda x: x)
+
+    start = time.time()
+    data = list(map(dumps, records))
+    dumps_time = time.time() - start
+
+    start = time.time()
+    loaded = list(map(loads, data))
+    loads_time = time.time() - start
+
+    assert loaded == records
+    size = sum(len(x) for x in data) / len(data)
+    return len(records) / dumps_time, len(records) / loads_time, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark serializers')
+    parser.add_argument('-n', '--records', type=int, default=200000,
+            help='Number of records for each serializer')
+    args = parser.parse_args()
+
+    print('%-40s %-8s %12s %12s %8s' % ('serializer', 'type', 'dumps/s',
+        'loads/s', 'bytes'))
+    for name, records in sample_records(args.records):
+        serializer = serializers.lookup(name)
+        dumps_rate, loads_rate, size = benchmark(serializer, records)
+        record_type = type(records[0]).__name__
+        print('%-40s %-8s %12.0f %12.0f %8.1f' % (name, record_type,
+            dumps_rate, loads_rate, size))
+
+
+if __name__ == '__main__':
+    main()
+
+# vim: et sw=4 sts=4